@@ -1,9 +1,9 @@
-import base64
 import datetime
 import logging
 import os
 import time
-from typing import List
+from functools import partial
+from typing import Dict, List, Tuple, Union
 
 import folium
 from matplotlib import pyplot as plt
@@ -14,10 +14,21 @@ import streamlit as st
 from folium.plugins import Draw
 from mapa_streamlit import convert_bbox_to_tif
 from mapa_streamlit.caching import get_hash_of_geojson
+from mapa_streamlit.histogram import create_histogram_figure
+from mapa_streamlit.indices import InvalidExpression, get_available_indices, parse_expression, resolve_indices
+from mapa_streamlit.serving import (
+    get_download_url,
+    is_download_registered,
+    is_download_server_reachable,
+    new_download_session,
+    open_download,
+    register_download,
+)
+from mapa_streamlit.speculation import Speculation, speculate
 from mapa_streamlit.stac import create_and_save_gif, fetch_stac_items_for_bbox, get_band_metadata
 from mapa_streamlit.utils import GIFTMPDIR, TMPDIR
+from mapa_streamlit.zip import create_zip_archive
 from streamlit_folium import st_folium
-import plotly.graph_objects as go
 
 
 from mapa_streamlit.cleaning import run_cleanup_job
@@ -26,10 +37,15 @@ from mapa_streamlit.settings import (
     BTN_LABEL_DOWNLOAD_GIFS,
     BTN_LABEL_DOWNLOAD_TIFS,
     DISK_CLEANING_THRESHOLD,
+    ESTIMATE_CAPTION,
     MAP_CENTER,
     MAP_ZOOM,
     MAX_ALLOWED_AREA_SIZE,
-    
+    RESULTS_CACHE_MAX_ENTRIES,
+    ClearSkySlider,
+    CustomIndexInput,
+    IndicesSelect,
+    OutputSelect,
 )
 from mapa_streamlit.verification import selected_bbox_in_boundary, selected_bbox_too_large
 
@@ -72,7 +88,8 @@ def _show_map(center: List[float], zoom: int) -> folium.Map:
             "polyline": False,
             "poly": False,
             "circle": False,
-            "polygon": False,
+            # self intersecting polygons are not valid geometries for the search
+            "polygon": {"allowIntersection": False},
             "marker": False,
             "circlemarker": False,
             "rectangle": True,
@@ -82,13 +99,26 @@ def _show_map(center: List[float], zoom: int) -> folium.Map:
     return m
 
 
-def _compute_tif(geometry: dict, progress_bar: st.progress,user_defined_collection,user_defined_bands,date_range,cloud_cover_percentage_value:int) -> None:
+@st.cache_resource
+def _get_map(center: Tuple[float, float], zoom: int) -> folium.Map:
+    # the map with its tile layers and the draw plugin is static, hence it is built once per process and shared by all
+    # sessions instead of on every rerun
+    return _show_map(center=list(center), zoom=zoom)
+
+
+@st.cache_data(show_spinner=False)
+def _get_band_metadata(collection: str) -> pd.DataFrame:
+    return get_band_metadata(collection)
+
+
+def _compute_tif(geometry: dict, progress_bar: st.progress,user_defined_collection,user_defined_bands,date_range,cloud_cover_percentage_value:int, composite: str = None, indices: List[str] = None, min_clear_fraction: float = None) -> bool:
     geo_hash = get_hash_of_geojson(geometry)
     mapa_cache_dir = TMPDIR()
     run_cleanup_job(path=mapa_cache_dir, disk_cleaning_threshold=DISK_CLEANING_THRESHOLD)
     path = mapa_cache_dir / geo_hash
     progress_bar.progress(0)
-    path=convert_bbox_to_tif(
+    # the zip archive is only built once the user actually requests the download
+    tif_paths=convert_bbox_to_tif(
         user_defined_collection=user_defined_collection, 
         user_defined_bands=user_defined_bands,
         bbox_geometry=geometry,
@@ -97,54 +127,65 @@ def _compute_tif(geometry: dict, progress_bar: st.progress,user_defined_collecti
         date_range=date_range,
         cloud_cover_percentage_value=cloud_cover_percentage_value,
         split_area_in_tiles= "1x1",
+        compress=False,
+        composite=composite,
+        indices=indices,
+        min_clear_fraction=min_clear_fraction,
     )
-    if path is None:
+    if tif_paths is None:
         st.warning("No images found for the given bounding box, date range and cloud cover percentage threshold to create .tifs.")
-    else:
-        st.sidebar.success("Successfully requested tif file!")
+        return False
+    tif_paths = tif_paths if isinstance(tif_paths, list) else [tif_paths]
+    register_download(
+        f"{geo_hash}.zip",
+        partial(create_zip_archive, files=tif_paths, output_file=f"{path}.zip"),
+        _get_download_session(),
+    )
+    return True
 
 def warn_large_region():
-    st.sidebar.warning(
+    st.warning(
         "Selected region is too large, fetching data for this area would consume too many resources. "
         "Please select a smaller region."
     )
 
 def warn_outside_boundary():
-    st.sidebar.warning(
-        "Selected rectangle is not within the allowed region of the world map. Do not scroll too far to the left or "
-        "right. Ensure to use the initial center view of the world for drawing your rectangle."
+    st.warning(
+        "Selected region is not within the allowed region of the world map. Do not scroll too far to the left or "
+        "right. Ensure to use the initial center view of the world for drawing your rectangle or polygon."
     )
 
-def _check_area_and_compute_tif(folium_output: dict, geo_hash: str, progress_bar: st.progress, date_range: str,cloud_cover_percentage_value:int) -> None:
-    user_defined_collection, user_defined_bands, geometry = extract_parameters(folium_output, geo_hash)
+def _is_valid_region(geometry: dict) -> bool:
     if selected_bbox_too_large(geometry, threshold=MAX_ALLOWED_AREA_SIZE):
         warn_large_region()
-    elif not selected_bbox_in_boundary(geometry):
+        return False
+    if not selected_bbox_in_boundary(geometry):
         warn_outside_boundary()
+        return False
+    return True
+
+
+def _speculate(geometry: dict, request: dict) -> Union[None, Speculation]:
+    """Runs the search and the header reads of `request` ahead in the background while the user is still choosing,
+    see `speculation.speculate`. The speculation of the session is superseded by new drawings and changed parameters."""
+    previous = st.session_state.get("speculation")
+    if selected_bbox_too_large(geometry, threshold=MAX_ALLOWED_AREA_SIZE) or not selected_bbox_in_boundary(geometry):
+        if previous is not None:
+            previous.cancel()
+        st.session_state.speculation = None
     else:
-        _compute_tif(geometry, progress_bar, user_defined_collection, user_defined_bands, date_range,cloud_cover_percentage_value)
+        st.session_state.speculation = speculate(previous, geometry, **request)
+    return st.session_state.speculation
 
 
-def extract_parameters(folium_output, geo_hash):
-    user_defined_collection=st.session_state.selected_collection
-    user_defined_bands=st.session_state.selected_bands
-    all_drawings_dict = {
-        get_hash_of_geojson(draw["geometry"]): draw["geometry"] for draw in folium_output["all_drawings"]
-    }
-    geometry = all_drawings_dict[geo_hash]
-    return user_defined_collection,user_defined_bands,geometry
+def _check_area_and_compute_tif(geometry: dict, progress_bar: st.progress, user_defined_collection: str, user_defined_bands: List[str], date_range: str,cloud_cover_percentage_value:int, composite: str = None, indices: List[str] = None, min_clear_fraction: float = None) -> bool:
+    if not _is_valid_region(geometry):
+        return False
+    return _compute_tif(geometry, progress_bar, user_defined_collection, user_defined_bands, date_range,cloud_cover_percentage_value, composite, indices, min_clear_fraction)
 
-def _compute_gif(folium_output: dict, geo_hash: str,date_range:str,cloud_cover_percentage_value:int):
-    
-    user_defined_collection, user_defined_bands, geometry = extract_parameters(folium_output, geo_hash)
-    if selected_bbox_too_large(geometry, threshold=MAX_ALLOWED_AREA_SIZE):
-        warn_large_region()
-    elif not selected_bbox_in_boundary(geometry):
-        warn_outside_boundary()
-
-    else:
-        path= TMPDIR()
 
+def _compute_gif(geometry: dict, user_defined_collection: str, user_defined_bands: List[str], date_range:str,cloud_cover_percentage_value:int):
+    if _is_valid_region(geometry):
         geo_hash = get_hash_of_geojson(geometry)
         mapa_cache_dir = GIFTMPDIR()
         run_cleanup_job(path=mapa_cache_dir, disk_cleaning_threshold=DISK_CLEANING_THRESHOLD)
@@ -152,22 +193,28 @@ def _compute_gif(folium_output: dict, geo_hash: str,date_range:str,cloud_cover_p
 
         gif_path=create_and_save_gif(geometry,geo_hash,user_defined_collection,user_defined_bands,path,date_range,cloud_cover_percentage_value)
         
-        st.sidebar.success("Successfully generated gif file!")
+        st.success("Successfully generated gif file!")
         return gif_path
 
-def get_binary_file_downloader_html(bin_data, file_label='File'):
-    bin_str = base64.b64encode(bin_data).decode()
-    href = f'<a href="data:image/gif;base64,{bin_str}" download="generated.gif">Click to Download {file_label}</a>'
-    return href
-
-def _download_tifs_btn(data: str, disabled: bool) -> None:
-    st.sidebar.download_button(
-        label=BTN_LABEL_DOWNLOAD_TIFS,
-        data=data,
-        file_name=f'{datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")}_streamlit.zip',
-        disabled=disabled,
-    )
-        
+def _get_download_session() -> str:
+    # the download server only serves the files registered under the token of this session
+    if "download_session" not in st.session_state:
+        st.session_state.download_session = new_download_session()
+    return st.session_state.download_session
+
+
+def _download_btn(label: str, name: str) -> None:
+    session = _get_download_session()
+    if not is_download_registered(name, session):
+        st.link_button(label=label, url="#", disabled=True)
+    elif is_download_server_reachable(st.context.headers.get("Host")):
+        # a plain link to the local download server, the file is streamed from disk instead of being sent through
+        # the websocket on every rerun
+        st.link_button(label=label, url=get_download_url(name, session))
+    else:
+        # the file is only built and sent through streamlit once the button is clicked
+        st.download_button(label=label, data=partial(open_download, name, session), file_name=name, on_click="ignore")
+
 
 def _get_active_drawing_hash(state, drawings: List[str]) -> str:
     # update state initially
@@ -198,45 +245,18 @@ collection_data = {
 
 
 def create_histogram(paths, array, tif_selectbox, selected_bands):
-    if len(selected_bands)==1:
-        print(array.shape)
-        print("name: ", tif_selectbox)
-        filenames = [path.name for path in paths]
-        data_distributions = array.squeeze(axis=-1)  
-        histogram_traces = []
-        for filename, distribution_data in zip(filenames, data_distributions):
-            if filename == tif_selectbox:
-                histogram_trace = go.Histogram(x=distribution_data.flatten(), name=filename, histnorm='probability')
-                histogram_traces.append(histogram_trace)
-        if histogram_traces:  
-            layout = go.Layout(title='Pixel Value Distribution Plot', xaxis=dict(title='Pixel Value'), yaxis=dict(title='Frequency'))
-            fig = go.Figure(data=histogram_traces, layout=layout)
-            st.plotly_chart(fig)
-        else:
-            st.write(f"No histogram data found for '{tif_selectbox}'.")
-        
-    if len(selected_bands)>1:
-            print("name: ", tif_selectbox)
-            filenames = [path.name for path in paths]
-            filenames = list(dict.fromkeys(filenames))
-            histogram_traces = []
-            for filename, distribution_data in zip(filenames, array):
-                if filename == tif_selectbox:
-                    for i in range(len(selected_bands)):
-                        distribution_array = distribution_data[i]
-                        histogram_trace = go.Histogram(x=distribution_array.flatten(), name=f'{filename} - {selected_bands[i]}', histnorm='probability')
-                        histogram_traces.append(histogram_trace)
-            if histogram_traces:  
-                layout = go.Layout(title='Pixel Value Distribution Plot', xaxis=dict(title='Pixel Value'), yaxis=dict(title='Frequency'))
-                fig = go.Figure(data=histogram_traces, layout=layout)
-                st.plotly_chart(fig)
-            else:
-                st.write(f"No histogram data found for '{tif_selectbox}'.")
-        
+    fig = create_histogram_figure(paths, array, tif_selectbox, selected_bands)
+    if fig is not None:
+        st.plotly_chart(fig)
+    else:
+        st.write(f"No histogram data found for '{tif_selectbox}'.")
 
-@st.cache_data()
-def fetch_stac_items_for_bbox_cached(user_defined_bands, user_defined_collection, geometry, date_range,cloud_cover_percentage_value):
+
+# cached as resource, so that reruns of the results viewer reuse the arrays instead of unpickling a copy of them
+@st.cache_resource(max_entries=RESULTS_CACHE_MAX_ENTRIES, show_spinner=False)
+def fetch_stac_items_for_bbox_cached(user_defined_bands, user_defined_collection, geometry, date_range,cloud_cover_percentage_value, min_clear_fraction=None, indices=None):
     try: 
+        # same arguments as the tifs of the request, so that they are served from the ledger instead of refetched
         paths, array, xx = fetch_stac_items_for_bbox(
         user_defined_bands,
         user_defined_collection,
@@ -245,7 +265,9 @@ def fetch_stac_items_for_bbox_cached(user_defined_bands, user_defined_collection
         cache_dir=TMPDIR(),
         date_range=date_range,
         cloud_cover_percentage_value=cloud_cover_percentage_value,
-        progress_bar=None
+        progress_bar=None,
+        min_clear_fraction=min_clear_fraction,
+        indices=resolve_indices(indices) if indices else None,
         )
         return paths, array, xx
     
@@ -253,49 +275,45 @@ def fetch_stac_items_for_bbox_cached(user_defined_bands, user_defined_collection
         print("No STAC items found for the given bounding box and date range.")
         return None
 
-def plot_images(geo_hash, date_range,folium_output,cloud_cover_percentage_value):
-
-    user_defined_collection, user_defined_bands, geometry = extract_parameters(folium_output, geo_hash)
+def plot_images(geometry, user_defined_collection, user_defined_bands, date_range,cloud_cover_percentage_value, min_clear_fraction=None, indices=None, composite=None):
 
-    if selected_bbox_too_large(geometry, threshold=MAX_ALLOWED_AREA_SIZE):
-        warn_large_region()
-    elif not selected_bbox_in_boundary(geometry):
-        warn_outside_boundary()
-    else:
+    if composite:
+        st.info("Composites have no single scenes to view, please download the composite tif instead.")
+        return
+    if _is_valid_region(geometry):
  
-        stac_result = fetch_stac_items_for_bbox_cached(user_defined_bands, user_defined_collection, geometry, date_range,cloud_cover_percentage_value)
+        stac_result = fetch_stac_items_for_bbox_cached(user_defined_bands, user_defined_collection, geometry, date_range,cloud_cover_percentage_value, min_clear_fraction, indices)
         if stac_result is None:
             st.warning("No data found for the given bounding box, date range and cloud cover percentage threshold")
         else:
             paths, array, xx=stac_result
+            # the tifs of indices only contain the index bands, each shown on its own as they aren't colors
+            shown_bands = list(resolve_indices(indices)) if indices else user_defined_bands
             
             filenames = [path.name for path in paths if not str(path).endswith('.xml')]
             filenames = list(dict.fromkeys(filenames))
             tif_selectbox = st.selectbox("Choose an option", filenames)
             if tif_selectbox:
                 st.write(f"You have chosen: {tif_selectbox}")
-                create_histogram(paths,array,tif_selectbox,user_defined_bands)
+                create_histogram(paths,array,tif_selectbox,shown_bands)
                     
-                if len(user_defined_bands)==1:
-                    bands_str = ", ".join(map(str, user_defined_bands))
-                    for arr in xx[bands_str]:
-                        fig, ax = plt.subplots()
-                        date_time=pd.to_datetime(arr.time.values).to_pydatetime().strftime("%Y-%m-%d_%H-%M-%S")+".tif"
-                        if date_time in tif_selectbox:
-                            ax.set_title(date_time)
-                            im = ax.imshow(arr)
-                            plt.colorbar(im)
-                            st.pyplot(fig)
+                if indices or len(user_defined_bands) == 1:
+                    for band in shown_bands:
+                        for arr in xx[band]:
+                            fig, ax = plt.subplots()
+                            date_time=pd.to_datetime(arr.time.values).to_pydatetime().strftime("%Y-%m-%d_%H-%M-%S")+".tif"
+                            if date_time in tif_selectbox:
+                                ax.set_title(f"{date_time} - {band}" if indices else date_time)
+                                im = ax.imshow(arr)
+                                plt.colorbar(im)
+                                st.pyplot(fig)
                 
                                 
-                if len(user_defined_bands) > 1:
-                    print(user_defined_bands)
-                        
+                if len(user_defined_bands) > 1 and not indices:
+                    # red, green, blue order for true color, without reordering the bands of the request in place
                     if user_defined_bands==['B02', 'B03', 'B04']:
-                        user_defined_bands.reverse()
-                        band_values_list = [xx[band].values for band in user_defined_bands]
-                    else:
-                        band_values_list = [xx[band].values for band in user_defined_bands]
+                        user_defined_bands = user_defined_bands[::-1]
+                    band_values_list = [xx[band].values for band in user_defined_bands]
 
                     if len(user_defined_bands) == 2:
                         empty_band = np.empty_like(band_values_list[0])
@@ -317,10 +335,6 @@ def plot_images(geo_hash, date_range,folium_output,cloud_cover_percentage_value)
                             st.pyplot(fig)
 
 
-def toggle_instructions():
-    st.session_state.show_instructions = not st.session_state.show_instructions
-
-
 def date_range_selector():
     today = datetime.datetime.now()
     this_year = today.year
@@ -338,170 +352,182 @@ def date_range_selector():
     
     return d
 
-if __name__ == "__main__":
-    st.set_page_config(
-        page_title="mapa",
-        page_icon="🌍",
-        layout="wide",
-        initial_sidebar_state="expanded",      
-    )
-
-    st.markdown(
-        """
-        #  Open Data Explorer
-        """,
-        unsafe_allow_html=True,
-    )
-    st.write("\n")
-    if 'show_instructions' not in st.session_state:
-        st.session_state.show_instructions = False
-
-    # Button to toggle instructions visibility
-    if st.button('Instructions'):
-        toggle_instructions()
-
-    # Instructions section
-    if st.session_state.show_instructions:
-        st.markdown(
-            f"""
-             1. Zoom to your region of interest on the map &nbsp; 🌍 &nbsp;
-             2. Click the black square on the map to draw a polygon
-             3. Select date range, collection and up to 3 bands in the sidebar dropdown menus. If you need more information about the bands, scroll down on the sidebar to find a band metadata table. 
-             Note: Selecting more than one band per request will stack the bands together into one tif. 
-             4. Click on <kbd>{BTN_LABEL_CREATE_TIF}</kbd>
-             4. Wait for the computation to finish
-             5. Below the map, view the 'Requested tif information' to view images and their pixel value distribution
-             6. Click on <kbd>{BTN_LABEL_DOWNLOAD_TIFS}</kbd> or <kbd>{BTN_LABEL_DOWNLOAD_GIFS}</kbd> 
-            
-             """,
-            unsafe_allow_html=True,)
-
-    m = _show_map(center=MAP_CENTER, zoom=MAP_ZOOM)
-    output = st_folium(m, key="init", width=1000, height=600)
 
-
-    geo_hash = None
-    if output:
-        if output["all_drawings"] is not None:
-            # get latest modified drawing
-            all_drawings = [get_hash_of_geojson(draw["geometry"]) for draw in output["all_drawings"]]
-            geo_hash = _get_active_drawing_hash(state=st.session_state, drawings=all_drawings)
-    st.write("\n")
+@st.fragment
+def sidebar_controls(drawings: Dict[str, dict], geo_hash: Union[str, None]) -> None:
+    """Request parameters, buttons and band metadata. Changing them only reruns this fragment, not the map and the
+    results viewer."""
     # ensure progress bar resides at top of sidebar and is invisible initially
-    progress_bar = st.sidebar.progress(0)
+    progress_bar = st.progress(0)
     progress_bar.empty()
 
-
-
     # Getting Started container
-    with st.sidebar.container():
+    with st.container():
 
         cloud_cover_percentage_value = st.slider('Select cloud cover percentage threshold', 0, 100, 20)
+        clear_sky_percentage_value = st.slider(
+            ClearSkySlider.label,
+            min_value=ClearSkySlider.min_value,
+            max_value=ClearSkySlider.max_value,
+            value=ClearSkySlider.value,
+            step=ClearSkySlider.step,
+            help=ClearSkySlider.help,
+        )
 
 
         d = date_range_selector()
         date_range=str('/'.join(map(str, d)))        
 
-        if 'selected_collection' not in st.session_state:
-            st.session_state.selected_collection = st.selectbox('Select a collection', (collection_data.keys()))
-        if 'selected_bands' not in st.session_state:
-            st.session_state.selected_bands = st.multiselect('Select bands', collection_data[st.session_state.selected_collection])
-        else:
-            selected_collection= st.selectbox('Select a collection', (collection_data.keys()))
-            st.session_state.selected_collection =selected_collection
-
-            if st.session_state.selected_collection != 'select':
-                selected_bands = st.multiselect('Select bands', collection_data[selected_collection])
-                st.session_state.selected_bands = selected_bands
-
-
-        find_tifs_button=st.button(
-            BTN_LABEL_CREATE_TIF,
-            key="find_tifs_button",
-            on_click=_check_area_and_compute_tif, 
-            kwargs={"folium_output": output, "geo_hash": geo_hash, "progress_bar": progress_bar, "date_range":date_range,"cloud_cover_percentage_value":cloud_cover_percentage_value},
-            disabled=False if geo_hash else True,
+        selected_collection = st.selectbox('Select a collection', list(collection_data), key="selected_collection")
+        selected_bands = st.multiselect(
+            'Select bands', collection_data[selected_collection], key=f"selected_bands_{selected_collection}"
         )
 
-        output_tifs_file = TMPDIR() / f"{geo_hash}.zip"
-        if output_tifs_file.is_file():
-            with open(output_tifs_file, "rb") as fp:
-                _download_tifs_btn(fp, False)
-        else:
-            _download_tifs_btn(b"None", True)
+        output_selection = st.selectbox(OutputSelect.label, list(OutputSelect.options), help=OutputSelect.help)
 
-        if len(st.session_state.selected_bands) == 1 or len(st.session_state.selected_bands)==3:
+        indices = st.multiselect(
+            IndicesSelect.label, get_available_indices(selected_collection), help=IndicesSelect.help
+        )
+        custom_index = st.text_input(
+            CustomIndexInput.label, placeholder=CustomIndexInput.placeholder, help=CustomIndexInput.help
+        )
+        if custom_index:
+            try:
+                for expression in resolve_indices([custom_index]).values():
+                    parse_expression(expression)
+                indices = indices + [custom_index]
+            except InvalidExpression as e:
+                st.error(f"Invalid custom index: {e}")
+        if indices and OutputSelect.options[output_selection]:
+            st.info("Indices are only computed for single scenes, not for composites.")
+            indices = []
+
+        request = {
+            "user_defined_collection": selected_collection,
+            "user_defined_bands": selected_bands,
+            "date_range": date_range,
+            "cloud_cover_percentage_value": cloud_cover_percentage_value,
+            "min_clear_fraction": clear_sky_percentage_value / 100,
+        }
+        speculation = _speculate(drawings[geo_hash], request) if geo_hash else None
+        if speculation is not None and speculation.estimated_bytes and selected_bands:
+            # only shown once the speculation finished before a later rerun of the controls
+            st.caption(ESTIMATE_CAPTION.format(items=len(speculation.items), mb=speculation.estimated_bytes / 1024**2))
+        if st.button(BTN_LABEL_CREATE_TIF, key="find_tifs_button", disabled=False if geo_hash else True):
+            if speculation is not None:
+                speculation.pick_up()
+            if not selected_bands:
+                st.warning('Please select bands')
+            elif _check_area_and_compute_tif(
+                drawings[geo_hash],
+                progress_bar,
+                composite=OutputSelect.options[output_selection],
+                indices=indices,
+                **request,
+            ):
+                # the results viewer shows the request as it was submitted, so that changing the controls
+                # afterwards doesn't refetch anything
+                st.session_state.tif_request = {
+                    "geometry": drawings[geo_hash],
+                    "composite": OutputSelect.options[output_selection],
+                    "indices": indices,
+                    **request,
+                }
+                st.toast("Successfully requested tif file!")
+                st.rerun()
+
+        _download_btn(BTN_LABEL_DOWNLOAD_TIFS, f"{geo_hash}.zip")
+
+        if len(selected_bands) == 1 or len(selected_bands)==3:
                 if st.button("Generate GIF",disabled=False if geo_hash else True):
    
-                    gif_path = _compute_gif(output, geo_hash, date_range,cloud_cover_percentage_value)
+                    gif_path = _compute_gif(drawings[geo_hash], selected_collection, selected_bands, date_range,cloud_cover_percentage_value)
                     if gif_path is None:
                         st.warning("No images found to create a GIF.")
                     else:
-                        with open(gif_path, "rb") as f:
-                            gif_bytes = f.read()
-                        st.markdown(get_binary_file_downloader_html(gif_bytes, "GIF"), unsafe_allow_html=True)      
+                        register_download(f"{geo_hash}.gif", gif_path, _get_download_session())
+                        _download_btn(BTN_LABEL_DOWNLOAD_GIFS, f"{geo_hash}.gif")
            
 
         else: 
             st.write("To create a gif select 1 or 3 bands.")
 
 
-        st.sidebar.markdown("---")
+        st.markdown("---")
 
-    with st.sidebar.container():
+    with st.container():
         st.write(
              """
              # Metadata
              Please view the table below for more information about your band selection
              """
          )
-                
-        if 'selected_collection' not in st.session_state:
-            selected_collection = st.table(get_band_metadata(selected_collection))
-        else:
-            selected_collection= st.table(get_band_metadata(st.session_state.selected_collection))
-            selected_collection=st.session_state.selected_collection
-           
+        st.table(_get_band_metadata(selected_collection))
 
-   
-  
-  #Outside of the sidebar  
-    if 'tif_button_clicked' not in st.session_state:
-        st.session_state.tif_button_clicked = False
 
-    if find_tifs_button:
-        st.session_state.tif_button_clicked = True
+@st.fragment
+def results_viewer() -> None:
+    """Images and histograms of the last requested tifs. Choosing another tif only reruns this fragment."""
+    request = st.session_state.get("tif_request")
+    if request is None:
+        return
+    st.markdown(
+        """
+        # Requested tif information
+        Please use the dropdown box to investigate your queried data.
+        """,
+        unsafe_allow_html=True,
+    )
+    plot_images(**request)
 
-    if st.session_state.tif_button_clicked:
-        if not st.session_state.selected_bands:
-            st.warning('Please select bands')
-        else:
-            st.markdown(
-            """
-            # Requested tif information
-            Please use the dropdown box to investigate your queried data.
-            """,
-            unsafe_allow_html=True,
-        )
-            
-            plot_images(geo_hash, date_range,output,cloud_cover_percentage_value)
-            st.session_state.selected_bands or st.session_state.selected_collection
-            # st.session_state.tif_button_clicked = False
-        
 
+if __name__ == "__main__":
+    st.set_page_config(
+        page_title="mapa",
+        page_icon="🌍",
+        layout="wide",
+        initial_sidebar_state="expanded",      
+    )
 
+    st.markdown(
+        """
+        #  Open Data Explorer
+        """,
+        unsafe_allow_html=True,
+    )
+    st.write("\n")
 
+    # Instructions section, expanded and collapsed in the browser without rerunning the script
+    with st.expander('Instructions'):
+        st.markdown(
+            f"""
+             1. Zoom to your region of interest on the map &nbsp; 🌍 &nbsp;
+             2. Click the black square or the pentagon on the map to draw a rectangle or a polygon. Only the pixels within a polygon are fetched, the rest of its bounding box is left empty
+             3. Select date range, collection and up to 3 bands in the sidebar dropdown menus. If you need more information about the bands, scroll down on the sidebar to find a band metadata table. 
+             Note: Selecting more than one band per request will stack the bands together into one tif. 
+             4. Click on <kbd>{BTN_LABEL_CREATE_TIF}</kbd>
+             4. Wait for the computation to finish
+             5. Below the map, view the 'Requested tif information' to view images and their pixel value distribution
+             6. Click on <kbd>{BTN_LABEL_DOWNLOAD_TIFS}</kbd> or <kbd>{BTN_LABEL_DOWNLOAD_GIFS}</kbd> 
             
+             """,
+            unsafe_allow_html=True,)
 
+    # only drawing changes rerun the script, panning and zooming the map don't
+    output = st_folium(
+        _get_map(tuple(MAP_CENTER), MAP_ZOOM), key="init", width=1000, height=600, returned_objects=["all_drawings"]
+    )
 
+    drawings = {}
+    geo_hash = None
+    if output:
+        if output["all_drawings"] is not None:
+            # get latest modified drawing, each drawing is hashed once per rerun
+            drawings = {get_hash_of_geojson(draw["geometry"]): draw["geometry"] for draw in output["all_drawings"]}
+            geo_hash = _get_active_drawing_hash(state=st.session_state, drawings=list(drawings))
+    st.write("\n")
 
+    with st.sidebar:
+        sidebar_controls(drawings, geo_hash)
 
-        
-        
-        
-
-
-                
-                
-
-                
\ No newline at end of file
+    results_viewer()
@@ -1,15 +1,19 @@
 from pathlib import Path
 
 from mapa_streamlit.exceptions import NoSTACItemFound
-import tomli
 
 import logging
 import os
+from importlib.metadata import PackageNotFoundError, version
 from pathlib import Path
 from typing import List, Union
 
 
 
+from mapa_streamlit.composite import composite_stac_items_for_bbox
+from mapa_streamlit.datacube import fetch_stac_items_to_datacube
+from mapa_streamlit.indices import resolve_indices
+from mapa_streamlit.metrics import request_context
 from mapa_streamlit.stac import fetch_stac_items_for_bbox
 from mapa_streamlit.tiling import get_x_y_from_tiles_format
 from mapa_streamlit.utils import TMPDIR, ProgressBar
@@ -22,6 +26,7 @@ log.setLevel(os.getenv("MAPA_LOG_LEVEL", "INFO"))
 
 
 
+@request_context()
 def convert_bbox_to_tif(
     user_defined_collection:str,
     user_defined_bands:list,
@@ -34,6 +39,13 @@ def convert_bbox_to_tif(
     allow_caching: bool = True,
     cache_dir: Union[Path, str] = TMPDIR(),
     progress_bar: Union[None, object] = None,
+    max_items: Union[None, int] = None,
+    composite: Union[None, str] = None,
+    percentile: float = 50,
+    cloud_mask: bool = True,
+    output_format: str = "tif",
+    indices: Union[None, List[str]] = None,
+    min_clear_fraction: Union[None, float] = None,
 ) -> Union[Path, List[Path]]:
     """
     Takes a GeoJSON containing a bounding box as input, fetches the required STAC GeoTIFFs for the
@@ -66,6 +78,28 @@ def convert_bbox_to_tif(
     progress_bar : Union[None, object], optional
         A streamlit progress bar object can be used to indicate the progress of downloading the STAC items. By
         default None
+    max_items : Union[None, int], optional
+        Only fetch the `max_items` least cloudy STAC items. By default None, meaning all matching items are fetched.
+    composite : Union[None, str], optional
+        Instead of one GeoTIFF per scene, reduce all scenes into a single composite GeoTIFF with one of "median",
+        "mean", "percentile" or "min-cloud". By default None
+    percentile : float, optional
+        Percentile in [0, 100] of the "percentile" composite. By default 50
+    cloud_mask : bool, optional
+        Whether clouded pixels are left out of the composite, according to the SCL band of sentinel-2 or the
+        qa_pixel band of landsat. By default True
+    output_format : str, optional
+        Format of the scenes, either one GeoTIFF per scene ("tif") or a single zarr datacube ("zarr") at
+        `output_file`.zarr. An existing datacube is extended with the scenes it is missing, its chunks are
+        compressed already, hence it is never zipped. Composites are always written as GeoTIFF. By default "tif"
+    indices : Union[None, List[str]], optional
+        Write spectral indices instead of the raw bands, each either a built-in index like "NDVI", "NDWI" or "NBR"
+        or a custom band math expression in the form "name=expression", e.g. "ratio=B08 / B04". Only supported for
+        the "tif" output format without composite. By default None
+    min_clear_fraction : Union[None, float], optional
+        Drop scenes of which less than this fraction in [0, 1] of the AOI is clear, according to the SCL band of
+        sentinel-2 or the qa_pixel band of landsat, before loading their bands. Only the mask band is read for the
+        screening, at a coarse resolution. By default None, meaning `conf.SCREENING_MIN_CLEAR_FRACTION`
 
     Returns
     -------
@@ -75,6 +109,11 @@ def convert_bbox_to_tif(
 
     if bbox_geometry is None:
         raise ValueError("⛔️  ERROR: make sure to draw a rectangle on the map first!")
+    if output_format not in ("tif", "zarr"):
+        raise ValueError(f"⛔️  ERROR: unknown output format {output_format}, use 'tif' or 'zarr'")
+    if indices and (composite or output_format != "tif"):
+        raise ValueError("⛔️  ERROR: indices can only be computed for the tif output of single scenes")
+    indices = resolve_indices(indices) if indices else None
 
     tiles = get_x_y_from_tiles_format(split_area_in_tiles)
 
@@ -83,10 +122,42 @@ def convert_bbox_to_tif(
     log.info(f"⏳  converting bounding box to file with arguments: {args}")
 
     if progress_bar:
-        steps = tiles.x * tiles.y * 2 if compress else tiles.x * tiles.y
-        progress_bar = ProgressBar(progress_bar=progress_bar, steps=steps)
+        # the work is registered by the individual stages as soon as its size is known
+        progress_bar = ProgressBar(progress_bar=progress_bar)
 
     try:
+        if composite:
+            path = composite_stac_items_for_bbox(
+                user_defined_bands,
+                user_defined_collection,
+                bbox_geometry,
+                cache_dir,
+                date_range,
+                cloud_cover_percentage_value,
+                method=composite,
+                percentile=percentile,
+                cloud_mask=cloud_mask,
+                progress_bar=progress_bar,
+                max_items=max_items,
+                min_clear_fraction=min_clear_fraction,
+            )
+            if compress:
+                return create_zip_archive(files=[path], output_file=f"{output_file}.zip", progress_bar=progress_bar)
+            return path
+
+        if output_format == "zarr":
+            return fetch_stac_items_to_datacube(
+                user_defined_bands,
+                user_defined_collection,
+                bbox_geometry,
+                f"{output_file}.zarr",
+                date_range,
+                cloud_cover_percentage_value,
+                progress_bar=progress_bar,
+                max_items=max_items,
+                min_clear_fraction=min_clear_fraction,
+            )
+
         tif_and_metadata_paths,arr,xx=fetch_stac_items_for_bbox(user_defined_bands,
         user_defined_collection,
         bbox_geometry,
@@ -94,19 +165,17 @@ def convert_bbox_to_tif(
         cache_dir,
         date_range,
         cloud_cover_percentage_value,
-        progress_bar)    
-        print("######################",tif_and_metadata_paths)
-
-        if progress_bar:
-            progress_bar.step()
+        progress_bar,
+        max_items=max_items,
+        indices=indices,
+        min_clear_fraction=min_clear_fraction)
         if compress:
-            print("TESTING",tif_and_metadata_paths)
             return create_zip_archive(files=tif_and_metadata_paths, output_file=f"{output_file}.zip", progress_bar=progress_bar)
         else:
             return tif_and_metadata_paths[0] if len(tif_and_metadata_paths) == 1 else tif_and_metadata_paths
 
-    except NoSTACItemFound as e:
-        print("No STAC items found for the given bounding box and date range.")
+    except NoSTACItemFound:
+        log.info("No STAC items found for the given bounding box and date range.")
         return None
 
 
@@ -115,10 +184,20 @@ def convert_bbox_to_tif(
 
 
 def _get_version_from_project_toml():
+    import tomli
+
     with open(Path(__file__).parent.parent / "pyproject.toml", "rb") as f:
         toml_dict = tomli.load(f)
 
     return toml_dict["tool"]["poetry"]["version"]
 
 
-__version__ = _get_version_from_project_toml()
+def _get_version() -> str:
+    try:
+        return version("mapa-streamlit")
+    except PackageNotFoundError:
+        # running from a source checkout which was not installed
+        return _get_version_from_project_toml()
+
+
+__version__ = _get_version()
@@ -0,0 +1,346 @@
+import hmac
+import logging
+import os
+import secrets
+import subprocess
+import sys
+import threading
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from hashlib import md5
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Callable, Iterator, List, Tuple, Union
+from urllib.parse import urlparse
+
+from mapa_streamlit import conf
+from mapa_streamlit.cache import TMP_PREFIX, atomic_write, file_lock
+from mapa_streamlit.serving import _parse_range
+from mapa_streamlit.signing import unsign_href
+from mapa_streamlit.utils import TMPDIR
+
+log = logging.getLogger(__name__)
+
+BLOCK_SUFFIX = ".blk"
+SIZE_FILENAME = "size"
+EVICTION_LOCK_NAME = "eviction"
+
+_sessions = threading.local()
+
+# proxy process, the cache directory it serves, its port and the key the hrefs it serves are signed with
+_server: Union[None, Tuple[subprocess.Popen, Path, int, bytes]] = None
+_server_lock = threading.Lock()
+
+
+def _get_session():
+    import requests
+
+    if not hasattr(_sessions, "session"):
+        _sessions.session = requests.Session()
+    return _sessions.session
+
+
+def _iter_runs(indices: List[int]) -> Iterator[List[int]]:
+    """Yields the runs of consecutive `indices`, e.g. [[1, 2], [5]] for [1, 2, 5]."""
+    run: List[int] = []
+    for index in indices:
+        if run and index != run[-1] + 1:
+            yield run
+            run = []
+        run.append(index)
+    if run:
+        yield run
+
+
+def get_cache_key(href: str) -> str:
+    """Key of the file at `href`, the same for all SAS tokens it is signed with."""
+    return md5(unsign_href(href).encode()).hexdigest()
+
+
+class BlockCache:
+    """Disk backed cache of remote files, in blocks of `block_size` bytes keyed by the url without SAS token (see
+    `get_cache_key`) and the index of the block. Each file is a directory of blocks within `cache_dir`, next to its
+    size. Missing blocks of a read are fetched with one range request per run of consecutive blocks. Once the cache
+    exceeds `max_bytes`, the least recently read blocks are evicted."""
+
+    def __init__(
+        self, cache_dir: Union[Path, str], max_bytes: Union[None, int] = None, block_size: Union[None, int] = None
+    ) -> None:
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = conf.BLOCK_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self.block_size = conf.BLOCK_CACHE_BLOCK_SIZE if block_size is None else block_size
+        self._nbytes: Union[None, int] = None
+        self._nbytes_lock = threading.Lock()
+
+    def _get_block(self, directory: Path, index: int) -> Union[None, bytes]:
+        path = directory / f"{index}{BLOCK_SUFFIX}"
+        try:
+            data = path.read_bytes()
+            # the modification time orders the blocks for eviction
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def _put_block(self, directory: Path, index: int, data: bytes) -> None:
+        with atomic_write(directory / f"{index}{BLOCK_SUFFIX}", record=False) as tmp_path:
+            tmp_path.write_bytes(data)
+        self._add_bytes(len(data))
+
+    def _get_size(self, directory: Path) -> Union[None, int]:
+        try:
+            return int((directory / SIZE_FILENAME).read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _fetch(self, href: str, start: int, end: int) -> Tuple[bytes, int]:
+        """Returns the bytes `start` to `end` (inclusive) of `href` and the size of the file."""
+        with _get_session().get(
+            href, headers={"Range": f"bytes={start}-{end}"}, timeout=conf.BLOCK_CACHE_REQUEST_TIMEOUT, stream=True
+        ) as response:
+            response.raise_for_status()
+            if response.status_code == HTTPStatus.PARTIAL_CONTENT:
+                return response.content, int(response.headers["Content-Range"].rsplit("/", 1)[1])
+            # servers which don't support ranges answer with the whole file, which is streamed up to `end` instead
+            if "Content-Length" not in response.headers:
+                raise IOError(f"{unsign_href(href)} was answered without range and length ({response.status_code})")
+            chunks, offset = [], 0
+            for chunk in response.iter_content(chunk_size=self.block_size):
+                if offset + len(chunk) > start:
+                    chunks.append(chunk[max(start - offset, 0) : end + 1 - offset])
+                offset += len(chunk)
+                if offset > end:
+                    break
+            return b"".join(chunks), int(response.headers["Content-Length"])
+
+    def get_size(self, href: str) -> int:
+        """Returns the size of the file at `href`, its first block is fetched if it isn't cached yet."""
+        size = self._get_size(self.cache_dir / get_cache_key(href))
+        return self.read(href, 0, 0)[1] if size is None else size
+
+    def read(self, href: str, start: int, end: int) -> Tuple[bytes, int]:
+        """Returns the bytes `start` to `end` (inclusive, clipped to the end of the file) of the file at `href` and
+        the size of the file."""
+        directory = self.cache_dir / get_cache_key(href)
+        size = self._get_size(directory)
+        first, last = start // self.block_size, end // self.block_size
+        if size is not None:
+            last = min(last, max(size - 1, 0) // self.block_size)
+        blocks, missing = {}, []
+        for index in range(first, last + 1):
+            data = self._get_block(directory, index)
+            if data is None:
+                missing.append(index)
+            else:
+                blocks[index] = data
+        hit_bytes = sum(map(len, blocks.values()))
+        for run in _iter_runs(missing):
+            data, size = self._fetch(href, run[0] * self.block_size, (run[-1] + 1) * self.block_size - 1)
+            directory.mkdir(parents=True, exist_ok=True)
+            if self._get_size(directory) != size:
+                with atomic_write(directory / SIZE_FILENAME, record=False) as tmp_path:
+                    tmp_path.write_text(str(size))
+            for i, index in enumerate(run):
+                block = data[i * self.block_size : (i + 1) * self.block_size]
+                if block:
+                    self._put_block(directory, index, block)
+                    blocks[index] = block
+        log.debug(f"🧱  read {hit_bytes} of {sum(map(len, blocks.values()))} bytes of {unsign_href(href)} from disk")
+        offset = start - first * self.block_size
+        return b"".join(blocks[index] for index in sorted(blocks))[offset : offset + end - start + 1], size
+
+    def _iter_blocks(self) -> Iterator[os.DirEntry]:
+        for directory in os.scandir(self.cache_dir):
+            if not directory.is_dir():
+                continue
+            for entry in os.scandir(directory.path):
+                if entry.name.endswith(BLOCK_SUFFIX) and not entry.name.startswith(TMP_PREFIX):
+                    yield entry
+
+    def _add_bytes(self, n_bytes: int) -> None:
+        with self._nbytes_lock:
+            if self._nbytes is None:
+                self._nbytes = sum(entry.stat().st_size for entry in self._iter_blocks())
+            self._nbytes += n_bytes
+            exceeded = self._nbytes > self.max_bytes
+        if exceeded:
+            self.evict()
+
+    def evict(self) -> int:
+        """Deletes the least recently read blocks, until the cache is below 90% of `max_bytes`. Processes sharing the
+        cache directory evict one after the other. Returns the number of deleted blocks."""
+        with file_lock(self.cache_dir / EVICTION_LOCK_NAME):
+            blocks = sorted((entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in self._iter_blocks())
+            nbytes, deleted = sum(size for _, size, _ in blocks), 0
+            for _, size, path in blocks:
+                if nbytes <= 0.9 * self.max_bytes:
+                    break
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                nbytes -= size
+                deleted += 1
+            with self._nbytes_lock:
+                self._nbytes = nbytes
+        log.info(f"🧹  evicted {deleted} blocks from the block cache, {nbytes / 1024**2:.0f} MB left")
+        return deleted
+
+
+def _encode_href(href: str) -> str:
+    return urlsafe_b64encode(href.encode()).decode().rstrip("=")
+
+
+def _decode_href(token: str) -> str:
+    return urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode()
+
+
+def _sign(token: str, key: bytes) -> str:
+    return hmac.new(key, token.encode(), "sha256").hexdigest()
+
+
+def _make_handler(cache: BlockCache, key: bytes):
+    class _BlockCacheRequestHandler(BaseHTTPRequestHandler):
+        # connections are kept alive, GDAL reuses them for the range requests of a file
+        protocol_version = "HTTP/1.1"
+
+        def do_HEAD(self) -> None:
+            self._serve(send_body=False)
+
+        def do_GET(self) -> None:
+            self._serve(send_body=True)
+
+        def _serve(self, send_body: bool) -> None:
+            # only hrefs signed by the process which started the proxy are fetched, see `get_cached_href`
+            token, signature, *_ = self.path.lstrip("/").split("/") + ["", ""]
+            if not hmac.compare_digest(signature, _sign(token, key)):
+                self.send_error(HTTPStatus.FORBIDDEN)
+                return
+            try:
+                href = _decode_href(token)
+            except ValueError:
+                self.send_error(HTTPStatus.NOT_FOUND)
+                return
+            try:
+                size = cache.get_size(href)
+                start, end = 0, size - 1
+                status = HTTPStatus.OK
+                range_header = self.headers.get("Range")
+                if range_header:
+                    byte_range = _parse_range(range_header, size)
+                    if byte_range is None:
+                        self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                        self.send_header("Content-Range", f"bytes */{size}")
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                        return
+                    start, end = byte_range
+                    status = HTTPStatus.PARTIAL_CONTENT
+                data = cache.read(href, start, end)[0] if send_body else b""
+            except Exception as e:
+                log.warning(f"⚠️  block cache read of {unsign_href(href)} failed: {e!r}")
+                self.send_error(HTTPStatus.BAD_GATEWAY)
+                return
+
+            self.send_response(status)
+            self.send_header("Content-Type", "image/tiff")
+            self.send_header("Content-Length", str(end - start + 1))
+            self.send_header("Accept-Ranges", "bytes")
+            if status == HTTPStatus.PARTIAL_CONTENT:
+                self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+            self.end_headers()
+            if send_body:
+                self.wfile.write(data)
+
+        def log_message(self, format: str, *args) -> None:
+            log.debug(f"🧱  {format % args}")
+
+    return _BlockCacheRequestHandler
+
+
+def start_block_cache_server() -> Tuple[int, bytes]:
+    """Starts the local proxy serving http range requests from the block cache, if it is not running yet, and
+    returns its port on the loopback interface and the key the hrefs it serves are signed with. GDAL holds the GIL
+    while opening remote files, hence the proxy runs in a separate process, which exits together with this one."""
+    global _server
+    cache_dir = TMPDIR() / conf.BLOCK_CACHE_DIRNAME
+    with _server_lock:
+        if _server is not None and (_server[1] != cache_dir or _server[0].poll() is not None):
+            _stop_server()
+        if _server is None:
+            process = subprocess.Popen(
+                [
+                    sys.executable,
+                    "-c",
+                    f"from {__name__} import main; main()",
+                    str(cache_dir),
+                    str(conf.BLOCK_CACHE_MAX_BYTES),
+                    str(conf.BLOCK_CACHE_BLOCK_SIZE),
+                ],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                text=True,
+                env={**os.environ, "PYTHONPATH": os.pathsep.join([str(Path(__file__).parent.parent), *sys.path])},
+            )
+            # the key is passed on stdin, so that it doesn't show up in the process list
+            key = secrets.token_bytes(32)
+            process.stdin.write(f"{key.hex()}\n")
+            process.stdin.flush()
+            port = process.stdout.readline().strip()
+            if not port:
+                raise RuntimeError(f"block cache proxy exited with {process.wait()}")
+            _server = (process, cache_dir, int(port), key)
+            log.info(f"🧱  started block cache proxy on port {port}, caching in {cache_dir}")
+        return _server[2], _server[3]
+
+
+def _stop_server() -> None:
+    global _server
+    process = _server[0]
+    # the proxy exits once its stdin is closed
+    process.stdin.close()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+    _server = None
+
+
+def stop_block_cache_server() -> None:
+    with _server_lock:
+        if _server is not None:
+            _stop_server()
+
+
+def get_cached_href(href: str) -> str:
+    """Returns the url under which the block cache proxy serves the file at `href`, signed with the key of the proxy,
+    which rejects the urls of any other hrefs. Hrefs other than http(s) ones are returned as they are."""
+    if urlparse(href).scheme not in ("http", "https"):
+        return href
+    port, key = start_block_cache_server()
+    token = _encode_href(href)
+    # the file name is kept, GDAL only reads urls with one of `CPL_VSIL_CURL_ALLOWED_EXTENSIONS`
+    return f"http://127.0.0.1:{port}/{token}/{_sign(token, key)}/{Path(urlparse(href).path).name}"
+
+
+def with_block_cache(patch_url: Union[None, Callable[[str], str]] = None) -> Callable[[str], str]:
+    """Wraps the `patch_url` of `odc.stac.stac_load`, so that the patched hrefs are read through the block cache."""
+
+    def _patch_url(href: str) -> str:
+        return get_cached_href(href if patch_url is None else patch_url(href))
+
+    return _patch_url
+
+
+def main() -> None:
+    """Runs the block cache proxy, see `start_block_cache_server`. Reads the signing key from stdin, prints its port
+    and serves until stdin is closed."""
+    cache_dir, max_bytes, block_size = sys.argv[1:4]
+    key = bytes.fromhex(sys.stdin.readline().strip())
+    cache = BlockCache(cache_dir, max_bytes=int(max_bytes), block_size=int(block_size))
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _make_handler(cache, key))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(server.server_address[1], flush=True)
+    sys.stdin.read()
+    server.shutdown()
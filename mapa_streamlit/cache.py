@@ -0,0 +1,171 @@
+import contextlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, Iterator, Tuple, Union
+
+from mapa_streamlit import conf
+
+log = logging.getLogger(__name__)
+
+# temporary files of writes in progress, never served, recorded or cleaned up
+TMP_PREFIX = ".mapa-tmp-"
+LOCK_SUFFIX = ".lock"
+
+# flock locks exclude other processes, but on network file systems they may be emulated with per process locks, hence
+# the threads of one process are excluded with a thread lock per path in addition
+_thread_locks: Dict[str, threading.Lock] = {}
+_thread_locks_lock = threading.Lock()
+
+
+def _get_writer() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _get_thread_lock(path: Path) -> threading.Lock:
+    with _thread_locks_lock:
+        return _thread_locks.setdefault(str(path), threading.Lock())
+
+
+@contextlib.contextmanager
+def file_lock(path: Union[Path, str], timeout: Union[None, float] = None) -> Iterator[None]:
+    """Holds an exclusive advisory lock on `path`, through the lock file `path`.lock next to it. The lock is shared by
+    all threads, processes and hosts (given a file system with working locks, like NFSv4) using the same cache
+    directory.
+
+    Raises
+    ------
+    TimeoutError
+        If the lock could not be acquired within `timeout` seconds, by default `conf.CACHE_LOCK_TIMEOUT`.
+    """
+    import fcntl
+
+    lock_path = Path(f"{path}{LOCK_SUFFIX}")
+    timeout = conf.CACHE_LOCK_TIMEOUT if timeout is None else timeout
+    deadline = time.monotonic() + timeout
+    thread_lock = _get_thread_lock(lock_path)
+    if not thread_lock.acquire(timeout=timeout):
+        raise TimeoutError(f"could not lock {path} within {timeout} s")
+    try:
+        lock_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(lock_path, "a") as f:
+            while True:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() > deadline:
+                        raise TimeoutError(f"could not lock {path} within {timeout} s") from None
+                    time.sleep(conf.CACHE_LOCK_POLL_INTERVAL)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+    finally:
+        thread_lock.release()
+
+
+@contextlib.contextmanager
+def atomic_write(path: Union[Path, str], record: bool = True) -> Iterator[Path]:
+    """Yields a temporary path in the directory of `path` to write to, which is renamed to `path` once the block
+    exits without an error and removed otherwise. Readers hence either see the complete file or none at all, also on
+    shared file systems. The temporary path keeps the suffix of `path`, so that drivers can be inferred from it. With
+    `record`, the file is added to the `Manifest` of its directory afterwards."""
+    path = Path(path)
+    tmp_path = path.with_name(f"{TMP_PREFIX}{uuid.uuid4().hex}-{path.name}")
+    try:
+        yield tmp_path
+        # the data must be on disk before the rename makes it visible, otherwise a crash can leave a torn file
+        with open(tmp_path, "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+    if record:
+        Manifest(path.parent).add(path)
+
+
+def _format_lines(entries: Dict[str, dict]) -> str:
+    return "".join(json.dumps({"name": name, **entry}) + "\n" for name, entry in entries.items())
+
+
+class Manifest:
+    """Records the files which were completely written into a cache directory, with their size and writer, as lines
+    of an append-only json log within the directory. Other processes and replicas sharing the directory only trust
+    files of the manifest, files of which the size changed in the meantime are considered corrupt. Writers only hold
+    the lock of the manifest to append their lines. The log is compacted when it is read while most of its lines are
+    superseded, see `conf.CACHE_MANIFEST_COMPACT_MIN_LINES`."""
+
+    def __init__(self, cache_dir: Union[Path, str]) -> None:
+        self.path = Path(cache_dir) / conf.CACHE_MANIFEST_FILENAME
+        self._entries: Union[None, Dict[str, dict]] = None
+
+    def _read_lines(self) -> Tuple[Dict[str, dict], int]:
+        entries, n_lines = {}, 0
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    n_lines += 1
+                    try:
+                        entry = json.loads(line)
+                        entries[entry.pop("name")] = entry
+                    except (json.JSONDecodeError, AttributeError, KeyError):
+                        # e.g. a line which is still being appended
+                        log.debug(f"⚠️  skipping invalid line of manifest {self.path}: {line!r}")
+        except FileNotFoundError:
+            pass
+        return entries, n_lines
+
+    def _read(self) -> Dict[str, dict]:
+        entries, n_lines = self._read_lines()
+        if n_lines > max(conf.CACHE_MANIFEST_COMPACT_MIN_LINES, 2 * len(entries)):
+            entries = self.compact()
+        return entries
+
+    def compact(self) -> Dict[str, dict]:
+        """Rewrites the manifest with the latest line of each file which still exists, and returns its entries."""
+        with file_lock(self.path):
+            entries, n_lines = self._read_lines()
+            entries = {name: entry for name, entry in entries.items() if (self.path.parent / name).exists()}
+            with atomic_write(self.path, record=False) as tmp_path:
+                tmp_path.write_text(_format_lines(entries))
+        log.debug(f"🗜  compacted manifest {self.path} from {n_lines} to {len(entries)} lines")
+        return entries
+
+    def add(self, *paths: Union[Path, str]) -> None:
+        entries = {
+            path.name: {"size": path.stat().st_size, "writer": _get_writer(), "created": time.time()}
+            for path in map(Path, paths)
+        }
+        lines = _format_lines(entries).encode()
+        with file_lock(self.path):
+            with open(self.path, "ab+") as f:
+                size = f.seek(0, os.SEEK_END)
+                if size:
+                    f.seek(size - 1)
+                    # the torn line of an interrupted append must not swallow the next one
+                    if f.read(1) != b"\n":
+                        lines = b"\n" + lines
+                f.write(lines)
+                f.flush()
+                os.fsync(f.fileno())
+        if self._entries is not None:
+            self._entries.update(entries)
+
+    def is_valid(self, path: Union[Path, str]) -> bool:
+        """Whether `path` was completely written and wasn't modified since. The manifest is read once per
+        instance."""
+        path = Path(path)
+        if self._entries is None:
+            self._entries = self._read()
+        entry = self._entries.get(path.name)
+        try:
+            return entry is not None and path.stat().st_size == entry["size"]
+        except FileNotFoundError:
+            return False
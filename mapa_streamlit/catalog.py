@@ -0,0 +1,401 @@
+import json
+import logging
+import operator
+import threading
+from datetime import date, datetime, time, timezone
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, Tuple, Union
+
+from mapa_streamlit import conf
+from mapa_streamlit.signing import sign_inplace
+
+if TYPE_CHECKING:
+    import pyarrow as pa
+    from pystac import Collection, Item, ItemCollection
+
+log = logging.getLogger(__name__)
+
+STAC_API = "stac-api"
+STATIC = "static"
+GEOPARQUET = "geoparquet"
+
+# key of the parquet file metadata holding the collections, as written by stac-geoparquet
+GEOPARQUET_METADATA_KEY = b"stac-geoparquet"
+
+QUERY_OPERATORS = {
+    "eq": operator.eq,
+    "neq": operator.ne,
+    "lt": operator.lt,
+    "lte": operator.le,
+    "gt": operator.gt,
+    "gte": operator.ge,
+}
+
+
+class Catalog:
+    """Source of STAC items and collections. Backends either forward the search to a STAC API, or search a local
+    mirror, e.g. of frequently requested regions, without any internet round trips."""
+
+    def search_pages(
+        self,
+        collections: List[str],
+        bbox: List[float],
+        datetime: str,
+        query: Union[None, dict] = None,
+        sortby: Union[None, str, List[dict]] = None,
+        limit: int = conf.STAC_SEARCH_PAGE_SIZE,
+        max_items: Union[None, int] = None,
+        fields: Union[None, dict] = None,
+        intersects: Union[None, dict] = None,
+    ) -> Iterator["ItemCollection"]:
+        """Yields the items matching the search page by page, with the same semantics as a STAC API item search.
+        Either `bbox` or the GeoJSON geometry `intersects` restrict the search spatially."""
+        raise NotImplementedError
+
+    def get_collection(self, collection_id: str) -> "Collection":
+        raise NotImplementedError
+
+
+class StacApiCatalog(Catalog):
+    def __init__(self, url: str) -> None:
+        self.url = url
+
+    def _client(self):
+        import pystac_client
+
+        # planetary computer assets are signed per page, other catalogs are left untouched by `sign_inplace`
+        return pystac_client.Client.open(self.url, modifier=sign_inplace)
+
+    def search_pages(
+        self, collections, bbox, datetime, query=None, sortby=None, limit=conf.STAC_SEARCH_PAGE_SIZE, max_items=None,
+        fields=None, intersects=None,
+    ) -> Iterator["ItemCollection"]:
+        search = self._client().search(
+            collections=collections,
+            bbox=bbox,
+            intersects=intersects,
+            datetime=datetime,
+            query=query,
+            sortby=sortby,
+            limit=limit,
+            max_items=max_items,
+            fields=fields,
+        )
+        return search.pages()
+
+    def get_collection(self, collection_id: str) -> "Collection":
+        return self._client().get_collection(collection_id)
+
+
+def _parse_datetime_range(value: Union[None, str]) -> Tuple[Union[datetime, None], Union[datetime, None]]:
+    """Parses a STAC datetime search parameter, e.g. `2023-01-01/2023-12-31`, into an inclusive utc range. Open ends,
+    given as `..` or empty string, are returned as None. Dates without time cover the whole day."""
+
+    def _parse(part: str, end: bool) -> Union[datetime, None]:
+        part = part.strip()
+        if part in ("", ".."):
+            return None
+        if len(part) == 10:
+            return datetime.combine(date.fromisoformat(part), time.max if end else time.min, tzinfo=timezone.utc)
+        parsed = datetime.fromisoformat(part.replace("Z", "+00:00"))
+        return parsed.replace(tzinfo=timezone.utc) if parsed.tzinfo is None else parsed.astimezone(timezone.utc)
+
+    if not value:
+        return None, None
+    start, _, end = value.partition("/")
+    return _parse(start, end=False), _parse(end if _ else start, end=True)
+
+
+def _intersects(bbox: List[float], other: List[float]) -> bool:
+    west, south, east, north = bbox[0], bbox[1], bbox[-2], bbox[-1]
+    other_west, other_south, other_east, other_north = other[0], other[1], other[-2], other[-1]
+    return west <= other_east and other_west <= east and south <= other_north and other_south <= north
+
+
+def _shape(geometry: dict):
+    from shapely.geometry import shape
+
+    return shape(geometry)
+
+
+def normalize_sortby(sortby: Union[None, str, List[dict]]) -> List[dict]:
+    """Returns `sortby` of a search as a list of {"field", "direction"} mappings, without "properties." prefixes."""
+    if not sortby:
+        return []
+    if isinstance(sortby, str):
+        sortby = [
+            {"field": field.lstrip("+-"), "direction": "desc" if field.startswith("-") else "asc"}
+            for field in sortby.split(",")
+        ]
+    return [{**sort, "field": sort["field"].replace("properties.", "", 1)} for sort in sortby]
+
+
+def _sort_value(item: "Item", field: str):
+    if field == "id":
+        return item.id
+    if field == "datetime":
+        return item.datetime
+    return item.properties.get(field)
+
+
+class LocalCatalog(Catalog):
+    """Base of the local mirror backends. Subclasses return candidate items, which are filtered, sorted and split
+    into pages here, so the search behaves like the one of a STAC API."""
+
+    def _candidates(
+        self, collections: List[str], bbox: List[float], start: Union[datetime, None], end: Union[datetime, None]
+    ) -> Iterable["Item"]:
+        raise NotImplementedError
+
+    @staticmethod
+    def _matches(item: "Item", collections, bbox, start, end, query: dict, intersects=None) -> bool:
+        if collections and item.collection_id not in collections:
+            return False
+        if bbox and item.bbox and not _intersects(bbox, item.bbox):
+            return False
+        if intersects is not None and item.geometry and not intersects.intersects(_shape(item.geometry)):
+            return False
+        item_start = item.datetime or item.common_metadata.start_datetime
+        item_end = item.datetime or item.common_metadata.end_datetime
+        if (start and item_end and item_end < start) or (end and item_start and item_start > end):
+            return False
+        for field, comparisons in (query or {}).items():
+            value = item.properties.get(field)
+            for comparison, bound in comparisons.items():
+                if value is None or not QUERY_OPERATORS[comparison](value, bound):
+                    return False
+        return True
+
+    def search_pages(
+        self, collections, bbox, datetime, query=None, sortby=None, limit=conf.STAC_SEARCH_PAGE_SIZE, max_items=None,
+        fields=None, intersects=None,
+    ) -> Iterator["ItemCollection"]:
+        from pystac import ItemCollection
+
+        # the fields extension only trims the payload of api responses, it is of no use for local catalogs
+        start, end = _parse_datetime_range(datetime)
+        if intersects is not None:
+            # candidates are prefiltered by the bbox of the geometry, which is cheap for all backends
+            intersects = _shape(intersects)
+            bbox = list(intersects.bounds) if bbox is None else bbox
+        items = [
+            item
+            for item in self._candidates(collections, bbox, start, end)
+            if self._matches(item, collections, bbox, start, end, query, intersects)
+        ]
+        # stable sorts, applied from the least to the most significant field
+        for sort in reversed(normalize_sortby(sortby)):
+            present = [item for item in items if _sort_value(item, sort["field"]) is not None]
+            missing = [item for item in items if _sort_value(item, sort["field"]) is None]
+            present.sort(key=lambda item: _sort_value(item, sort["field"]), reverse=sort["direction"] == "desc")
+            items = present + missing
+        if max_items is not None:
+            items = items[:max_items]
+        for offset in range(0, len(items), limit):
+            yield ItemCollection(items[offset : offset + limit])
+
+
+class StaticCatalog(LocalCatalog):
+    """Static STAC catalog on disk, e.g. as written by `pystac.Catalog.save`. The items are read once and kept in
+    memory, a changed mirror is picked up after `reload`."""
+
+    def __init__(self, path: Union[str, Path]) -> None:
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._catalog = None
+        self._items: Dict[str, List["Item"]] = {}
+
+    def _get_catalog(self):
+        from pystac import Catalog as PystacCatalog
+
+        with self._lock:
+            if self._catalog is None:
+                path = self.path / "catalog.json" if self.path.is_dir() else self.path
+                self._catalog = PystacCatalog.from_file(str(path))
+            return self._catalog
+
+    def reload(self) -> None:
+        with self._lock:
+            self._catalog = None
+            self._items.clear()
+
+    def get_collection(self, collection_id: str) -> "Collection":
+        collection = self._get_catalog().get_child(collection_id, recursive=True)
+        if collection is None:
+            raise KeyError(f"collection {collection_id} not found in static catalog {self.path}")
+        return collection
+
+    def _get_items(self, collection_id: str) -> List["Item"]:
+        with self._lock:
+            if collection_id in self._items:
+                return self._items[collection_id]
+        items = []
+        for item in self.get_collection(collection_id).get_items(recursive=True):
+            # assets are usually stored next to the items with relative hrefs
+            item.make_asset_hrefs_absolute()
+            items.append(item)
+        log.info(f"📚  loaded {len(items)} items of {collection_id} from static catalog {self.path}")
+        with self._lock:
+            self._items[collection_id] = items
+        return items
+
+    def _candidates(self, collections, bbox, start, end) -> Iterable["Item"]:
+        for collection_id in collections:
+            yield from self._get_items(collection_id)
+
+
+class GeoParquetCatalog(LocalCatalog):
+    """Items stored in a stac-geoparquet file, one row per item. Collection, datetime and bbox filters are pushed
+    down to the parquet reader, so only the row groups of the requested region and time are read."""
+
+    def __init__(self, path: Union[str, Path]) -> None:
+        self.path = Path(path)
+
+    def get_collection(self, collection_id: str) -> "Collection":
+        import pyarrow.parquet as pq
+        from pystac import Collection
+
+        metadata = pq.read_schema(self.path).metadata or {}
+        collections = json.loads(metadata.get(GEOPARQUET_METADATA_KEY, b"{}")).get("collections", {})
+        if collection_id not in collections:
+            raise KeyError(f"collection {collection_id} not found in the metadata of {self.path}")
+        return Collection.from_dict(collections[collection_id])
+
+    def _candidates(self, collections, bbox, start, end) -> Iterable["Item"]:
+        import pyarrow.dataset as ds
+        import pyarrow.parquet as pq
+
+        schema = pq.read_schema(self.path)
+        expression = ds.field("collection").isin(collections)
+        if bbox and "bbox" in schema.names:
+            expression &= (ds.field("bbox", "xmin") <= bbox[2]) & (ds.field("bbox", "xmax") >= bbox[0])
+            expression &= (ds.field("bbox", "ymin") <= bbox[3]) & (ds.field("bbox", "ymax") >= bbox[1])
+        if "datetime" in schema.names:
+            if start:
+                expression &= ds.field("datetime") >= start
+            if end:
+                expression &= ds.field("datetime") <= end
+        table = ds.dataset(self.path, format="parquet").to_table(filter=expression)
+        return [from_geoparquet_row(row) for row in table.to_pylist()]
+
+
+def _drop_none(value):
+    """Structs of a parquet column have the union of all fields, fields missing in an item are None."""
+    if isinstance(value, dict):
+        return {key: _drop_none(v) for key, v in value.items() if v is not None}
+    if isinstance(value, list):
+        return [_drop_none(v) for v in value]
+    return value
+
+
+def _to_json(value):
+    if isinstance(value, datetime):
+        value = value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value.astimezone(timezone.utc)
+        return value.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    if isinstance(value, dict):
+        return {key: _to_json(v) for key, v in value.items()}
+    if isinstance(value, list):
+        return [_to_json(v) for v in value]
+    return value
+
+
+def from_geoparquet_row(row: dict) -> "Item":
+    """Returns the item of a row of a stac-geoparquet table, see `to_geoparquet_table`."""
+    import shapely
+    from pystac import Item
+
+    row = _drop_none(_to_json(row))
+    geometry = row.pop("geometry", None)
+    # shapely returns the coordinates as tuples, the json round trip turns them into lists as in any other item
+    geometry = json.loads(json.dumps(shapely.geometry.mapping(shapely.from_wkb(geometry)))) if geometry else None
+    bbox = row.pop("bbox", None)
+    if isinstance(bbox, dict):
+        bbox = [bbox["xmin"], bbox["ymin"], bbox["xmax"], bbox["ymax"]]
+    item = {
+        "type": row.pop("type", "Feature"),
+        "stac_version": row.pop("stac_version", "1.0.0"),
+        "stac_extensions": row.pop("stac_extensions", []),
+        "id": row.pop("id"),
+        "collection": row.pop("collection", None),
+        "geometry": geometry,
+        "bbox": bbox,
+        "links": row.pop("links", []),
+        "assets": row.pop("assets", {}),
+        # all remaining columns are the item properties
+        "properties": row,
+    }
+    return Item.from_dict(item, preserve_dict=False)
+
+
+def to_geoparquet_table(items: Iterable[dict]) -> "pa.Table":
+    """Returns the stac-geoparquet table of `items` given as dictionaries: one row per item, with the footprint as
+    wkb, the bbox as struct and one column per property."""
+    import pyarrow as pa
+    import shapely
+
+    rows = []
+    for item in items:
+        item = dict(item)
+        properties = item.pop("properties")
+        geometry = item.pop("geometry")
+        bbox = item.pop("bbox", None)
+        rows.append(
+            {
+                **item,
+                "geometry": shapely.to_wkb(shapely.geometry.shape(geometry)) if geometry else None,
+                "bbox": dict(zip(("xmin", "ymin", "xmax", "ymax"), [bbox[0], bbox[1], bbox[-2], bbox[-1]]))
+                if bbox
+                else None,
+                **{key: _parse_timestamp(key, value) for key, value in properties.items()},
+            }
+        )
+    return pa.Table.from_pylist(rows)
+
+
+def write_geoparquet(items: Iterable["Item"], path: Union[str, Path], collections: Iterable["Collection"] = ()) -> Path:
+    """Writes `items` to a stac-geoparquet file readable by `GeoParquetCatalog`, e.g. to mirror a hot region. The
+    `collections` are stored in the file metadata, for the band metadata lookup."""
+    import pyarrow.parquet as pq
+
+    table = to_geoparquet_table(item.to_dict(include_self_link=False, transform_hrefs=False) for item in items)
+    metadata = {"version": "1.0.0", "collections": {c.id: c.to_dict(include_self_link=False) for c in collections}}
+    table = table.replace_schema_metadata(
+        {**(table.schema.metadata or {}), GEOPARQUET_METADATA_KEY: json.dumps(metadata)}
+    )
+    pq.write_table(table, path)
+    return Path(path)
+
+
+def _parse_timestamp(key: str, value):
+    if key in ("datetime", "start_datetime", "end_datetime", "created", "updated") and isinstance(value, str):
+        return datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return value
+
+
+_catalogs: Dict[Tuple[str, str], Catalog] = {}
+_catalogs_lock = threading.Lock()
+
+
+def get_catalog(backend: str = None, location: str = None) -> Catalog:
+    """Returns the catalog backend selected with `conf.CATALOG_BACKEND`, either a STAC API (`conf.STAC_API_URL`) or a
+    local mirror (`conf.CATALOG_PATH`) given as static catalog or stac-geoparquet file. Instances are shared, so the
+    items of a static catalog are only read once."""
+    backend = backend or conf.CATALOG_BACKEND
+    if backend == STAC_API:
+        location = location or conf.STAC_API_URL
+    else:
+        location = location or conf.CATALOG_PATH
+    if not location:
+        raise ValueError(f"no location configured for catalog backend {backend}, set MAPA_CATALOG_PATH")
+
+    with _catalogs_lock:
+        if (backend, location) not in _catalogs:
+            if backend == STAC_API:
+                _catalogs[(backend, location)] = StacApiCatalog(location)
+            elif backend == STATIC:
+                _catalogs[(backend, location)] = StaticCatalog(location)
+            elif backend == GEOPARQUET:
+                _catalogs[(backend, location)] = GeoParquetCatalog(location)
+            else:
+                raise ValueError(f"unknown catalog backend {backend}, use one of {STAC_API}, {STATIC}, {GEOPARQUET}")
+        return _catalogs[(backend, location)]
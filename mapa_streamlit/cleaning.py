@@ -5,6 +5,8 @@ from typing import Union
 
 import psutil
 
+from mapa_streamlit.cache import TMP_PREFIX
+
 log = logging.getLogger(__name__)
 
 
@@ -49,6 +51,9 @@ def _get_data_size_of_dir(path: Path) -> float:
 
 def _delete_files_in_dir(path: Path, file_suffix: str, name_prefix: Union[None, str] = None) -> None:
     for file in path.iterdir():
+        # files which are still being written, possibly by another process sharing the directory
+        if file.name.startswith(TMP_PREFIX):
+            continue
         if file.suffix == file_suffix:
             if name_prefix:  # if name prefix is specified, only delete file if name matches
                 if file.name.startswith(name_prefix):
@@ -0,0 +1,352 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Dict, Iterator, List, Sequence, Union
+
+from mapa_streamlit import convert_bbox_to_tif
+from mapa_streamlit.caching import get_hash_of_geojson
+from mapa_streamlit.geometry import SUPPORTED_GEOMETRY_TYPES
+from mapa_streamlit.planning import fetch_stac_items_for_aois, plan_aoi_groups
+from mapa_streamlit.utils import TMPDIR
+from mapa_streamlit.zip import create_zip_archive
+
+log = logging.getLogger(__name__)
+
+MANIFEST_FILE = "manifest.jsonl"
+DONE = "done"
+EMPTY = "empty"
+FAILED = "failed"
+
+
+@dataclass
+class BatchParameters:
+    collection: str = "sentinel-2-l2a"
+    bands: List[str] = field(default_factory=lambda: ["B04", "B03", "B02"])
+    date_range: str = ""
+    cloud_cover: int = 20
+    max_items: Union[None, int] = None
+    compress: bool = True
+
+    def get_hash(self) -> str:
+        return get_hash_of_geojson(asdict(self))
+
+
+@dataclass
+class AOI:
+    id: str
+    geometry: dict
+
+
+@dataclass
+class AOIResult:
+    aoi: str
+    status: str
+    seconds: float
+    params: str
+    outputs: List[str] = field(default_factory=list)
+    error: Union[None, str] = None
+
+
+def _safe_id(value) -> str:
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", str(value)).strip("._") or "aoi"
+
+
+def read_aois(path: Union[str, Path], id_property: Union[None, str] = None) -> List[AOI]:
+    """Reads the AOIs of a GeoJSON FeatureCollection. The id of an AOI is taken from the `id_property` of the feature
+    properties, the feature id or, if neither is set, the position of the feature in the collection."""
+    with open(path) as f:
+        collection = json.load(f)
+    if collection.get("type") != "FeatureCollection":
+        raise ValueError(f"⛔️  ERROR: {path} is not a GeoJSON FeatureCollection")
+
+    aois = []
+    for i, feature in enumerate(collection["features"]):
+        properties = feature.get("properties") or {}
+        aoi_id = properties.get(id_property) if id_property else None
+        aoi_id = _safe_id(aoi_id if aoi_id is not None else feature.get("id", i))
+        geometry_type = (feature.get("geometry") or {}).get("type")
+        if geometry_type not in SUPPORTED_GEOMETRY_TYPES:
+            raise ValueError(
+                f"⛔️  ERROR: AOI {aoi_id} is a {geometry_type}, only {', '.join(SUPPORTED_GEOMETRY_TYPES)} are supported"
+            )
+        aois.append(AOI(id=aoi_id, geometry=feature["geometry"]))
+
+    duplicates = {aoi.id for aoi in aois if sum(other.id == aoi.id for other in aois) > 1}
+    if duplicates:
+        raise ValueError(f"⛔️  ERROR: AOI ids must be unique, found duplicates: {sorted(duplicates)}")
+    return aois
+
+
+def read_manifest(path: Path) -> Dict[str, AOIResult]:
+    """Returns the latest result of each AOI recorded in the manifest. Truncated lines, e.g. of an interrupted run,
+    are ignored."""
+    results = {}
+    if not path.is_file():
+        return results
+    with open(path) as f:
+        for line in f:
+            try:
+                result = AOIResult(**json.loads(line))
+            except (json.JSONDecodeError, TypeError):
+                log.warning(f"⚠️  skipping invalid manifest line: {line!r}")
+                continue
+            results[result.aoi] = result
+    return results
+
+
+def _append_to_manifest(path: Path, result: AOIResult) -> None:
+    with open(path, "a") as f:
+        f.write(json.dumps(asdict(result)) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _run_aoi(aoi: AOI, params: BatchParameters, output_dir: Path, cache_dir: Path) -> AOIResult:
+    start = time.perf_counter()
+    status, outputs, error = DONE, [], None
+    try:
+        # each AOI gets its own tif directory, as the tif names only depend on the collection and the date
+        result = convert_bbox_to_tif(
+            user_defined_collection=params.collection,
+            user_defined_bands=params.bands,
+            bbox_geometry=aoi.geometry,
+            date_range=params.date_range,
+            cloud_cover_percentage_value=params.cloud_cover,
+            output_file=str(output_dir / aoi.id),
+            compress=params.compress,
+            cache_dir=_get_tif_dir(aoi, params, output_dir, cache_dir),
+            max_items=params.max_items,
+        )
+        if result is None:
+            status = EMPTY
+        else:
+            outputs = [str(p) for p in (result if isinstance(result, list) else [result])]
+    except Exception as e:
+        log.exception(f"❌  processing aoi {aoi.id} failed")
+        status, error = FAILED, repr(e)
+    return AOIResult(
+        aoi=aoi.id,
+        status=status,
+        seconds=round(time.perf_counter() - start, 3),
+        params=params.get_hash(),
+        outputs=outputs,
+        error=error,
+    )
+
+
+def _get_tif_dir(aoi: AOI, params: BatchParameters, output_dir: Path, cache_dir: Path) -> Path:
+    # uncompressed results are the tifs themselves, hence they are written to the output directory
+    tif_dir = (output_dir if not params.compress else cache_dir) / aoi.id
+    tif_dir.mkdir(parents=True, exist_ok=True)
+    return tif_dir
+
+
+def run_batch(
+    aois: Sequence[AOI],
+    params: BatchParameters,
+    output_dir: Union[str, Path],
+    workers: int = 1,
+    manifest: Union[None, str, Path] = None,
+    cache_dir: Union[None, str, Path] = None,
+    retry_failed: bool = True,
+    merge_overlapping: bool = False,
+) -> List[AOIResult]:
+    """Runs the fetch / write / zip pipeline for all `aois` with a pool of `workers` processes. Each finished AOI is
+    appended to the manifest right away, AOIs which are already recorded as done with the same parameters are
+    skipped, so an interrupted run continues where it stopped.
+
+    Parameters
+    ----------
+    workers : int, optional
+        Number of worker processes. With 1 worker, all AOIs are processed one after the other in this process.
+    manifest : Union[None, str, Path], optional
+        Path to the manifest, by default `manifest.jsonl` in the output directory.
+    retry_failed : bool, optional
+        Whether AOIs which failed in a previous run should be processed again. By default True
+    merge_overlapping : bool, optional
+        Whether overlapping AOIs should be searched and loaded together, reading shared pixels only once. Their tifs
+        are clipped from the grid of the merged load, whose pixels are held in memory until all of its AOIs are
+        written. AOIs are never merged with `params.max_items`, which applies per AOI. By default False
+
+    Returns
+    -------
+    List[AOIResult]
+        Results of the AOIs processed in this run.
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    cache_dir = Path(cache_dir) if cache_dir else TMPDIR() / "batch"
+    manifest = Path(manifest) if manifest else output_dir / MANIFEST_FILE
+
+    params_hash = params.get_hash()
+    finished = {DONE, EMPTY} if retry_failed else {DONE, EMPTY, FAILED}
+    previous = read_manifest(manifest)
+
+    def _is_finished(aoi: AOI) -> bool:
+        # results computed with other parameters are outdated
+        result = previous.get(aoi.id)
+        return result is not None and result.status in finished and result.params == params_hash
+
+    pending = [aoi for aoi in aois if not _is_finished(aoi)]
+    log.info(f"🗺  processing {len(pending)} of {len(aois)} AOIs, {len(aois) - len(pending)} already finished")
+
+    if merge_overlapping and params.max_items:
+        # the least cloudy scenes of a merged search would be those of the union instead of each aoi
+        log.info("🧩  not merging overlapping aois, max_items applies to each aoi on its own")
+        merge_overlapping = False
+    if merge_overlapping:
+        groups = [[pending[i] for i in group] for group in plan_aoi_groups([aoi.geometry for aoi in pending])]
+    else:
+        groups = [[aoi] for aoi in pending]
+
+    results = []
+    for i, result in enumerate(_iter_results(groups, params, output_dir, cache_dir, workers), start=1):
+        _append_to_manifest(manifest, result)
+        results.append(result)
+        icon = {DONE: "✅", EMPTY: "🫙", FAILED: "❌"}[result.status]
+        log.info(f"{icon}  [{i}/{len(pending)}] aoi {result.aoi} {result.status} in {result.seconds:.1f} s")
+    return results
+
+
+def _run_group(aois: List[AOI], params: BatchParameters, output_dir: Path, cache_dir: Path) -> List[AOIResult]:
+    """Processes a group of overlapping AOIs with a single search and load, see `fetch_stac_items_for_aois`."""
+    if len(aois) == 1:
+        return [_run_aoi(aois[0], params, output_dir, cache_dir)]
+
+    start = time.perf_counter()
+    try:
+        fetched = fetch_stac_items_for_aois(
+            {aoi.id: aoi.geometry for aoi in aois},
+            params.bands,
+            params.collection,
+            {aoi.id: _get_tif_dir(aoi, params, output_dir, cache_dir) for aoi in aois},
+            params.date_range,
+            params.cloud_cover,
+            max_items=params.max_items,
+        )
+    except Exception as e:
+        log.exception(f"❌  processing aois {[aoi.id for aoi in aois]} failed")
+        seconds = round((time.perf_counter() - start) / len(aois), 3)
+        return [AOIResult(aoi.id, FAILED, seconds, params.get_hash(), error=repr(e)) for aoi in aois]
+
+    results = []
+    for aoi in aois:
+        if aoi.id not in fetched:
+            results.append(AOIResult(aoi.id, EMPTY, 0.0, params.get_hash()))
+            continue
+        start = time.perf_counter()
+        outputs = fetched[aoi.id].paths
+        if params.compress:
+            outputs = [create_zip_archive(files=outputs, output_file=output_dir / f"{aoi.id}.zip")]
+        seconds = round(fetched[aoi.id].seconds + time.perf_counter() - start, 3)
+        results.append(AOIResult(aoi.id, DONE, seconds, params.get_hash(), outputs=[str(p) for p in outputs]))
+    return results
+
+
+def _iter_results(
+    groups: Sequence[List[AOI]], params: BatchParameters, output_dir: Path, cache_dir: Path, workers: int
+) -> Iterator[AOIResult]:
+    if workers <= 1:
+        for group in groups:
+            yield from _run_group(group, params, output_dir, cache_dir)
+        return
+
+    # GDAL and the thread pools of the readers don't survive a fork, hence fresh worker processes are spawned
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        futures = [pool.submit(_run_group, group, params, output_dir, cache_dir) for group in groups]
+        try:
+            for future in as_completed(futures):
+                yield from future.result()
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+
+def format_summary(results: Sequence[AOIResult]) -> str:
+    """Returns a table of the per AOI timings, slowest first, followed by the totals per status."""
+    lines = [f"{'aoi':<40} {'status':<8} {'seconds':>10}"]
+    for result in sorted(results, key=lambda r: r.seconds, reverse=True):
+        lines.append(f"{result.aoi:<40} {result.status:<8} {result.seconds:>10.1f}")
+    statuses = {status: [r for r in results if r.status == status] for status in (DONE, EMPTY, FAILED)}
+    lines.append(
+        ", ".join(f"{len(r)} {status}" for status, r in statuses.items())
+        + f", {sum(r.seconds for r in results):.1f} s in total"
+    )
+    return "\n".join(lines)
+
+
+def _load_params(args: argparse.Namespace) -> BatchParameters:
+    values = {}
+    if args.params:
+        with open(args.params) as f:
+            values.update(json.load(f))
+    # explicitly given arguments override the parameter file
+    for key in ("collection", "bands", "date_range", "cloud_cover", "max_items", "compress"):
+        if getattr(args, key) is not None:
+            values[key] = getattr(args, key)
+    params = BatchParameters(**values)
+    if not params.date_range:
+        raise ValueError("⛔️  ERROR: a date range is required, pass --date-range or set it in the parameter file")
+    return params
+
+
+def parse_args(argv: Union[None, Sequence[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="mapa-batch",
+        description="Fetches STAC scenes for all AOIs of a GeoJSON FeatureCollection and writes them as GeoTIFFs.",
+    )
+    parser.add_argument("aois", type=Path, help="GeoJSON FeatureCollection with one feature per AOI")
+    parser.add_argument("-o", "--output-dir", type=Path, default=Path("output"), help="directory of the results")
+    parser.add_argument("--params", type=Path, help="json file with the parameters, overridden by the options below")
+    parser.add_argument("--collection", help="STAC collection, e.g. sentinel-2-l2a or landsat-c2-l2")
+    parser.add_argument("--bands", nargs="+", help="bands to fetch, e.g. B04 B03 B02")
+    parser.add_argument("--date-range", help="date range of the scenes, e.g. 2023-06-01/2023-07-31")
+    parser.add_argument("--cloud-cover", type=int, help="maximum cloud cover in percent")
+    parser.add_argument("--max-items", type=int, help="only fetch the N least cloudy scenes per AOI")
+    parser.add_argument(
+        "--no-compress", dest="compress", action="store_const", const=False, help="write tifs instead of zip archives"
+    )
+    parser.add_argument("-j", "--workers", type=int, default=1, help="number of worker processes, by default 1")
+    parser.add_argument("--manifest", type=Path, help=f"manifest path, by default {MANIFEST_FILE} in the output dir")
+    parser.add_argument("--cache-dir", type=Path, help="directory of the intermediate tifs of compressed results")
+    parser.add_argument("--id-property", help="feature property holding the AOI id, by default the feature id")
+    parser.add_argument("--no-retry-failed", dest="retry_failed", action="store_false", help="skip failed AOIs")
+    parser.add_argument(
+        "--merge-overlapping",
+        action="store_true",
+        help="search and load overlapping AOIs once, clipping each of them. The pixels of each merged load are held "
+        "in memory, ignored with --max-items",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv: Union[None, Sequence[str]] = None) -> int:
+    args = parse_args(argv)
+    params = _load_params(args)
+    aois = read_aois(args.aois, id_property=args.id_property)
+    results = run_batch(
+        aois,
+        params,
+        args.output_dir,
+        workers=args.workers,
+        manifest=args.manifest,
+        cache_dir=args.cache_dir,
+        retry_failed=args.retry_failed,
+        merge_overlapping=args.merge_overlapping,
+    )
+    print(format_summary(results))
+    return 1 if any(result.status == FAILED for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
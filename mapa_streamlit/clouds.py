@@ -0,0 +1,51 @@
+import logging
+from typing import TYPE_CHECKING, Union
+
+if TYPE_CHECKING:
+    import xarray as xr
+
+log = logging.getLogger(__name__)
+
+# band flagging clouds, cloud shadows and missing data per pixel, by collection
+MASK_BANDS = {"sentinel-2-l2a": "SCL", "landsat-c2-l2": "qa_pixel"}
+# sentinel-2 scene classes without a clear observation: no data, saturated or defective, cloud shadow, medium and high
+# probability clouds and thin cirrus
+SCL_INVALID_CLASSES = (0, 1, 3, 8, 9, 10)
+# landsat qa_pixel bits without a clear observation: fill, dilated cloud, cirrus, cloud and cloud shadow
+QA_PIXEL_INVALID_BITS = (0, 1, 2, 3, 4)
+QA_PIXEL_FILL_BIT = 0
+
+
+def get_clear_mask(xarray: "xr.Dataset", collection: str) -> Union["xr.DataArray", None]:
+    """Returns a lazy boolean mask of the pixels with a clear observation, None if the collection has no mask band or
+    it was not loaded."""
+    band = MASK_BANDS.get(collection)
+    if band is None or band not in xarray:
+        return None
+    if band == "SCL":
+        return ~xarray[band].isin(SCL_INVALID_CLASSES)
+    invalid_bits = sum(1 << bit for bit in QA_PIXEL_INVALID_BITS)
+    return (xarray[band].astype("uint16") & invalid_bits) == 0
+
+
+def get_observed_mask(xarray: "xr.Dataset", collection: str) -> Union["xr.DataArray", None]:
+    """Returns a lazy boolean mask of the pixels a scene observed at all, cloudy or not, i.e. which are neither
+    outside of its footprint nor fill values. None if the collection has no mask band or it was not loaded."""
+    band = MASK_BANDS.get(collection)
+    if band is None or band not in xarray:
+        return None
+    observed = xarray[band] != 0
+    if band == "qa_pixel":
+        observed &= (xarray[band].astype("uint16") & (1 << QA_PIXEL_FILL_BIT)) == 0
+    return observed
+
+
+def get_clear_fractions(xarray: "xr.Dataset", collection: str) -> Union["xr.DataArray", None]:
+    """Returns the fraction of clear pixels among the observed pixels per scene, 0 for scenes which didn't observe any
+    pixel. None if the collection has no mask band or it was not loaded."""
+    clear, observed = get_clear_mask(xarray, collection), get_observed_mask(xarray, collection)
+    if clear is None:
+        return None
+    spatial_dims = [dim for dim in observed.dims if dim != "time"]
+    n_observed = observed.sum(spatial_dims)
+    return ((clear & observed).sum(spatial_dims) / n_observed.where(n_observed > 0)).fillna(0)
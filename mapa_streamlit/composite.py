@@ -0,0 +1,207 @@
+import logging
+from pathlib import Path
+from typing import TYPE_CHECKING, Union
+
+from mapa_streamlit import conf
+from mapa_streamlit.cache import atomic_write
+from mapa_streamlit.clouds import get_clear_mask
+from mapa_streamlit.io import remote_io_env
+from mapa_streamlit.metrics import request_context, span
+from mapa_streamlit.reads import HedgedReader, ReadStats, get_reader
+from mapa_streamlit.stac import load_stac_items_for_bbox
+from mapa_streamlit.utils import ProgressBar
+
+if TYPE_CHECKING:
+    import numpy as np
+    import xarray as xr
+
+log = logging.getLogger(__name__)
+
+COMPOSITE_METHODS = ("median", "mean", "percentile", "min-cloud")
+
+
+def _first_valid(values: "np.ndarray") -> "np.ndarray":
+    import numpy as np
+
+    # time is the last axis, scenes are already ordered from least to most cloudy
+    index = np.argmax(~np.isnan(values), axis=-1)
+    return np.take_along_axis(values, index[..., None], axis=-1)[..., 0]
+
+
+def composite(
+    xarray: "xr.Dataset",
+    bands: list,
+    collection: str,
+    method: str = "median",
+    percentile: float = 50,
+    cloud_mask: bool = True,
+) -> "xr.DataArray":
+    """Lazily reduces the scenes of `xarray` over time into one composite of shape (band, y, x). Nodata and, with
+    `cloud_mask`, clouded pixels are left out of the reduction. Pixels without any valid observation end up as 0.
+
+    Parameters
+    ----------
+    method : str, optional
+        One of `COMPOSITE_METHODS`. "min-cloud" takes each pixel from the clearest scene in which it is valid.
+        By default "median"
+    percentile : float, optional
+        Percentile in [0, 100] of the "percentile" method. By default 50
+
+    Returns
+    -------
+    xr.DataArray
+        Dask backed float32 composite, chunked spatially with `conf.COMPOSITE_CHUNK_SIZE`.
+    """
+    import numpy as np
+    import xarray as xr
+
+    if method not in COMPOSITE_METHODS:
+        raise ValueError(f"unknown composite method {method}, expected one of {COMPOSITE_METHODS}")
+
+    data = xarray[bands].to_array("band").astype("float32")
+    data = data.where(data != 0)
+    clear = get_clear_mask(xarray, collection) if cloud_mask else None
+    if clear is not None:
+        data = data.where(clear)
+
+    chunks = {"band": 1, "y": conf.COMPOSITE_CHUNK_SIZE, "x": conf.COMPOSITE_CHUNK_SIZE}
+    if method == "mean":
+        # sum and count are accumulated chunk by chunk, the scenes don't need to be in one chunk
+        result = data.chunk(chunks).mean("time", skipna=True)
+    else:
+        # order statistics need all scenes of a pixel at once, memory is bounded by the spatial chunk size instead
+        data = data.chunk({**chunks, "time": -1})
+        if method == "median":
+            result = data.median("time", skipna=True)
+        elif method == "percentile":
+            result = data.quantile(percentile / 100, dim="time", skipna=True).drop_vars("quantile")
+        else:
+            valid = clear if clear is not None else data.isel(band=0).notnull()
+            with span("rank_scenes", scenes=xarray.sizes["time"]):
+                clear_fraction = valid.mean(["y", "x"]).values
+            data = data.isel(time=np.argsort(-clear_fraction, kind="stable"))
+            result = xr.apply_ufunc(
+                _first_valid, data, input_core_dims=[["time"]], dask="parallelized", output_dtypes=[data.dtype]
+            )
+    return result.fillna(0).astype("float32").transpose("band", "y", "x")
+
+
+def save_composite(
+    result: "xr.DataArray",
+    path: Path,
+    geobox,
+    progress_bar: Union[None, ProgressBar] = None,
+    reader: HedgedReader = None,
+    **tags,
+) -> Path:
+    """Writes `result` block by block into a tiled and compressed GeoTIFF, only one spatial block is computed and held
+    in memory at a time. Each block is computed through the `reads.HedgedReader`, so that failing or slow reads are
+    retried or hedged. Blocks which still fail after all retries are written as nodata (0) and counted in the read
+    tags of the GeoTIFF, unless `conf.READ_FAIL_ON_ERROR` is enabled."""
+    import itertools
+
+    import numpy as np
+    import rasterio as rio
+    from rasterio.windows import Window
+
+    size = conf.COMPOSITE_CHUNK_SIZE
+    data = result.data.rechunk((-1, size, size))
+    meta = {
+        "driver": "GTiff",
+        "transform": geobox.affine,
+        "crs": str(geobox.crs),
+        "width": result.sizes["x"],
+        "height": result.sizes["y"],
+        "count": result.sizes["band"],
+        "dtype": "float32",
+        "nodata": 0,
+        "tiled": True,
+        "blockxsize": size,
+        "blockysize": size,
+        "compress": "deflate",
+        "predictor": 3,
+    }
+    if progress_bar:
+        progress_bar.add_work(data.nbytes)
+
+    reader = get_reader() if reader is None else reader
+    stats = ReadStats()
+    with span("geotiff_write", file=path.name) as s, atomic_write(path) as tmp_path:
+        with rio.open(tmp_path, "w", **meta) as dst:
+            dst.update_tags(**{key: str(value) for key, value in tags.items()})
+            for j, band in enumerate(result.band.values):
+                dst.set_band_description(j + 1, str(band))
+            y_offsets = np.cumsum((0,) + data.chunks[1])
+            x_offsets = np.cumsum((0,) + data.chunks[2])
+            for iy, ix in itertools.product(range(len(data.chunks[1])), range(len(data.chunks[2]))):
+                block = data.blocks[:, iy, ix]
+                try:
+                    values = reader.read(block.compute, stats, nbytes=block.nbytes)
+                except Exception as e:
+                    if conf.READ_FAIL_ON_ERROR:
+                        raise
+                    log.error(f"⚠️  composite block ({iy}, {ix}) failed after retries, filling with nodata: {e!r}")
+                    values = np.zeros(block.shape, dtype=block.dtype)
+                window = Window(x_offsets[ix], y_offsets[iy], block.shape[2], block.shape[1])
+                dst.write(values, window=window)
+                s.add_bytes(block.nbytes)
+                if progress_bar:
+                    progress_bar.step(block.nbytes)
+            dst.update_tags(**stats.as_tags())
+    return path
+
+
+@request_context()
+def composite_stac_items_for_bbox(
+    user_defined_bands: list,
+    user_defined_collection: str,
+    geojson: dict,
+    cache_dir: Path,
+    date_range: str,
+    cloud_cover_percentage_value: int,
+    method: str = "median",
+    percentile: float = 50,
+    cloud_mask: bool = True,
+    progress_bar: Union[None, ProgressBar] = None,
+    max_items: Union[None, int] = None,
+    min_clear_fraction: Union[None, float] = None,
+) -> Path:
+    """Computes a temporal composite of all STAC items found for `geojson` and writes it as a single GeoTIFF to
+    `cache_dir`. The scenes are read chunk by chunk while reducing, so only a single spatial chunk of the whole time
+    series is held in memory at once, see `conf.COMPOSITE_CHUNK_SIZE`.
+
+    Returns
+    -------
+    Path
+        Path to the composite GeoTIFF.
+    """
+    import pandas as pd
+
+    size = conf.COMPOSITE_CHUNK_SIZE
+    with remote_io_env():
+        items, xx = load_stac_items_for_bbox(
+            user_defined_collection,
+            geojson,
+            date_range,
+            cloud_cover_percentage_value,
+            max_items=max_items,
+            chunks={"x": size, "y": size},
+            min_clear_fraction=min_clear_fraction,
+        )
+        log.info(f"🧮  computing {method} composite of {xx.sizes['time']} scenes from {len(items)} stac items...")
+        result = composite(xx, user_defined_bands, user_defined_collection, method, percentile, cloud_mask)
+
+        days = pd.to_datetime(xx.time.values).strftime("%Y-%m-%d")
+        name = method if method != "percentile" else f"p{percentile:g}"
+        path = Path(cache_dir) / f"{user_defined_collection}_{name}_{days[0]}_{days[-1]}.tif"
+        return save_composite(
+            result,
+            path,
+            xx.odc.geobox,
+            progress_bar=progress_bar,
+            composite=name,
+            scenes=xx.sizes["time"],
+            start=days[0],
+            end=days[-1],
+            cloud_mask=cloud_mask and get_clear_mask(xx, user_defined_collection) is not None,
+        )
@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 
 SUPPORTED_INPUT_FORMAT = {".tiff", ".tif"}
@@ -14,5 +15,149 @@ DEMO_TIFF_PATH = Path(__file__).parent.parent / "tests" / "tiff" / "hawaii.tiff"
 
 # stac catalogue
 PLANETARY_COMPUTER_API_URL = "https://planetarycomputer.microsoft.com/api/stac/v1"
+# any STAC API can be used instead, e.g. a local stand-in for offline benchmarks
+STAC_API_URL = os.getenv("MAPA_STAC_API_URL", PLANETARY_COMPUTER_API_URL)
+# catalog backend used for searching items and collections: "stac-api" (STAC_API_URL) or a local mirror of hot
+# regions, either a static STAC catalog ("static") or a stac-geoparquet file ("geoparquet") at CATALOG_PATH. Assets of
+# a mirror can live on local disk or in a local object store, GDAL picks up the usual AWS_* variables for s3:// hrefs
+CATALOG_BACKEND = os.getenv("MAPA_CATALOG_BACKEND", "stac-api")
+CATALOG_PATH = os.getenv("MAPA_CATALOG_PATH", "")
 
 
+# root directory of the cache, by default "mapa" within the temp directory. Point it to a shared file system, e.g. an
+# NFS mount, so that replicas serve each other's fetches instead of downloading the same scenes again. Files are
+# written atomically and recorded in an append-only manifest per directory, concurrent fetches of the same scenes wait
+# for each other on advisory locks, for at most CACHE_LOCK_TIMEOUT seconds. Manifests of more than
+# CACHE_MANIFEST_COMPACT_MIN_LINES lines are compacted once more than half of their lines are superseded
+CACHE_ROOT = os.getenv("MAPA_CACHE_ROOT", "")
+CACHE_MANIFEST_FILENAME = "mapa_manifest.jsonl"
+CACHE_MANIFEST_COMPACT_MIN_LINES = 1000
+CACHE_LOCK_TIMEOUT = float(os.getenv("MAPA_CACHE_LOCK_TIMEOUT", "1800"))
+CACHE_LOCK_POLL_INTERVAL = 0.1
+
+# local download server, streams result archives and gifs in chunks with http range support
+DOWNLOAD_SERVER_HOST = os.getenv("MAPA_DOWNLOAD_SERVER_HOST", "127.0.0.1")
+DOWNLOAD_SERVER_PORT = int(os.getenv("MAPA_DOWNLOAD_SERVER_PORT", "8502"))
+# url under which the download server is reachable from the browser, e.g. when running behind a reverse proxy. Without
+# it, only browsers on the same machine get links to the download server, the others download through streamlit
+DOWNLOAD_SERVER_PUBLIC_URL = os.getenv("MAPA_DOWNLOAD_SERVER_PUBLIC_URL", "")
+DOWNLOAD_URL_PREFIX = "download/"
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# stac search, results are streamed page by page in the order of acquisition, so that the tiles of a solar day are
+# known to be complete as soon as a later day shows up and are loaded together. Searches for the `max_items` least
+# cloudy scenes are sorted by cloud cover instead and loaded at once
+STAC_SEARCH_PAGE_SIZE = 100
+STAC_SEARCH_SORTBY = [{"field": "datetime", "direction": "asc"}]
+STAC_SEARCH_MAX_ITEMS_SORTBY = [{"field": "eo:cloud_cover", "direction": "asc"}]
+# fields extension parameter to trim the item payload, e.g. {"exclude": ["properties.s2:mgrs_tile"]}, None returns
+# complete items
+STAC_SEARCH_FIELDS = None
+# number of search result pages requested ahead while the current page is loaded
+STAC_SEARCH_PREFETCH_PAGES = 2
+# results of STAC API searches are stored as compact parquet tables in this subdirectory of the cache directory and
+# reused by the same search for ITEM_STORE_TTL seconds, 0 disables storing them
+ITEM_STORE_DIRNAME = "items"
+ITEM_STORE_TTL = float(os.getenv("MAPA_ITEM_STORE_TTL", "3600"))
+
+# persistent cache of remote COG bytes, the reads of `stac._load_items` go through a local proxy which serves http range
+# requests from blocks of BLOCK_CACHE_BLOCK_SIZE bytes in this subdirectory of the cache directory, keyed by the url
+# without SAS token. Near duplicate requests, e.g. one more band or a shifted AOI, read the headers and blocks they
+# share from disk. The least recently read blocks are evicted beyond BLOCK_CACHE_MAX_BYTES. The cache is opt-in (0
+# disables it), GDAL talks HTTP/1.1 to the proxy, which gives up the HTTP/2 multiplexing of REMOTE_IO_ENV
+BLOCK_CACHE_DIRNAME = "blocks"
+BLOCK_CACHE_MAX_BYTES = int(os.getenv("MAPA_BLOCK_CACHE_MAX_BYTES", "0"))
+BLOCK_CACHE_BLOCK_SIZE = int(os.getenv("MAPA_BLOCK_CACHE_BLOCK_SIZE", str(128 * 1024)))
+BLOCK_CACHE_REQUEST_TIMEOUT = 60
+
+# speculative prefetch, as soon as an AOI is drawn or the parameters change, the STAC search, the size estimation and
+# the COG headers of the first SPECULATION_MAX_ITEMS items are run ahead in a background thread with the given
+# niceness, after SPECULATION_DELAY seconds without further changes. The submitted request waits for the search for at
+# most SPECULATION_PICKUP_TIMEOUT seconds and answers it from the stored results, see `speculation.Speculation`
+SPECULATION = os.getenv("MAPA_SPECULATION", "true").lower() == "true"
+SPECULATION_DELAY = float(os.getenv("MAPA_SPECULATION_DELAY", "0.5"))
+SPECULATION_MAX_ITEMS = int(os.getenv("MAPA_SPECULATION_MAX_ITEMS", "10"))
+SPECULATION_NICENESS = 10
+SPECULATION_PICKUP_TIMEOUT = 60
+
+# classification bands which are resampled with nearest neighbour instead of bilinear interpolation
+NEAREST_RESAMPLING_BANDS = ("SCL", "qa_pixel", "qa", "qa_radsat", "qa_aerosol", "cloud_qa")
+
+# read planning, with "aoi" the scenes are loaded onto a grid derived from the AOI. With "source" the grid is snapped
+# to the CRS, resolution and pixel grid of the scenes and extended to whole internal blocks of their COGs, with the
+# dask chunks aligned to the blocks, see `grid.plan_read`. Bands at the resolution of the grid are then read without
+# resampling, READ_GRID_RESAMPLING is used for the coarser ones, e.g. "nearest" to skip interpolating the 20 m bands of
+# sentinel-2 onto its 10 m grid. READ_BLOCK_SIZE is the block size of the COGs, 0 reads it from the first header
+READ_GRID = os.getenv("MAPA_READ_GRID", "aoi")
+READ_GRID_RESAMPLING = os.getenv("MAPA_READ_GRID_RESAMPLING", "bilinear")
+READ_BLOCK_SIZE = int(os.getenv("MAPA_READ_BLOCK_SIZE", "0"))
+
+# polygon AOIs are loaded in square spatial chunks of this many pixels per side, chunks outside of the polygon are
+# never read. Smaller chunks follow the outline more closely, at the cost of more requests
+POLYGON_CHUNK_SIZE = int(os.getenv("MAPA_POLYGON_CHUNK_SIZE", "256"))
+
+# pixel level cloud screening, items of which less than this fraction of the observed AOI pixels is clear according
+# to their SCL / qa_pixel band are dropped before loading all bands. 0 disables the screening. The mask band is read
+# at SCREENING_RESOLUTION (in units of the scene CRS, usually meters), coarse enough to be served from the overviews
+SCREENING_MIN_CLEAR_FRACTION = float(os.getenv("MAPA_SCREENING_MIN_CLEAR_FRACTION", "0"))
+SCREENING_RESOLUTION = float(os.getenv("MAPA_SCREENING_RESOLUTION", "120"))
+
+# temporal composites are reduced and written in spatial chunks of this many pixels per side, the peak memory is
+# about chunk size² x scenes x bands x 4 bytes per worker thread. Must be a multiple of 16 (geotiff block size)
+COMPOSITE_CHUNK_SIZE = int(os.getenv("MAPA_COMPOSITE_CHUNK_SIZE", "512"))
+
+# zarr datacube output, chunked per scene along time and in square spatial chunks of this many pixels per side
+DATACUBE_CHUNK_SIZE = int(os.getenv("MAPA_DATACUBE_CHUNK_SIZE", "512"))
+
+# incremental fetching, the scenes materialized per collection, bands, AOI and cloud cover are recorded in a ledger
+# within the cache directory, so that a refresh only searches date ranges which were not covered yet and only loads
+# new items. Days younger than LEDGER_SETTLE_DAYS are never considered covered, as items are published with a delay
+LEDGER_FILENAME = "mapa_ledger.json"
+LEDGER_SETTLE_DAYS = 3
+
+# overlapping AOIs are loaded together, as long as the bbox of their union is at most this many times their area
+PLANNING_MAX_AREA_RATIO = 2.0
+
+# sas tokens for signing planetary computer asset hrefs, tokens are cached per storage container until they are about
+# to expire
+PLANETARY_COMPUTER_SAS_URL = os.getenv("PC_SDK_SAS_URL", "https://planetarycomputer.microsoft.com/api/sas/v1/token")
+SAS_TOKEN_EXPIRY_MARGIN = 5 * 60
+SAS_TOKEN_REQUEST_TIMEOUT = 30
+SAS_TOKEN_REQUEST_RETRIES = 5
+SAS_TOKEN_REQUEST_WORKERS = 8
+
+# gdal configuration all remote cog reads run with, avoids directory listings and re-reading headers on every open and
+# merges neighbouring range requests
+GDAL_REMOTE_IO_OPTIONS = {
+    "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR",
+    "CPL_VSIL_CURL_ALLOWED_EXTENSIONS": ".tif,.TIF,.tiff",
+    "GDAL_HTTP_MERGE_CONSECUTIVE_RANGES": "YES",
+    "GDAL_HTTP_MULTIPLEX": "YES",
+    "GDAL_HTTP_VERSION": "2",
+    "GDAL_HTTP_MAX_RETRY": 3,
+    "GDAL_HTTP_RETRY_DELAY": 1,
+    "GDAL_INGESTED_BYTES_AT_OPEN": 32 * 1024,
+    "GDAL_CACHEMAX": 512,  # mega bytes
+    "VSI_CACHE": True,
+    "VSI_CACHE_SIZE": 64 * 1024 * 1024,
+    "CPL_VSIL_CURL_CACHE_SIZE": 128 * 1024 * 1024,
+}
+
+# remote chunk reads, failed reads are retried with exponential backoff, reads slower than the given quantile of the
+# observed latencies of reads of similar size are hedged with a duplicate request, but no more than READ_HEDGE_BUDGET
+# of all reads
+READ_MAX_RETRIES = 3
+READ_RETRY_BACKOFF = 0.5  # seconds, doubled with every retry
+READ_HEDGE_QUANTILE = 0.95
+READ_HEDGE_MIN_SAMPLES = 20
+READ_HEDGE_BUDGET = 0.05
+READ_LATENCY_WINDOW = 500  # per size class
+READ_WORKERS = 8
+# raise instead of filling scenes with nodata, if reads still fail after all retries
+READ_FAIL_ON_ERROR = False
+
+# upper bounds (in seconds) of the duration histogram buckets exposed on the `/metrics` endpoint of the download server
+METRICS_DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+# minimal time in seconds between two updates of the progress bar in the ui
+PROGRESS_MIN_UPDATE_INTERVAL = 0.25
@@ -0,0 +1,140 @@
+import logging
+from pathlib import Path
+from typing import TYPE_CHECKING, Set, Union
+
+from mapa_streamlit import conf
+from mapa_streamlit.cache import file_lock
+from mapa_streamlit.exceptions import NoSTACItemFound
+from mapa_streamlit.io import remote_io_env
+from mapa_streamlit.metrics import request_context, span
+from mapa_streamlit.reads import read_dataset
+from mapa_streamlit.stac import _drop_already_loaded_days, _load_items, iter_stac_item_pages
+from mapa_streamlit.utils import ProgressBar, prefetch_iterator
+
+if TYPE_CHECKING:
+    import numpy as np
+    import xarray as xr
+
+log = logging.getLogger(__name__)
+
+
+def open_datacube(path: Union[Path, str]) -> Union["xr.Dataset", None]:
+    """Lazily opens the zarr datacube at `path`, None if there is none yet."""
+    import xarray as xr
+
+    # zarr v2 and v3 group metadata
+    if not any((Path(path) / name).is_file() for name in (".zgroup", "zarr.json")):
+        return None
+    return xr.open_zarr(path)
+
+
+def get_datacube_days(datacube: Union["xr.Dataset", None]) -> Set[str]:
+    """Returns the solar days (as %Y-%m-%d) which are already part of `datacube`."""
+    import pandas as pd
+
+    if datacube is None:
+        return set()
+    return set(pd.to_datetime(datacube.time.values).strftime("%Y-%m-%d"))
+
+
+def _encoding(bands: list) -> dict:
+    size = conf.DATACUBE_CHUNK_SIZE
+    # one chunk per scene along time, so appending a scene only adds chunks and never rewrites existing ones. Chunks
+    # are compressed with the default codec of the installed zarr version (blosc)
+    encoding = {band: {"chunks": (1, size, size)} for band in bands}
+    # a fixed epoch keeps the time encoding valid for scenes appended later on
+    encoding["time"] = {"units": "microseconds since 1970-01-01", "dtype": "int64"}
+    return encoding
+
+
+def append_to_datacube(xarray: "xr.Dataset", array: "np.ndarray", path: Union[Path, str], bands: list) -> None:
+    """Appends the scenes of `xarray`, with the pixels already read into `array` of shape (time, y, x, band), along
+    the time dimension of the zarr datacube at `path`. The datacube is created on the first call."""
+    import xarray as xr
+
+    data = xr.Dataset(
+        {band: (xarray[band].dims, array[..., j], xarray[band].attrs) for j, band in enumerate(bands)},
+        coords=xarray.coords,
+    )
+    with span("zarr_write", scenes=xarray.sizes["time"], bands=len(bands)) as s:
+        if open_datacube(path) is None:
+            data.to_zarr(path, mode="w", encoding=_encoding(bands))
+        else:
+            data.to_zarr(path, append_dim="time")
+        s.add_bytes(array.nbytes)
+
+
+@request_context()
+def fetch_stac_items_to_datacube(
+    user_defined_bands: list,
+    user_defined_collection: str,
+    geojson: dict,
+    path: Union[Path, str],
+    date_range: str,
+    cloud_cover_percentage_value: int,
+    progress_bar: Union[None, ProgressBar] = None,
+    max_items: Union[None, int] = None,
+    min_clear_fraction: Union[None, float] = None,
+) -> Path:
+    """Fetches the STAC items for `geojson` into a chunked and compressed zarr datacube of dimensions (time, y, x),
+    with one variable per band and the georeferencing stored once. If the datacube already exists, only scenes of
+    solar days which are not part of it yet are read and appended, on the grid of the existing datacube. Existing
+    chunks are never rewritten. Appended scenes are not sorted in, use `sortby("time")` after opening if needed.
+    Scenes are read and appended one at a time, so memory is bounded by the pixels of a single scene instead of a
+    whole page of search results.
+
+    Returns
+    -------
+    Path
+        Path to the zarr datacube.
+    """
+    import odc.geo.xr  # noqa: F401, registers the `.odc` accessor
+
+    path = Path(path)
+    # appends of other processes sharing the datacube are waited for, so that no scene is appended twice
+    with file_lock(path):
+        datacube = open_datacube(path)
+        geobox = None
+        if datacube is not None:
+            missing = set(user_defined_bands) - set(datacube.data_vars)
+            if missing:
+                raise ValueError(f"datacube {path} was created without the bands {sorted(missing)}, use a new path")
+            user_defined_bands = list(datacube.data_vars)
+            geobox = datacube.odc.geobox
+        loaded_days = get_datacube_days(datacube)
+        existing_days = len(loaded_days)
+
+        pages = prefetch_iterator(
+            iter_stac_item_pages(
+                user_defined_collection,
+                geojson,
+                date_range,
+                cloud_cover_percentage_value,
+                max_items=max_items,
+                min_clear_fraction=min_clear_fraction,
+            ),
+            depth=conf.STAC_SEARCH_PREFETCH_PAGES,
+        )
+        n_items = 0
+        with remote_io_env():
+            for page in pages:
+                n_items += len(page.items)
+                xx = _drop_already_loaded_days(_load_items(page, geojson, geobox), loaded_days)
+                geobox = xx.odc.geobox if geobox is None else geobox
+                if xx.time.size == 0:
+                    continue
+                log.info(f"⬇️  appending {xx.time.size} scenes to datacube {path.name}...")
+                if progress_bar:
+                    progress_bar.add_work(sum(xx[band].nbytes for band in user_defined_bands))
+                # scene by scene, so that only a single scene of the page is held in memory
+                for i in range(xx.sizes["time"]):
+                    scene = xx.isel(time=[i])
+                    with span("compute", scenes=1, bands=len(user_defined_bands)) as s:
+                        array, _ = read_dataset(scene, user_defined_bands, progress_bar=progress_bar)
+                        s.add_bytes(array.nbytes)
+                    append_to_datacube(scene, array, path, user_defined_bands)
+
+    if not n_items and datacube is None:
+        raise NoSTACItemFound("Could not find the desired STAC item for the given bounding box and date range.")
+    log.info(f"🧊  datacube {path.name} has {len(loaded_days)} scenes, {len(loaded_days) - existing_days} new")
+    return path
@@ -0,0 +1,90 @@
+import logging
+from typing import TYPE_CHECKING, List, Sequence
+
+if TYPE_CHECKING:
+    import dask.array as da
+    import numpy as np
+    import xarray as xr
+
+log = logging.getLogger(__name__)
+
+SUPPORTED_GEOMETRY_TYPES = ("Polygon", "MultiPolygon")
+
+
+def is_rectangle(geojson: dict) -> bool:
+    """Whether `geojson` is an axis aligned rectangle in lon / lat, like the ones drawn with the rectangle tool. The
+    bbox of those is searched and loaded as is, any other geometry is searched with `intersects` and masked."""
+    if geojson.get("type") != "Polygon" or len(geojson["coordinates"]) != 1:
+        return False
+    ring = [tuple(coordinate[:2]) for coordinate in geojson["coordinates"][0]]
+    if ring and ring[0] == ring[-1]:
+        ring = ring[:-1]
+    lons, lats = {lon for lon, _ in ring}, {lat for _, lat in ring}
+    return len(ring) == 4 and len(lons) == 2 and len(lats) == 2 and all(
+        (ring[i][0] == ring[i - 1][0]) != (ring[i][1] == ring[i - 1][1]) for i in range(4)
+    )
+
+
+def union_geometry(geometries: Sequence[dict]) -> dict:
+    """Returns the union of `geometries` as GeoJSON geometry, overlapping parts are dissolved so that the result is
+    valid for `intersects` searches."""
+    from shapely.geometry import mapping, shape
+    from shapely.ops import unary_union
+
+    return mapping(unary_union([shape(geometry) for geometry in geometries]))
+
+
+def _get_offsets(chunks: Sequence[int]) -> List[int]:
+    offsets = [0]
+    for chunk in chunks:
+        offsets.append(offsets[-1] + chunk)
+    return offsets
+
+
+def _mask_blocks(data: "da.Array", mask: "np.ndarray", nodata) -> "da.Array":
+    """Masks the dask array `data` of dims (..., y, x) with the boolean `mask` of dims (y, x). Blocks which are
+    completely outside of the mask are replaced by nodata blocks, so that the tasks reading them drop out of the
+    graph, and blocks which are completely inside are kept as they are."""
+    import dask.array as da
+
+    y_offsets, x_offsets = _get_offsets(data.chunks[-2]), _get_offsets(data.chunks[-1])
+    leading = (slice(None),) * (data.ndim - 2)
+    blocks, pruned = [], 0
+    for i in range(len(y_offsets) - 1):
+        row = []
+        for j in range(len(x_offsets) - 1):
+            block = data.blocks[leading + (i, j)]
+            block_mask = mask[y_offsets[i] : y_offsets[i + 1], x_offsets[j] : x_offsets[j + 1]]
+            if not block_mask.any():
+                row.append(da.full(block.shape, nodata, dtype=data.dtype, chunks=block.chunks))
+                pruned += 1
+            elif block_mask.all():
+                row.append(block)
+            else:
+                row.append(da.where(block_mask, block, nodata).astype(data.dtype))
+        blocks.append(row)
+    log.debug(f"✂️  {pruned} of {data.numblocks[-2] * data.numblocks[-1]} chunks are outside of the geometry")
+    return da.block(blocks)
+
+
+def mask_outside_geometry(xarray: "xr.Dataset", geojson: dict, nodata=0) -> "xr.Dataset":
+    """Sets the pixels of `xarray` outside of the lon / lat `geojson` geometry to `nodata`, so that they compress to
+    almost nothing. Pixels touching the geometry are kept. For dask backed bands, chunks which don't intersect the
+    geometry are never read."""
+    import dask.array as da
+    import numpy as np
+    import odc.geo.xr  # noqa: F401, registers the `.odc` accessor
+    from odc.geo.geom import Geometry
+
+    mask = odc.geo.xr.rasterize(Geometry(geojson, crs="EPSG:4326"), xarray.odc.geobox, all_touched=True).values
+    spatial_dims = tuple(xarray.odc.spatial_dims)
+    masked = xarray.copy()
+    for name, band in xarray.data_vars.items():
+        if band.dims[-2:] != spatial_dims:
+            continue
+        if isinstance(band.data, da.Array):
+            data = _mask_blocks(band.data, mask, nodata)
+        else:
+            data = np.where(mask, band.values, np.array(nodata, dtype=band.dtype))
+        masked[name] = (band.dims, data, band.attrs)
+    return masked
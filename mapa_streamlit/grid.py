@@ -0,0 +1,191 @@
+import logging
+import math
+import posixpath
+import threading
+from collections import Counter
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Callable, Dict, List, Sequence, Tuple, Union
+
+from mapa_streamlit import conf
+from mapa_streamlit.signing import unsign_href
+
+if TYPE_CHECKING:
+    from affine import Affine
+    from odc.geo import XY
+    from odc.geo.geobox import GeoBox
+
+log = logging.getLogger(__name__)
+
+# internal block shape of the COGs per collection, band and directory of the assets, read once per process from the
+# header of the first asset. The directory keeps catalogs with the same collection ids, e.g. mirrors, apart
+_block_shapes: Dict[Tuple[str, str, str], Tuple[int, int]] = {}
+_block_shapes_lock = threading.Lock()
+
+
+@dataclass(frozen=True)
+class ReadPlan:
+    """Grid and dask chunks a page of items is loaded with, see `plan_read`. `geobox` is snapped to the blocks of the
+    COGs, the requested grid is the `roi` of it."""
+
+    geobox: "GeoBox"
+    roi: Tuple[slice, slice]
+    chunks: Dict[str, int]
+
+
+def get_anchor(transform: "Affine") -> "XY":
+    """Returns the anchor of the pixel grid of `transform`, grids created with it (see `GeoBox.from_geopolygon`) share
+    its pixel edges."""
+    from odc.geo import xy_
+
+    return xy_((transform.c / transform.a) % 1, (transform.f / transform.e) % 1)
+
+
+def get_block_shape(
+    collection: str, band: str, href: str, patch_url: Union[None, Callable[[str], str]] = None
+) -> Union[None, Tuple[int, int]]:
+    """Returns the internal (rows, columns) block shape of the COG at `href`, assumed to be the same for all assets of
+    `band` within `collection` in the same directory. The header is read through `patch_url`, `conf.READ_BLOCK_SIZE`
+    skips reading it. None if the header can't be read."""
+    import rasterio
+
+    if conf.READ_BLOCK_SIZE:
+        return conf.READ_BLOCK_SIZE, conf.READ_BLOCK_SIZE
+    key = (collection, band, posixpath.dirname(unsign_href(href)))
+    with _block_shapes_lock:
+        if key in _block_shapes:
+            return _block_shapes[key]
+    try:
+        with rasterio.open(patch_url(href) if patch_url else href) as src:
+            block_shape = tuple(src.block_shapes[0])
+    except Exception as e:
+        log.warning(f"⚠️  could not read the block shape of {band} of {collection}, not aligning reads to it: {e}")
+        return None
+    with _block_shapes_lock:
+        _block_shapes[key] = block_shape
+    return block_shape
+
+
+def _get_pixel_grid(geobox: "GeoBox") -> tuple:
+    return geobox.crs, geobox.resolution, get_anchor(geobox.transform)
+
+
+def _get_sources(parsed_items, bands: Union[None, Sequence[str]] = None) -> List[tuple]:
+    """Returns the native grid, collection, band name and href of the finest of `bands` of each parsed item."""
+    sources: List[tuple] = []
+    for item in parsed_items:
+        band_sources = [
+            (source.geobox, name, source.uri)
+            for (name, _), source in item.bands.items()
+            if source.geobox is not None and (bands is None or name in bands)
+        ]
+        if band_sources:
+            gbox, name, uri = min(band_sources, key=lambda s: min(s[0].resolution.map(abs).xy))
+            sources.append((gbox, item.collection.name, name, uri))
+    return sources
+
+
+def _get_most_common_source(sources: List[tuple]) -> tuple:
+    (most_common, _), *_ = Counter(_get_pixel_grid(gbox) for gbox, *_ in sources).most_common(1)
+    return next(s for s in sources if _get_pixel_grid(s[0]) == most_common)
+
+
+def _round_up(value: int, multiple: int) -> int:
+    return max(1, math.ceil(value / multiple)) * multiple
+
+
+def plan_read(
+    items,
+    geojson: dict,
+    bands: Union[None, Sequence[str]] = None,
+    geobox: Union[None, "GeoBox"] = None,
+    chunks: Union[None, Dict[str, int]] = None,
+    patch_url: Union[None, Callable[[str], str]] = None,
+) -> Union[None, ReadPlan]:
+    """Plans loading `items` on the native grid of their scenes: the CRS, resolution and pixel grid of the finest of
+    `bands` in the scenes most of the items share. The grid covering `geojson` (or `geobox`, for the later pages of a
+    search) is extended to whole internal blocks of the COGs and the dask chunks are aligned to them, so that every
+    chunk reads whole blocks without any resampling, which odc-stac does as plain windowed reads. Spatial `chunks` are
+    rounded up to multiples of the blocks, by default each scene is one chunk.
+
+    Returns
+    -------
+    Union[None, ReadPlan]
+        None if the items lack projection metadata or `geobox` is not on the pixel grid of the scenes.
+    """
+    from affine import Affine
+    from odc.geo.geobox import GeoBox
+    from odc.geo.geom import Geometry
+    from odc.stac import parse_items
+
+    sources = _get_sources(parse_items(items), bands)
+    if not sources:
+        return None
+    source, collection, band, uri = _get_most_common_source(sources)
+
+    if geobox is None:
+        geobox = GeoBox.from_geopolygon(
+            Geometry(geojson, crs="EPSG:4326"),
+            resolution=source.resolution,
+            crs=source.crs,
+            anchor=get_anchor(source.transform),
+        )
+    if geobox.crs != source.crs or geobox.resolution != source.resolution:
+        return None
+    col, row = ~source.transform * (geobox.transform.c, geobox.transform.f)
+    if abs(col - round(col)) > 1e-3 or abs(row - round(row)) > 1e-3:
+        return None
+    col, row = round(col), round(row)
+    height, width = geobox.shape
+
+    block_shape = get_block_shape(collection, band, uri, patch_url=patch_url)
+    if block_shape is None:
+        return ReadPlan(geobox, (slice(0, height), slice(0, width)), chunks or {"y": height, "x": width})
+    block_rows, block_cols = block_shape
+    row0, col0 = row // block_rows * block_rows, col // block_cols * block_cols
+    row1 = math.ceil((row + height) / block_rows) * block_rows
+    col1 = math.ceil((col + width) / block_cols) * block_cols
+    snapped = GeoBox((row1 - row0, col1 - col0), source.transform * Affine.translation(col0, row0), source.crs)
+    chunks = chunks or {"y": snapped.shape[0], "x": snapped.shape[1]}
+    log.debug(
+        f"🧱  reading {snapped.shape[0] // block_rows} x {snapped.shape[1] // block_cols} blocks of "
+        f"{block_rows} x {block_cols} px for a {height} x {width} px grid"
+    )
+    return ReadPlan(
+        snapped,
+        (slice(row - row0, row - row0 + height), slice(col - col0, col - col0 + width)),
+        {"y": _round_up(chunks["y"], block_rows), "x": _round_up(chunks["x"], block_cols)},
+    )
+
+
+def estimate_read_bytes(items, geojson: dict, bands: Sequence[str]) -> Union[None, int]:
+    """Estimates the size of the pixels of `bands` loaded for `items` over `geojson`: one scene per solar day on the
+    native grid of the finest band (see `plan_read`), with the data type odc-stac loads each band with.
+
+    Returns
+    -------
+    Union[None, int]
+        Bytes before compression, None if the items lack projection metadata.
+    """
+    import numpy as np
+    from odc.geo.geobox import GeoBox
+    from odc.geo.geom import Geometry
+    from odc.stac import parse_items
+
+    parsed = list(parse_items(items))
+    sources = _get_sources(parsed, bands)
+    if not sources:
+        return None
+    source, *_ = _get_most_common_source(sources)
+    geobox = GeoBox.from_geopolygon(
+        Geometry(geojson, crs="EPSG:4326"),
+        resolution=source.resolution,
+        crs=source.crs,
+        anchor=get_anchor(source.transform),
+    )
+    itemsizes = {}
+    for item in parsed:
+        for (name, _), band_source in item.bands.items():
+            if name in bands and name not in itemsizes and band_source.meta is not None:
+                itemsizes[name] = np.dtype(band_source.meta.data_type).itemsize
+    days = {item.solar_date.date() for item in parsed}
+    return len(days) * geobox.shape[0] * geobox.shape[1] * sum(itemsizes.get(band, 2) for band in bands)
@@ -0,0 +1,45 @@
+import logging
+from pathlib import Path
+from typing import TYPE_CHECKING, List, Union
+
+if TYPE_CHECKING:
+    import numpy as np
+    import plotly.graph_objects as go
+
+log = logging.getLogger(__name__)
+
+
+def create_histogram_figure(
+    paths: List[Path], array: "np.ndarray", tif_selectbox: str, selected_bands: List[str]
+) -> Union["go.Figure", None]:
+    """Creates the pixel value distribution plot of the selected tif, None if no data is found for it."""
+    import plotly.graph_objects as go
+
+    log.debug(f"📊  creating histogram of {tif_selectbox} from array of shape {array.shape}")
+    histogram_traces = []
+    if len(selected_bands) == 1:
+        filenames = [path.name for path in paths]
+        data_distributions = array.squeeze(axis=-1)
+        for filename, distribution_data in zip(filenames, data_distributions):
+            if filename == tif_selectbox:
+                histogram_trace = go.Histogram(x=distribution_data.flatten(), name=filename, histnorm="probability")
+                histogram_traces.append(histogram_trace)
+
+    if len(selected_bands) > 1:
+        filenames = [path.name for path in paths]
+        filenames = list(dict.fromkeys(filenames))
+        for filename, distribution_data in zip(filenames, array):
+            if filename == tif_selectbox:
+                for i in range(len(selected_bands)):
+                    distribution_array = distribution_data[i]
+                    histogram_trace = go.Histogram(
+                        x=distribution_array.flatten(), name=f"{filename} - {selected_bands[i]}", histnorm="probability"
+                    )
+                    histogram_traces.append(histogram_trace)
+
+    if not histogram_traces:
+        return None
+    layout = go.Layout(
+        title="Pixel Value Distribution Plot", xaxis=dict(title="Pixel Value"), yaxis=dict(title="Frequency")
+    )
+    return go.Figure(data=histogram_traces, layout=layout)
@@ -0,0 +1,224 @@
+import ast
+import logging
+from typing import TYPE_CHECKING, Callable, Dict, List, Sequence, Set
+
+if TYPE_CHECKING:
+    import xarray as xr
+
+log = logging.getLogger(__name__)
+
+# spectral indices over common band names, see `COMMON_BAND_NAMES`
+INDICES = {
+    "NDVI": "(nir - red) / (nir + red)",
+    "NDWI": "(green - nir) / (green + nir)",
+    "NDMI": "(nir - swir16) / (nir + swir16)",
+    "NBR": "(nir - swir22) / (nir + swir22)",
+    "NDBI": "(swir16 - nir) / (swir16 + nir)",
+    "SAVI": "1.5 * (nir - red) / (nir + red + 0.5)",
+    "EVI": "2.5 * (nir - red) / (nir + 6 * red - 7.5 * blue + 1)",
+}
+
+# band of each common name per collection, expressions can use either of them
+COMMON_BAND_NAMES = {
+    "sentinel-2-l2a": {
+        "coastal": "B01",
+        "blue": "B02",
+        "green": "B03",
+        "red": "B04",
+        "rededge1": "B05",
+        "rededge2": "B06",
+        "rededge3": "B07",
+        "nir": "B08",
+        "nir08": "B8A",
+        "nir09": "B09",
+        "swir16": "B11",
+        "swir22": "B12",
+    },
+    "landsat-c2-l2": {
+        "coastal": "coastal",
+        "blue": "blue",
+        "green": "green",
+        "red": "red",
+        "nir": "nir08",
+        "nir08": "nir08",
+        "swir16": "swir16",
+        "swir22": "swir22",
+    },
+}
+
+# scale and offset turning the digital numbers of the reflectance bands into surface reflectance, indices which are not
+# plain ratios like EVI depend on it. The additional -0.1 offset of sentinel-2 scenes from processing baseline 04.00 on
+# is not applied, as it differs between scenes
+REFLECTANCE_SCALING = {
+    "sentinel-2-l2a": (0.0001, 0.0),
+    "landsat-c2-l2": (0.0000275, -0.2),
+}
+
+MAX_EXPRESSION_LENGTH = 256
+MAX_EXPONENT = 8
+
+
+def _functions() -> Dict[str, Callable]:
+    import numpy as np
+
+    return {
+        "sqrt": np.sqrt,
+        "abs": np.abs,
+        "log": np.log,
+        "exp": np.exp,
+        "min": np.minimum,
+        "max": np.maximum,
+        "clip": np.clip,
+    }
+
+
+# number of arguments of each function
+_FUNCTION_ARITIES = {"sqrt": 1, "abs": 1, "log": 1, "exp": 1, "min": 2, "max": 2, "clip": 3}
+_OPERATORS = {
+    ast.Add: lambda a, b: a + b,
+    ast.Sub: lambda a, b: a - b,
+    ast.Mult: lambda a, b: a * b,
+    ast.Div: lambda a, b: a / b,
+    ast.Pow: lambda a, b: a**b,
+}
+_UNARY_OPERATORS = {ast.USub: lambda a: -a, ast.UAdd: lambda a: +a}
+
+
+class InvalidExpression(ValueError):
+    pass
+
+
+def _get_band(name: str, collection: str) -> str:
+    return COMMON_BAND_NAMES.get(collection, {}).get(name, name)
+
+
+def parse_expression(expression: str) -> ast.Expression:
+    """Parses a band math `expression` and makes sure it only consists of numbers, band names, arithmetic operators
+    and calls of the functions sqrt, abs, log, exp, min, max and clip.
+
+    Raises
+    ------
+    InvalidExpression
+        If anything else is used, e.g. attributes, subscripts, keyword arguments or other functions, if a function
+        is called with the wrong number of arguments or if no band is used at all.
+    """
+    if len(expression) > MAX_EXPRESSION_LENGTH:
+        raise InvalidExpression(f"expression is longer than {MAX_EXPRESSION_LENGTH} characters")
+    try:
+        tree = ast.parse(expression, mode="eval")
+    except SyntaxError as e:
+        raise InvalidExpression(f"invalid expression {expression!r}: {e.msg}") from None
+
+    called = {id(node.func) for node in ast.walk(tree) if isinstance(node, ast.Call)}
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.func.id not in _FUNCTION_ARITIES or node.keywords:
+                raise InvalidExpression(f"only the functions {', '.join(_FUNCTION_ARITIES)} can be called")
+            if len(node.args) != _FUNCTION_ARITIES[node.func.id]:
+                raise InvalidExpression(
+                    f"function {node.func.id} takes {_FUNCTION_ARITIES[node.func.id]} arguments, got {len(node.args)}"
+                )
+        elif isinstance(node, ast.Name):
+            if node.id in _FUNCTION_ARITIES and id(node) not in called:
+                raise InvalidExpression(f"function {node.id} can't be used as band")
+        elif isinstance(node, ast.BinOp):
+            if type(node.op) not in _OPERATORS:
+                raise InvalidExpression(f"operator {type(node.op).__name__} is not supported")
+            # large powers of constants would be evaluated right away and take forever
+            exponent = getattr(node.right, "value", None)
+            if isinstance(node.op, ast.Pow) and not (
+                isinstance(node.right, ast.Constant)
+                and isinstance(exponent, (int, float))
+                and abs(exponent) <= MAX_EXPONENT
+            ):
+                raise InvalidExpression(f"exponents must be numbers up to {MAX_EXPONENT}")
+        elif isinstance(node, ast.UnaryOp):
+            if type(node.op) not in _UNARY_OPERATORS:
+                raise InvalidExpression(f"operator {type(node.op).__name__} is not supported")
+        elif isinstance(node, ast.Constant):
+            if isinstance(node.value, bool) or not isinstance(node.value, (int, float)):
+                raise InvalidExpression(f"only numbers are allowed as constants, got {node.value!r}")
+        elif not isinstance(node, (ast.Expression, ast.Load, ast.operator, ast.unaryop)):
+            raise InvalidExpression(f"{type(node).__name__} is not allowed in expressions")
+    # an index of constants only would be a number instead of a band
+    if not _get_names(tree):
+        raise InvalidExpression(f"expression {expression!r} doesn't use any band")
+    return tree
+
+
+def _get_names(tree: ast.Expression) -> Set[str]:
+    called = {id(node.func) for node in ast.walk(tree) if isinstance(node, ast.Call)}
+    return {node.id for node in ast.walk(tree) if isinstance(node, ast.Name) and id(node) not in called}
+
+
+def get_expression_bands(expression: str, collection: str) -> Set[str]:
+    """Returns the bands of `collection` an `expression` reads, common band names are translated to band names."""
+    return {_get_band(name, collection) for name in _get_names(parse_expression(expression))}
+
+
+def resolve_indices(indices: Sequence[str]) -> Dict[str, str]:
+    """Resolves built-in index names like "NDVI" and custom indices given as "name=expression" to their expressions,
+    keyed by the band name of the index."""
+    resolved = {}
+    for index in indices:
+        if "=" in index:
+            name, expression = (part.strip() for part in index.split("=", 1))
+            if not name.isidentifier():
+                raise InvalidExpression(f"invalid index name {name!r}")
+        elif index.upper() in INDICES:
+            name, expression = index.upper(), INDICES[index.upper()]
+        else:
+            raise InvalidExpression(f"unknown index {index}, use one of {', '.join(INDICES)} or name=expression")
+        resolved[name] = expression
+    return resolved
+
+
+def get_available_indices(collection: str) -> List[str]:
+    """Returns the built-in indices of which all bands have a common band name in `collection`."""
+    common_names = COMMON_BAND_NAMES.get(collection, {})
+    return [
+        name
+        for name, expression in INDICES.items()
+        if _get_names(parse_expression(expression)) <= set(common_names)
+    ]
+
+
+def _evaluate(node: ast.AST, bands: Dict[str, "xr.DataArray"], functions: Dict[str, Callable]):
+    if isinstance(node, ast.Expression):
+        return _evaluate(node.body, bands, functions)
+    if isinstance(node, ast.Constant):
+        return node.value
+    if isinstance(node, ast.Name):
+        return bands[node.id]
+    if isinstance(node, ast.BinOp):
+        return _OPERATORS[type(node.op)](_evaluate(node.left, bands, functions), _evaluate(node.right, bands, functions))
+    if isinstance(node, ast.UnaryOp):
+        return _UNARY_OPERATORS[type(node.op)](_evaluate(node.operand, bands, functions))
+    if isinstance(node, ast.Call):
+        return functions[node.func.id](*(_evaluate(arg, bands, functions) for arg in node.args))
+    raise InvalidExpression(f"{type(node).__name__} is not allowed in expressions")
+
+
+def add_indices(xarray: "xr.Dataset", indices: Dict[str, str], collection: str) -> "xr.Dataset":
+    """Adds a float32 band per index to the lazily loaded `xarray`, computed chunk by chunk from the surface
+    reflectance of the bands in its expression once the index band is read. Nodata pixels of any of those bands and
+    invalid results like divisions by zero end up as NaN."""
+    import numpy as np
+
+    scale, offset = REFLECTANCE_SCALING.get(collection, (1.0, 0.0))
+    functions = _functions()
+    xarray = xarray.copy()
+    for name, expression in indices.items():
+        tree = parse_expression(expression)
+        bands = {}
+        for band_name in _get_names(tree):
+            band = _get_band(band_name, collection)
+            if band not in xarray:
+                raise InvalidExpression(f"band {band} of index {name} is not part of the {collection} items")
+            data = xarray[band].astype("float32")
+            bands[band_name] = data.where(data != 0) * np.float32(scale) + np.float32(offset)
+        index = _evaluate(tree, bands, functions)
+        xarray[name] = index.where(np.isfinite(index)).astype("float32")
+        xarray[name].attrs = {"expression": expression}
+        log.debug(f"🧮  added index {name} = {expression}")
+    return xarray
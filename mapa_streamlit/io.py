@@ -1,6 +1,13 @@
-from pystac import ItemCollection
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Iterator
 
-def are_stac_items_planetary_computer(item_collection: ItemCollection) -> bool:
+from mapa_streamlit import conf
+
+if TYPE_CHECKING:
+    from pystac import ItemCollection
+
+
+def are_stac_items_planetary_computer(item_collection: "ItemCollection") -> bool:
     if not item_collection.items:
         return False
     
@@ -9,4 +16,29 @@ def are_stac_items_planetary_computer(item_collection: ItemCollection) -> bool:
         True
         if absolute_href and "planetarycomputer.microsoft.com" in absolute_href
         else False
-    )
\ No newline at end of file
+    )
+
+
+def get_remote_io_options(**overrides) -> dict:
+    return {**conf.GDAL_REMOTE_IO_OPTIONS, **overrides}
+
+
+def get_stackstac_gdal_env(**overrides):
+    """Returns the GDAL environment for `stackstac.stack`, which applies it to its own reader threads."""
+    import stackstac
+
+    return stackstac.DEFAULT_GDAL_ENV.updated(always=get_remote_io_options(**overrides))
+
+
+@contextmanager
+def remote_io_env(**overrides) -> Iterator[dict]:
+    """Context manager in which all remote COG reads should run. It applies the GDAL options of
+    `conf.GDAL_REMOTE_IO_OPTIONS` (optionally updated by `overrides`) to the current thread and to the reader threads
+    odc-stac uses when computing lazily loaded datasets."""
+    import rasterio
+    from odc.stac import configure_rio
+
+    options = get_remote_io_options(**overrides)
+    configure_rio(**options)
+    with rasterio.Env(**options):
+        yield options
@@ -0,0 +1,207 @@
+import json
+import logging
+import time
+from datetime import datetime, timedelta
+from hashlib import md5
+from pathlib import Path
+from typing import TYPE_CHECKING, Iterable, List, Sequence, Union
+
+from mapa_streamlit import conf
+from mapa_streamlit.cache import atomic_write
+from mapa_streamlit.catalog import from_geoparquet_row, to_geoparquet_table
+from mapa_streamlit.signing import sign_inplace, unsign_href
+
+if TYPE_CHECKING:
+    import pyarrow as pa
+    from pystac import Item, ItemCollection
+
+log = logging.getLogger(__name__)
+
+CLOUD_COVER = "eo:cloud_cover"
+
+
+def get_solar_day(time: datetime, bbox: Union[None, Sequence[float]]) -> str:
+    """Returns the solar day (as %Y-%m-%d) `stac_load(groupby="solar_day")` groups an item acquired at `time` within
+    `bbox` by: its time shifted by the longitude of its center."""
+    if bbox:
+        time += timedelta(hours=(bbox[0] + bbox[-2]) / 2 / 15)
+    return time.strftime("%Y-%m-%d")
+
+
+def _to_dict(item: "Item") -> dict:
+    data = item.to_dict(include_self_link=True, transform_hrefs=False)
+    # only the self link is kept, it tells which catalog the item is from, see `io.are_stac_items_planetary_computer`
+    data["links"] = [link for link in data.get("links", []) if link.get("rel") == "self"]
+    for asset in data.get("assets", {}).values():
+        asset["href"] = unsign_href(asset["href"])
+    return data
+
+
+class ItemTable:
+    """STAC items as a stac-geoparquet table (see `catalog.to_geoparquet_table`): id, collection, datetime, bbox,
+    footprint, assets and one column per property. Filters, sorting and href lookups are evaluated on the columns,
+    pystac items are only created for the rows which are actually loaded, see `to_items`. Hrefs are stored without
+    SAS tokens, items are signed again when they are created."""
+
+    def __init__(self, table: "pa.Table") -> None:
+        self.table = table
+
+    @classmethod
+    def from_items(cls, items: Iterable["Item"]) -> "ItemTable":
+        return cls(to_geoparquet_table(_to_dict(item) for item in items))
+
+    @classmethod
+    def concat(cls, tables: Sequence["ItemTable"]) -> "ItemTable":
+        import pyarrow as pa
+
+        tables = [table for table in tables if len(table)]
+        if len(tables) == 1:
+            return tables[0]
+        # the structs of the assets and properties differ between pages, the rows are rebuilt into the union of them
+        return cls(pa.Table.from_pylist([row for table in tables for row in table.table.to_pylist()]))
+
+    def __len__(self) -> int:
+        return self.table.num_rows
+
+    @property
+    def nbytes(self) -> int:
+        return self.table.nbytes
+
+    @property
+    def ids(self) -> List[str]:
+        return self.table.column("id").to_pylist() if len(self) else []
+
+    @property
+    def solar_days(self) -> List[str]:
+        """The solar day of each item, see `get_solar_day`."""
+        if not len(self):
+            return []
+        names = self.table.column_names
+        times = self.table.column("datetime").to_pylist() if "datetime" in names else [None] * len(self)
+        if "start_datetime" in names:
+            times = [time or start for time, start in zip(times, self.table.column("start_datetime").to_pylist())]
+        bboxes = self.table.column("bbox").to_pylist() if "bbox" in names else [None] * len(self)
+        return [
+            get_solar_day(time, [bbox["xmin"], bbox["ymin"], bbox["xmax"], bbox["ymax"]] if bbox else None)
+            for time, bbox in zip(times, bboxes)
+        ]
+
+    def get_hrefs(self, asset: str) -> List[Union[str, None]]:
+        """Returns the unsigned href of `asset` per item, None for items without it."""
+        import pyarrow.compute as pc
+
+        if not len(self) or "assets" not in self.table.column_names:
+            return [None] * len(self)
+        assets = self.table.schema.field("assets").type
+        index = assets.get_field_index(asset)
+        if index < 0:
+            return [None] * len(self)
+        href = assets[index].type.get_field_index("href")
+        return pc.struct_field(self.table.column("assets"), [index, href]).to_pylist()
+
+    def filter(
+        self,
+        bbox: Union[None, Sequence[float]] = None,
+        start: Union[None, datetime] = None,
+        end: Union[None, datetime] = None,
+        max_cloud_cover: Union[None, float] = None,
+        exclude_ids: Union[None, Iterable[str]] = None,
+        solar_days: Union[None, Iterable[str]] = None,
+    ) -> "ItemTable":
+        """Returns the items intersecting `bbox`, acquired within [`start`, `end`], with less than `max_cloud_cover`
+        percent of clouds, not part of `exclude_ids` and acquired on one of `solar_days`."""
+        import pyarrow as pa
+        import pyarrow.compute as pc
+
+        if not len(self):
+            return self
+        if max_cloud_cover is not None and CLOUD_COVER not in self.table.column_names:
+            return self.slice(0, 0)
+        expression = pc.scalar(True)
+        if bbox is not None:
+            expression &= (pc.field("bbox", "xmin") <= bbox[2]) & (pc.field("bbox", "xmax") >= bbox[0])
+            expression &= (pc.field("bbox", "ymin") <= bbox[3]) & (pc.field("bbox", "ymax") >= bbox[1])
+        if start is not None:
+            expression &= pc.field("datetime") >= start
+        if end is not None:
+            expression &= pc.field("datetime") <= end
+        if max_cloud_cover is not None:
+            expression &= pc.field(CLOUD_COVER) < max_cloud_cover
+        if exclude_ids is not None:
+            expression &= ~pc.field("id").isin(pa.array(list(exclude_ids), type=pa.string()))
+        table = self.table
+        if solar_days is not None:
+            solar_days = set(solar_days)
+            table = table.filter(pa.array([day in solar_days for day in self.solar_days]))
+        return ItemTable(table.filter(expression))
+
+    def sort_by_cloud_cover(self) -> "ItemTable":
+        """Least cloudy items first, items without cloud cover last."""
+        if not len(self):
+            return self
+        keys = [(CLOUD_COVER, "ascending")] if CLOUD_COVER in self.table.column_names else []
+        return ItemTable(self.table.sort_by(keys + [("id", "ascending")]))
+
+    def slice(self, offset: int, length: int) -> "ItemTable":
+        return ItemTable(self.table.slice(offset, length))
+
+    def to_items(self) -> "ItemCollection":
+        from pystac import ItemCollection
+
+        items = ItemCollection([from_geoparquet_row(row) for row in self.table.to_pylist()])
+        sign_inplace(items)
+        return items
+
+    def write(self, path: Union[Path, str]) -> Path:
+        import pyarrow.parquet as pq
+
+        with atomic_write(path) as tmp_path:
+            pq.write_table(self.table, tmp_path, compression="zstd")
+        return Path(path)
+
+    @classmethod
+    def read(cls, path: Union[Path, str]) -> "ItemTable":
+        import pyarrow.parquet as pq
+
+        return cls(pq.read_table(path))
+
+
+def get_search_key(**search) -> str:
+    """Key of the results of a search with the given parameters."""
+    return md5(json.dumps(search, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class ItemStore:
+    """Search results stored as `ItemTable` parquet files within a cache directory, one per search. Results are
+    reused for `conf.ITEM_STORE_TTL` seconds, newly published items show up once they expired."""
+
+    def __init__(self, cache_dir: Union[Path, str], ttl: Union[None, float] = None) -> None:
+        self.cache_dir = Path(cache_dir)
+        self.ttl = conf.ITEM_STORE_TTL if ttl is None else ttl
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.parquet"
+
+    def get(self, key: str) -> Union[None, ItemTable]:
+        path = self._path(key)
+        try:
+            if time.time() - path.stat().st_mtime > self.ttl:
+                return None
+            return ItemTable.read(path)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            log.warning(f"⚠️  ignoring unreadable search results {path}: {e}")
+            return None
+
+    def put(self, key: str, table: ItemTable) -> None:
+        if self.ttl <= 0:
+            return
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        try:
+            table.write(self._path(key))
+        except Exception as e:
+            # e.g. empty structs of items without any assets can't be written to parquet, the search is repeated
+            log.warning(f"⚠️  not storing the search results {key}: {e}")
+            return
+        log.debug(f"🗃  stored {len(table)} search results as {self._path(key).name} ({table.nbytes / 1024:.0f} kB)")
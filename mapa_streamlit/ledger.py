@@ -0,0 +1,233 @@
+import copy
+import json
+import logging
+from dataclasses import asdict, dataclass, field
+from datetime import date, datetime, timedelta, timezone
+from hashlib import md5
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, List, Tuple, Union
+
+from mapa_streamlit import conf
+from mapa_streamlit.cache import Manifest, atomic_write, file_lock
+from mapa_streamlit.caching import get_hash_of_geojson
+from mapa_streamlit.catalog import _parse_datetime_range
+
+if TYPE_CHECKING:
+    from shapely import STRtree
+
+log = logging.getLogger(__name__)
+
+# open ended date ranges are covered from this day on
+_EPOCH = date(1970, 1, 1)
+
+# entries and R-trees over their AOIs per ledger path, along with the version of the ledger file they were read from.
+# The trees are built per search parameters on first use, see `Ledger.find_covering`
+_indexes: Dict[str, Tuple[Union[None, tuple], Dict[str, dict], Dict[str, tuple]]] = {}
+
+
+def get_ledger_key(
+    collection: str, bands: list, geojson: dict, cloud_cover_percentage_value: int, min_clear_fraction: float = 0
+) -> str:
+    """Key of the scenes materialized for a search. The band order is part of the key, as it is the band order of
+    the tifs."""
+    search = [collection, list(bands), get_hash_of_geojson(geojson), cloud_cover_percentage_value]
+    # only part of the key with screening enabled, so that existing entries stay valid
+    if min_clear_fraction:
+        search.append(min_clear_fraction)
+    return md5(json.dumps(search).encode()).hexdigest()
+
+
+@dataclass
+class LedgerEntry:
+    """Scenes materialized for one ledger key.
+
+    `covered` are the inclusive day ranges which were searched completely, `items` the ids of all STAC items which
+    were loaded or skipped because a scene of their solar day existed already, `scenes` the tif paths and the
+    acquisition time per solar day (as %Y-%m-%d) and `metadata` the day per downloaded metadata file. `search` holds
+    the search parameters besides the AOI and `geometry` the AOI, so that the entry can serve AOIs within it, see
+    `Ledger.find_covering`."""
+
+    covered: List[Tuple[str, str]] = field(default_factory=list)
+    items: List[str] = field(default_factory=list)
+    scenes: Dict[str, dict] = field(default_factory=dict)
+    metadata: Dict[str, str] = field(default_factory=dict)
+    search: Dict[str, object] = field(default_factory=dict)
+    geometry: Union[None, dict] = None
+
+    def add_scene(self, day: str, time: datetime, paths: List[Path]) -> None:
+        self.scenes[day] = {"datetime": time.isoformat(), "paths": [str(path) for path in paths]}
+
+    def get_scenes(self, date_range: str) -> List[dict]:
+        """Returns the scenes within `date_range`, sorted by time."""
+        start, end = _get_days(date_range)
+        return sorted(
+            (scene for day, scene in self.scenes.items() if start <= date.fromisoformat(day) <= end),
+            key=lambda scene: scene["datetime"],
+        )
+
+    def get_metadata(self, date_range: str) -> List[str]:
+        """Returns the metadata files of the items within `date_range`."""
+        start, end = _get_days(date_range)
+        return [path for path, day in self.metadata.items() if start <= date.fromisoformat(day) <= end]
+
+    def is_complete(self) -> bool:
+        """Whether all files of the entry exist and were completely written, according to the manifests of their
+        directories, see `cache.Manifest`."""
+        manifests = {}
+        paths = [Path(path) for scene in self.scenes.values() for path in scene["paths"]]
+        paths += [Path(path) for path in self.metadata]
+        return all(manifests.setdefault(path.parent, Manifest(path.parent)).is_valid(path) for path in paths)
+
+
+def _get_version(path: Path) -> Union[None, Tuple[int, int, int]]:
+    # the ledger is replaced on every write, hence a new inode tells a change even if the modification time doesn't
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def _get_days(date_range: str) -> Tuple[date, date]:
+    start, end = _parse_datetime_range(date_range)
+    return (start.date() if start else _EPOCH), (end.date() if end else datetime.now(timezone.utc).date())
+
+
+def _merge(ranges: List[Tuple[date, date]]) -> List[Tuple[date, date]]:
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + timedelta(days=1):
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def get_uncovered_date_ranges(date_range: str, covered: List[Tuple[str, str]]) -> List[str]:
+    """Returns the parts of `date_range` which are not `covered` yet, as date ranges in the format of the STAC
+    search."""
+    start, end = _get_days(date_range)
+    uncovered = []
+    for covered_start, covered_end in _merge([(date.fromisoformat(s), date.fromisoformat(e)) for s, e in covered]):
+        if covered_end < start or covered_start > end:
+            continue
+        if covered_start > start:
+            uncovered.append((start, covered_start - timedelta(days=1)))
+        start = covered_end + timedelta(days=1)
+    if start <= end:
+        uncovered.append((start, end))
+    return [f"{s.isoformat()}/{e.isoformat()}" for s, e in uncovered]
+
+
+def add_covered_date_range(covered: List[Tuple[str, str]], date_range: str) -> List[Tuple[str, str]]:
+    """Adds `date_range` to the `covered` day ranges. The last `conf.LEDGER_SETTLE_DAYS` days are left out, as items
+    are published with some delay, so that they are searched again on the next refresh."""
+    start, end = _get_days(date_range)
+    end = min(end, datetime.now(timezone.utc).date() - timedelta(days=conf.LEDGER_SETTLE_DAYS))
+    ranges = [(date.fromisoformat(s), date.fromisoformat(e)) for s, e in covered]
+    if start <= end:
+        ranges.append((start, end))
+    return [(s.isoformat(), e.isoformat()) for s, e in _merge(ranges)]
+
+
+def clip_covered_date_ranges(covered: List[Tuple[str, str]], date_range: str) -> List[Tuple[str, str]]:
+    """Returns the parts of the `covered` day ranges within `date_range`."""
+    start, end = _get_days(date_range)
+    clipped = []
+    for covered_start, covered_end in covered:
+        clipped_start = max(date.fromisoformat(covered_start), start)
+        clipped_end = min(date.fromisoformat(covered_end), end)
+        if clipped_start <= clipped_end:
+            clipped.append((clipped_start.isoformat(), clipped_end.isoformat()))
+    return clipped
+
+
+class Ledger:
+    """Records which STAC items were materialized as tifs into a cache directory, stored as json next to them. The
+    ledger is locked while it is read or written, so that it can be shared by processes and replicas."""
+
+    def __init__(self, cache_dir: Union[Path, str]) -> None:
+        self.path = Path(cache_dir) / conf.LEDGER_FILENAME
+
+    def _read(self) -> Dict[str, dict]:
+        try:
+            return json.loads(self.path.read_text())
+        except FileNotFoundError:
+            return {}
+        except json.JSONDecodeError:
+            log.warning(f"⚠️  ignoring corrupt ledger {self.path}")
+            return {}
+
+    def get(self, key: str) -> LedgerEntry:
+        """Returns the entry of `key`. Entries of which files were deleted in the meantime, e.g. by the cleanup job,
+        are started from scratch."""
+        with file_lock(self.path):
+            entry = self._read().get(key)
+        if entry is None:
+            return LedgerEntry()
+        entry = LedgerEntry(**entry)
+        if not entry.is_complete():
+            log.info(f"🗑  files of ledger entry {key} were deleted, fetching from scratch")
+            return LedgerEntry()
+        return entry
+
+    def find_covering(
+        self, search: Dict[str, object], geojson: dict, date_range: str
+    ) -> Union[None, Tuple[str, LedgerEntry]]:
+        """Returns the key and entry with the same `search` parameters of which the AOI contains `geojson`, looked up
+        in an R-tree over the AOIs of all entries, which is kept in memory until the ledger changes. Of several
+        entries, the one covering most of `date_range` wins, then the one with the smallest AOI, as fewer pixels have
+        to be clipped from it. None if there is none, also if `geojson` only partly overlaps the AOIs of entries or is
+        only covered by several of them together, such AOIs are fetched in full."""
+        from shapely.geometry import shape
+
+        candidates, aois, tree = self._get_index(search)
+        if tree is None:
+            return None
+        # indices of the aois which contain the geometry
+        containing = tree.query(shape(geojson), predicate="within")
+
+        def _uncovered_days(entry: LedgerEntry) -> int:
+            return sum(
+                (date.fromisoformat(end) - date.fromisoformat(start)).days + 1
+                for start, end in (r.split("/") for r in get_uncovered_date_ranges(date_range, entry.covered))
+            )
+
+        for i in sorted(containing, key=lambda i: (_uncovered_days(candidates[i][1]), aois[i].area)):
+            key, entry = candidates[i]
+            if clip_covered_date_ranges(entry.covered, date_range) and entry.is_complete():
+                # the cached entries are shared between lookups
+                return key, copy.deepcopy(entry)
+        return None
+
+    def _get_index(self, search: Dict[str, object]) -> Tuple[List[Tuple[str, LedgerEntry]], list, "STRtree"]:
+        """Returns the entries with the same `search` parameters and an AOI, their AOIs and an R-tree over them (None
+        without entries). The ledger is only read and the trees are only rebuilt once the ledger file changed."""
+        from shapely import STRtree
+        from shapely.geometry import shape
+
+        search_key = json.dumps(search, sort_keys=True)
+        # the file lock excludes the other threads of this process as well, see `cache.file_lock`
+        with file_lock(self.path):
+            version = _get_version(self.path)
+            index = _indexes.get(str(self.path))
+            if index is None or index[0] != version:
+                index = _indexes[str(self.path)] = (version, self._read(), {})
+            _, entries, trees = index
+            if search_key not in trees:
+                candidates = [
+                    (key, LedgerEntry(**entry))
+                    for key, entry in entries.items()
+                    if entry.get("search") == search and entry.get("geometry") and entry.get("covered")
+                ]
+                aois = [shape(entry.geometry) for _, entry in candidates]
+                trees[search_key] = (candidates, aois, STRtree(aois) if aois else None)
+            return trees[search_key]
+
+    def put(self, key: str, entry: LedgerEntry) -> None:
+        with file_lock(self.path):
+            entries = self._read()
+            entries[key] = asdict(entry)
+            # written to a temporary file first, so that readers never see a partially written ledger
+            with atomic_write(self.path, record=False) as tmp_path:
+                tmp_path.write_text(json.dumps(entries))
@@ -0,0 +1,130 @@
+import contextvars
+import json
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Dict, Iterator, Tuple, Union
+
+from mapa_streamlit import conf
+
+log = logging.getLogger(__name__)
+
+_request_id: contextvars.ContextVar = contextvars.ContextVar("mapa_request_id", default=None)
+
+
+def get_request_id() -> Union[str, None]:
+    return _request_id.get()
+
+
+@contextmanager
+def request_context(request_id: str = None) -> Iterator[str]:
+    """Sets the correlation id all spans within the context are logged with. Nested contexts keep the id of the
+    outer context, unless an explicit `request_id` is given."""
+
+    request_id = request_id or get_request_id() or uuid.uuid4().hex[:12]
+    token = _request_id.set(request_id)
+    try:
+        yield request_id
+    finally:
+        _request_id.reset(token)
+
+
+class _Registry:
+    """Thread safe in-process store of the counters and histograms exposed on the metrics endpoint."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.counters: Dict[Tuple[str, str], float] = {}
+        self.histograms: Dict[Tuple[str, str], Dict] = {}
+
+    def inc(self, name: str, stage: str, value: float = 1.0) -> None:
+        with self._lock:
+            self.counters[(name, stage)] = self.counters.get((name, stage), 0.0) + value
+
+    def observe(self, name: str, stage: str, value: float) -> None:
+        with self._lock:
+            histogram = self.histograms.setdefault(
+                (name, stage), {"buckets": [0] * len(conf.METRICS_DURATION_BUCKETS), "sum": 0.0, "count": 0}
+            )
+            for i, bound in enumerate(conf.METRICS_DURATION_BUCKETS):
+                if value <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def render(self) -> str:
+        """Returns all metrics in the prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f"# TYPE {name} counter")
+                for (counter, stage), value in sorted(self.counters.items()):
+                    if counter == name:
+                        lines.append(f'{name}{{stage="{stage}"}} {value:g}')
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (histogram, stage), values in sorted(self.histograms.items()):
+                    if histogram != name:
+                        continue
+                    for bound, count in zip(conf.METRICS_DURATION_BUCKETS, values["buckets"]):
+                        lines.append(f'{name}_bucket{{stage="{stage}",le="{bound:g}"}} {count}')
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {values["count"]}')
+                    lines.append(f'{name}_sum{{stage="{stage}"}} {values["sum"]:g}')
+                    lines.append(f'{name}_count{{stage="{stage}"}} {values["count"]}')
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = _Registry()
+
+
+class Span:
+    def __init__(self, stage: str, fields: dict) -> None:
+        self.stage = stage
+        self.fields = fields
+        self.bytes = 0
+        self.duration = 0.0
+
+    def add_bytes(self, n_bytes: int) -> None:
+        self.bytes += int(n_bytes)
+
+
+@contextmanager
+def span(stage: str, **fields) -> Iterator[Span]:
+    """Times a pipeline stage. The duration, processed bytes (see `Span.add_bytes`) and failures are recorded per stage
+    in the metrics registry and logged as a structured json line together with the request id and `fields`."""
+
+    current = Span(stage, fields)
+    status = "ok"
+    start = time.perf_counter()
+    try:
+        yield current
+    except BaseException:
+        status = "error"
+        REGISTRY.inc("mapa_stage_errors_total", stage)
+        raise
+    finally:
+        current.duration = time.perf_counter() - start
+        REGISTRY.observe("mapa_stage_duration_seconds", stage, current.duration)
+        if current.bytes:
+            REGISTRY.inc("mapa_stage_bytes_total", stage, current.bytes)
+        record = {
+            "event": "span",
+            "stage": stage,
+            "status": status,
+            "request_id": get_request_id(),
+            "duration_s": round(current.duration, 6),
+            "bytes": current.bytes,
+            **current.fields,
+        }
+        log.info(json.dumps(record, default=str))
+
+
+def render_metrics() -> str:
+    return REGISTRY.render()
@@ -0,0 +1,203 @@
+import logging
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Sequence
+
+from mapa_streamlit import conf
+from mapa_streamlit.exceptions import NoSTACItemFound
+from mapa_streamlit.geometry import is_rectangle, mask_outside_geometry, union_geometry
+from mapa_streamlit.io import remote_io_env
+from mapa_streamlit.metrics import request_context, span
+from mapa_streamlit.reads import read_dataset
+from mapa_streamlit.stac import (
+    _turn_geojson_into_bbox,
+    get_mtl_metadata,
+    load_stac_items_for_bbox,
+    save_images_from_xarr,
+)
+
+log = logging.getLogger(__name__)
+
+
+def _area(bbox: Sequence[float]) -> float:
+    return max(bbox[2] - bbox[0], 0.0) * max(bbox[3] - bbox[1], 0.0)
+
+
+def _intersects(bbox: Sequence[float], other: Sequence[float]) -> bool:
+    return bbox[0] <= other[2] and other[0] <= bbox[2] and bbox[1] <= other[3] and other[1] <= bbox[3]
+
+
+def _union(bbox: Sequence[float], other: Sequence[float]) -> List[float]:
+    return [min(bbox[0], other[0]), min(bbox[1], other[1]), max(bbox[2], other[2]), max(bbox[3], other[3])]
+
+
+def _bbox_to_geojson(bbox: Sequence[float]) -> dict:
+    west, south, east, north = bbox
+    return {
+        "type": "Polygon",
+        "coordinates": [[[west, south], [east, south], [east, north], [west, north], [west, south]]],
+    }
+
+
+class _UnionFind:
+    def __init__(self, bboxes: Sequence[Sequence[float]]) -> None:
+        self.parent = list(range(len(bboxes)))
+        self.bbox = {i: list(bbox) for i, bbox in enumerate(bboxes)}
+        # sum of the areas of the members, to judge how much pixels outside of the AOIs a merged load would read
+        self.area = {i: _area(bbox) for i, bbox in enumerate(bboxes)}
+
+    def find(self, i: int) -> int:
+        while self.parent[i] != i:
+            self.parent[i] = self.parent[self.parent[i]]
+            i = self.parent[i]
+        return i
+
+    def union(self, i: int, j: int, max_area_ratio: float) -> bool:
+        root_i, root_j = self.find(i), self.find(j)
+        if root_i == root_j:
+            return False
+        merged = _union(self.bbox[root_i], self.bbox[root_j])
+        area = self.area[root_i] + self.area[root_j]
+        if _area(merged) > max_area_ratio * area:
+            return False
+        self.parent[root_j] = root_i
+        self.bbox[root_i], self.area[root_i] = merged, area
+        return True
+
+
+def plan_aoi_groups(geometries: Sequence[dict], max_area_ratio: float = None) -> List[List[int]]:
+    """Groups overlapping AOIs, each group can be searched and loaded once over the bbox of its union. Groups are the
+    connected components of the overlap graph, however two groups are only merged as long as the bbox of their union
+    is at most `max_area_ratio` times the area of their AOIs, so that chains of AOIs don't end up in one huge load.
+
+    Returns
+    -------
+    List[List[int]]
+        Indices of the AOIs per group, in the order of `geometries`.
+    """
+    max_area_ratio = conf.PLANNING_MAX_AREA_RATIO if max_area_ratio is None else max_area_ratio
+    bboxes = [_turn_geojson_into_bbox(geometry) for geometry in geometries]
+    groups = _UnionFind(bboxes)
+
+    # sweep along the west edges, only AOIs starting before the east edge of the current one can overlap with it
+    order = sorted(range(len(bboxes)), key=lambda i: bboxes[i][0])
+    for position, i in enumerate(order):
+        for j in order[position + 1 :]:
+            if bboxes[j][0] > bboxes[i][2]:
+                break
+            if _intersects(bboxes[i], bboxes[j]):
+                groups.union(i, j, max_area_ratio)
+
+    members: Dict[int, List[int]] = {}
+    for i in range(len(bboxes)):
+        members.setdefault(groups.find(i), []).append(i)
+    return sorted(members.values())
+
+
+@dataclass
+class AOIFetch:
+    """Result of an AOI which was fetched as part of a merged load, see `fetch_stac_items_for_aois`."""
+
+    paths: List[Path]
+    array: object
+    xarray: object
+    seconds: float = 0.0
+    group: List[str] = field(default_factory=list)
+
+
+@request_context()
+def fetch_stac_items_for_aois(
+    aois: Dict[str, dict],
+    user_defined_bands: list,
+    user_defined_collection: str,
+    cache_dirs: Dict[str, Path],
+    date_range: str,
+    cloud_cover_percentage_value: int,
+    max_items: int = None,
+) -> Dict[str, AOIFetch]:
+    """Fetches the STAC items for several AOIs with one search and one load per group of overlapping AOIs, so shared
+    pixels are only read once. The tifs of each AOI are clipped from the pixels of its group, on the grid of the
+    group, and written to the AOI's cache directory. The pixels of the whole group are held in memory meanwhile, see
+    `conf.PLANNING_MAX_AREA_RATIO` for how much larger than its AOIs a group can get. With `max_items`, which are the
+    least cloudy items of each AOI, AOIs are fetched one by one instead.
+
+    Returns
+    -------
+    Dict[str, AOIFetch]
+        Tif and metadata paths, pixels and dataset per AOI id. AOIs without any STAC item are left out.
+    """
+    ids = list(aois)
+    # the least cloudy items of a merged search would be those of the union instead of each aoi
+    groups = [[i] for i in range(len(ids))] if max_items else plan_aoi_groups([aois[aoi_id] for aoi_id in ids])
+    results = {}
+    for group in groups:
+        group_ids = [ids[i] for i in group]
+        try:
+            results.update(
+                _fetch_group(
+                    {aoi_id: aois[aoi_id] for aoi_id in group_ids},
+                    user_defined_bands,
+                    user_defined_collection,
+                    cache_dirs,
+                    date_range,
+                    cloud_cover_percentage_value,
+                    max_items,
+                )
+            )
+        except NoSTACItemFound:
+            log.info(f"🫙  no stac items found for aois {group_ids}")
+    return results
+
+
+def _fetch_group(
+    aois: Dict[str, dict],
+    bands: list,
+    collection: str,
+    cache_dirs: Dict[str, Path],
+    date_range: str,
+    cloud_cover: int,
+    max_items: int,
+) -> Dict[str, AOIFetch]:
+    from odc.geo.geom import Geometry
+    from pystac import ItemCollection
+
+    start = time.perf_counter()
+    bbox = _turn_geojson_into_bbox(next(iter(aois.values())))
+    for geometry in aois.values():
+        bbox = _union(bbox, _turn_geojson_into_bbox(geometry))
+    # polygon aois are loaded over their union, so that chunks outside of all of them aren't read
+    rectangles = all(is_rectangle(geometry) for geometry in aois.values())
+    union = _bbox_to_geojson(bbox) if rectangles else union_geometry(list(aois.values()))
+    log.info(f"🧩  loading {len(aois)} overlapping aois {list(aois)} at once")
+
+    with remote_io_env():
+        items, xx = load_stac_items_for_bbox(collection, union, date_range, cloud_cover, max_items=max_items)
+        with span("compute", scenes=xx.sizes["time"], bands=len(bands), aois=len(aois)) as s:
+            array, _ = read_dataset(xx, bands)
+            s.add_bytes(array.nbytes)
+    # the pixels of the union are kept in memory and each aoi is clipped from them
+    loaded = xx[bands].copy()
+    for j, band in enumerate(bands):
+        loaded[band] = (xx[band].dims, array[..., j])
+    shared_seconds = (time.perf_counter() - start) / len(aois)
+
+    results = {}
+    for aoi_id, geometry in aois.items():
+        start = time.perf_counter()
+        clipped = loaded.odc.crop(Geometry(geometry, crs="EPSG:4326"), apply_mask=False)
+        if not is_rectangle(geometry):
+            clipped = mask_outside_geometry(clipped, geometry)
+        paths, aoi_array = save_images_from_xarr(clipped, cache_dirs[aoi_id], bands, collection)
+        if collection == "landsat-c2-l2":
+            aoi_bbox = _turn_geojson_into_bbox(geometry)
+            aoi_items = [item for item in items if item.bbox is None or _intersects(item.bbox, aoi_bbox)]
+            paths += get_mtl_metadata(ItemCollection(aoi_items), cache_dirs[aoi_id])
+        results[aoi_id] = AOIFetch(
+            paths=paths,
+            array=aoi_array,
+            xarray=clipped,
+            seconds=shared_seconds + time.perf_counter() - start,
+            group=list(aois),
+        )
+    return results
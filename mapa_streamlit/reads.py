@@ -0,0 +1,224 @@
+import contextvars
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import asdict, dataclass
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterator, List, Tuple, TypeVar, Union
+
+from mapa_streamlit import conf
+from mapa_streamlit.metrics import span
+from mapa_streamlit.utils import DaskProgressCallback, ProgressBar
+
+if TYPE_CHECKING:
+    import numpy as np
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+@dataclass
+class ReadStats:
+    reads: int = 0
+    retries: int = 0
+    hedges: int = 0
+    errors: int = 0
+
+    def as_tags(self) -> Dict[str, int]:
+        """Returns the stats as GeoTIFF metadata tags."""
+        return {f"read_{key}": value for key, value in asdict(self).items()}
+
+
+def get_size_class(nbytes: int) -> int:
+    """Returns the size class of a read of `nbytes`, reads within a factor of two in size share a class."""
+    return max(int(nbytes), 1).bit_length()
+
+
+class HedgedReader:
+    """Runs remote reads with retries and hedging. Failing reads are retried with exponential backoff. If a read
+    takes longer than the `hedge_quantile` of the previously observed latencies of reads of the same size class (see
+    `get_size_class`), a duplicate read is started and the result of whichever finishes first is used, which cuts the
+    latency tail caused by single slow requests. At most `hedge_budget` of all reads are hedged, which bounds the
+    duplicated traffic, e.g. when most reads are served from the GDAL cache and only the slower remaining ones would
+    exceed the quantile."""
+
+    def __init__(
+        self,
+        max_retries: int = None,
+        backoff: float = None,
+        hedge_quantile: float = None,
+        hedge_min_samples: int = None,
+        hedge_budget: float = None,
+        max_workers: int = None,
+    ) -> None:
+        self.max_retries = conf.READ_MAX_RETRIES if max_retries is None else max_retries
+        self.backoff = conf.READ_RETRY_BACKOFF if backoff is None else backoff
+        self.hedge_quantile = conf.READ_HEDGE_QUANTILE if hedge_quantile is None else hedge_quantile
+        self.hedge_min_samples = conf.READ_HEDGE_MIN_SAMPLES if hedge_min_samples is None else hedge_min_samples
+        self.hedge_budget = conf.READ_HEDGE_BUDGET if hedge_budget is None else hedge_budget
+        self.max_workers = conf.READ_WORKERS if max_workers is None else max_workers
+        self._latencies: Dict[int, deque] = defaultdict(lambda: deque(maxlen=conf.READ_LATENCY_WINDOW))
+        self._reads = 0
+        self._hedges = 0
+        self._lock = threading.Lock()
+        # hedged duplicates need their own threads, otherwise they would queue up behind the reads they should hedge
+        self._pool = ThreadPoolExecutor(max_workers=2 * self.max_workers, thread_name_prefix="mapa-read")
+
+    def hedge_delay(self, nbytes: int = 0) -> Union[float, None]:
+        """Returns the latency after which a read of `nbytes` gets hedged, None as long as too few reads of its size
+        class were observed."""
+        with self._lock:
+            latencies = self._latencies.get(get_size_class(nbytes), ())
+            if len(latencies) < self.hedge_min_samples:
+                return None
+            latencies = sorted(latencies)
+        return latencies[min(int(self.hedge_quantile * len(latencies)), len(latencies) - 1)]
+
+    def _timed(self, read: Callable[[], T], size_class: int) -> T:
+        start = time.perf_counter()
+        result = read()
+        with self._lock:
+            self._latencies[size_class].append(time.perf_counter() - start)
+        return result
+
+    def _take_hedge(self) -> bool:
+        with self._lock:
+            if self._hedges >= self.hedge_budget * self._reads:
+                return False
+            self._hedges += 1
+            return True
+
+    def _read_hedged(self, read: Callable[[], T], stats: ReadStats, nbytes: int) -> T:
+        size_class = get_size_class(nbytes)
+        futures = {self._pool.submit(self._timed, read, size_class)}
+        delay = self.hedge_delay(nbytes)
+        if delay is not None:
+            done, _ = wait(futures, timeout=delay)
+            if not done and self._take_hedge():
+                stats.hedges += 1
+                futures.add(self._pool.submit(self._timed, read, size_class))
+
+        error = None
+        while futures:
+            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    for pending in futures:
+                        pending.cancel()
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def read(self, read: Callable[[], T], stats: ReadStats = None, nbytes: int = 0) -> T:
+        """Runs `read` with retries and hedging, `nbytes` is the expected size of its result, which selects the
+        latencies it is compared against."""
+        stats = ReadStats() if stats is None else stats
+        stats.reads += 1
+        with self._lock:
+            self._reads += 1
+        for attempt in range(self.max_retries + 1):
+            try:
+                return self._read_hedged(read, stats, nbytes)
+            except Exception as e:
+                if attempt == self.max_retries:
+                    stats.errors += 1
+                    raise
+                stats.retries += 1
+                log.warning(f"🔁  read failed with {e!r}, retrying ({attempt + 1}/{self.max_retries}) ...")
+                time.sleep(self.backoff * 2**attempt)
+
+
+_reader: Union[HedgedReader, None] = None
+_reader_lock = threading.Lock()
+
+
+def get_reader() -> HedgedReader:
+    """Returns the process wide reader, sharing the observed latencies between requests."""
+    global _reader
+    with _reader_lock:
+        if _reader is None:
+            _reader = HedgedReader()
+        return _reader
+
+
+def _iter_chunks(data) -> Iterator[Tuple[Tuple[slice, ...], Any]]:
+    # yields the dask chunks of `data` along with the region of the array they fill
+    import dask.array as da
+    import numpy as np
+
+    data = da.asarray(data)
+    offsets = [np.cumsum((0,) + chunks) for chunks in data.chunks]
+    for index in np.ndindex(*data.numblocks):
+        region = tuple(slice(offset[k], offset[k + 1]) for offset, k in zip(offsets, index))
+        yield region, data.blocks[index]
+
+
+def read_dataset(
+    xarray, bands: List[str], reader: HedgedReader = None, progress_bar: Union[ProgressBar, None] = None
+) -> Tuple["np.ndarray", List[ReadStats]]:
+    """Computes the lazily loaded `bands` of `xarray` chunk by chunk through `reader`, so that a failing or slow
+    chunk is retried or hedged on its own instead of the whole band of a scene. The progress bar advances with the
+    completed dask tasks, weighted by the bytes each read yields.
+
+    Returns
+    -------
+    Tuple[np.ndarray, List[ReadStats]]
+        Array of shape (time, y, x, band) and the read statistics of each scene. Chunks which still fail after all
+        retries are filled with nodata (0) and counted as errors, unless `conf.READ_FAIL_ON_ERROR` is enabled.
+    """
+    import numpy as np
+
+    reader = get_reader() if reader is None else reader
+    n_scenes = xarray.sizes["time"]
+    dtype = np.result_type(*[xarray[band].dtype for band in bands])
+    array = np.zeros((n_scenes, xarray.sizes["y"], xarray.sizes["x"], len(bands)), dtype=dtype)
+    # separate stats per band, as the bands of a scene are read concurrently
+    band_stats = [[ReadStats() for _ in bands] for _ in range(n_scenes)]
+
+    def _read_chunk(i: int, j: int, region: Tuple[slice, ...], chunk) -> None:
+        callbacks = []
+        if progress_bar:
+            progress = DaskProgressCallback(progress_bar, chunk.nbytes)
+            callbacks = progress.callbacks
+        try:
+            # the threads of the reader provide the parallelism, hence each read is computed synchronously
+            with span("chunk_read", band=bands[j], scene=i) as s:
+                array[(i, *region, j)] = reader.read(
+                    lambda: np.asarray(chunk.compute(scheduler="synchronous", callbacks=callbacks)),
+                    band_stats[i][j],
+                    nbytes=chunk.nbytes,
+                )
+                s.add_bytes(chunk.nbytes)
+        except Exception as e:
+            if conf.READ_FAIL_ON_ERROR:
+                raise
+            log.error(f"⚠️  reading a chunk of {bands[j]} of scene {i} failed after retries, filling with nodata: {e!r}")
+        finally:
+            if progress_bar:
+                progress.finish()
+
+    def _read(i: int, j: int) -> None:
+        # the chunks of a band are read one after another, so that cog blocks which overlap several chunks are
+        # served from the gdal block cache instead of being fetched by concurrent reads again
+        for region, chunk in _iter_chunks(xarray[bands[j]].isel(time=i).data):
+            _read_chunk(i, j, region, chunk)
+
+    with ThreadPoolExecutor(max_workers=reader.max_workers) as pool:
+        pending = {
+            pool.submit(contextvars.copy_context().run, _read, i, j) for i in range(n_scenes) for j in range(len(bands))
+        }
+        while pending:
+            done, pending = wait(pending, timeout=conf.PROGRESS_MIN_UPDATE_INTERVAL)
+            for future in done:
+                future.result()
+            # progress is counted in the worker threads, but can only be displayed from this thread
+            if progress_bar:
+                progress_bar.refresh()
+
+    stats = [
+        ReadStats(**{key: sum(getattr(s, key) for s in scene_stats) for key in asdict(ReadStats())})
+        for scene_stats in band_stats
+    ]
+    return array, stats
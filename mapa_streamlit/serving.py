@@ -0,0 +1,241 @@
+import logging
+import mimetypes
+import re
+import secrets
+import threading
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import BinaryIO, Callable, Dict, Tuple, Union
+from urllib.parse import unquote, urlsplit
+
+from mapa_streamlit import conf
+from mapa_streamlit.metrics import render_metrics
+
+log = logging.getLogger(__name__)
+
+_RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+_LOOPBACK_HOSTS = ("localhost", "127.0.0.1", "::1")
+
+# downloads per session token and name, a session can only download the files it registered itself
+_downloads: Dict[Tuple[str, str], Callable[[], Path]] = {}
+_downloads_lock = threading.Lock()
+_build_locks: Dict[Tuple[str, str], threading.Lock] = {}
+_built: Dict[Tuple[str, str], Path] = {}
+
+_server: Union[ThreadingHTTPServer, None] = None
+_server_lock = threading.Lock()
+
+
+def new_download_session() -> str:
+    """Returns a new session token, the downloads a session registers are only served under its token."""
+    return secrets.token_urlsafe(16)
+
+
+def register_download(name: str, builder: Union[Path, Callable[[], Path]], session: str) -> str:
+    """Registers a file which can be downloaded from the local download server.
+
+    Parameters
+    ----------
+    name : str
+        Name under which the file will be served, e.g. `<geo_hash>.zip`.
+    builder : Union[Path, Callable[[], Path]]
+        Either the path to an existing file or a callable creating the file and returning its path. Callables are
+        only invoked once the file is requested for the first time, so archives are built on demand.
+    session : str
+        Token of the session registering the file, see `new_download_session`. The file is only served under it.
+
+    Returns
+    -------
+    str
+        URL under which the file can be downloaded.
+    """
+
+    if isinstance(builder, (str, Path)):
+        path = Path(builder)
+
+        def builder() -> Path:
+            return path
+
+    key = (session, name)
+    with _downloads_lock:
+        _downloads[key] = builder
+        _build_locks.setdefault(key, threading.Lock())
+        _built.pop(key, None)
+    log.debug(f"🔗  registered download: {name}")
+    return get_download_url(name, session)
+
+
+def is_download_registered(name: str, session: str) -> bool:
+    with _downloads_lock:
+        return (session, name) in _downloads
+
+
+def _resolve_download(name: str, session: str) -> Union[Path, None]:
+    key = (session, name)
+    with _downloads_lock:
+        builder = _downloads.get(key)
+        build_lock = _build_locks.get(key)
+    if builder is None:
+        return None
+
+    # concurrent requests for the same archive must not build it twice, a built file is only rebuilt if it got
+    # removed in the meantime, e.g. by the cleanup job
+    with build_lock:
+        path = _built.get(key)
+        if path is None or not path.is_file():
+            path = Path(builder())
+            _built[key] = path
+    return path if path.is_file() else None
+
+
+def open_download(name: str, session: str) -> BinaryIO:
+    """Opens the file registered by `session` under `name`, building it first if needed, e.g. to send it through
+    streamlit where the download server can't be reached, see `is_download_server_reachable`."""
+    path = _resolve_download(name, session)
+    if path is None:
+        raise FileNotFoundError(f"{name} was not registered for download")
+    return open(path, "rb")
+
+
+def _parse_range(header: str, size: int) -> Union[Tuple[int, int], None]:
+    """Returns the inclusive byte range of a `Range` header, None if the range can't be satisfied."""
+
+    match = _RANGE_PATTERN.match(header.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    start, end = match.groups()
+    if start == "":
+        # suffix range, e.g. "bytes=-500" requests the last 500 bytes
+        length = int(end)
+        if length == 0:
+            return None
+        return max(size - length, 0), size - 1
+    start = int(start)
+    end = size - 1 if end == "" else min(int(end), size - 1)
+    if start > end or start >= size:
+        return None
+    return start, end
+
+
+class _DownloadRequestHandler(BaseHTTPRequestHandler):
+    def do_HEAD(self) -> None:
+        self._serve(send_body=False)
+
+    def do_GET(self) -> None:
+        self._serve(send_body=True)
+
+    def _serve(self, send_body: bool) -> None:
+        name = unquote(self.path.split("?", 1)[0].lstrip("/"))
+        if name == "metrics":
+            self._serve_metrics(send_body)
+            return
+        if not name.startswith(conf.DOWNLOAD_URL_PREFIX):
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        session, _, name = name[len(conf.DOWNLOAD_URL_PREFIX) :].partition("/")
+        path = _resolve_download(name, session)
+        if path is None:
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+
+        size = path.stat().st_size
+        start, end = 0, size - 1
+        status = HTTPStatus.OK
+        range_header = self.headers.get("Range")
+        if range_header:
+            byte_range = _parse_range(range_header, size)
+            if byte_range is None:
+                self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            start, end = byte_range
+            status = HTTPStatus.PARTIAL_CONTENT
+
+        length = end - start + 1
+        self.send_response(status)
+        self.send_header("Content-Type", mimetypes.guess_type(name)[0] or "application/octet-stream")
+        self.send_header("Content-Length", str(length))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Disposition", f'attachment; filename="{name}"')
+        if status == HTTPStatus.PARTIAL_CONTENT:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+
+        if send_body:
+            with open(path, "rb") as f:
+                f.seek(start)
+                _copy_chunked(f, self.wfile, length)
+
+    def _serve_metrics(self, send_body: bool) -> None:
+        body = render_metrics().encode()
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        log.debug(f"🌐  {self.address_string()} {format % args}")
+
+
+def _copy_chunked(src, dst, length: int, chunk_size: int = None) -> None:
+    chunk_size = chunk_size or conf.DOWNLOAD_CHUNK_SIZE
+    remaining = length
+    while remaining > 0:
+        chunk = src.read(min(chunk_size, remaining))
+        if not chunk:
+            break
+        dst.write(chunk)
+        remaining -= len(chunk)
+
+
+def start_download_server(host: str = None, port: int = None) -> ThreadingHTTPServer:
+    """Starts the local download server in a daemon thread, if it is not running yet, and returns it. Besides the
+    registered downloads it serves the pipeline metrics under `/metrics`."""
+
+    global _server
+    with _server_lock:
+        if _server is None:
+            host = conf.DOWNLOAD_SERVER_HOST if host is None else host
+            port = conf.DOWNLOAD_SERVER_PORT if port is None else port
+            _server = ThreadingHTTPServer((host, port), _DownloadRequestHandler)
+            _server.daemon_threads = True
+            thread = threading.Thread(target=_server.serve_forever, name="mapa-download-server", daemon=True)
+            thread.start()
+            log.info(f"🌐  started download server on {host}:{_server.server_address[1]}")
+            if not conf.DOWNLOAD_SERVER_PUBLIC_URL:
+                log.warning(
+                    "⚠️  MAPA_DOWNLOAD_SERVER_PUBLIC_URL is not set, only browsers on this machine can reach the "
+                    "download server, others download through streamlit"
+                )
+        return _server
+
+
+def stop_download_server() -> None:
+    global _server
+    with _server_lock:
+        if _server is not None:
+            _server.shutdown()
+            _server.server_close()
+            _server = None
+
+
+def get_download_url(name: str, session: str) -> str:
+    host, port = start_download_server().server_address[:2]
+    base_url = conf.DOWNLOAD_SERVER_PUBLIC_URL or f"http://{host}:{port}"
+    return f"{base_url.rstrip('/')}/{conf.DOWNLOAD_URL_PREFIX}{session}/{name}"
+
+
+def is_download_server_reachable(client_host: Union[None, str]) -> bool:
+    """Whether a browser which reached the app under `client_host` (the `Host` header of its requests) can follow
+    links to the download server. Without `conf.DOWNLOAD_SERVER_PUBLIC_URL`, the links point to the address the server
+    is bound to, which only browsers on the same machine reach."""
+    if conf.DOWNLOAD_SERVER_PUBLIC_URL:
+        return True
+    hostname = urlsplit(f"//{client_host or ''}").hostname
+    return hostname in _LOOPBACK_HOSTS and conf.DOWNLOAD_SERVER_HOST in _LOOPBACK_HOSTS
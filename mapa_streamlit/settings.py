@@ -1,5 +1,5 @@
 from importlib.metadata import version
-from typing import Tuple
+from typing import Dict, Tuple, Union
 
 from mapa_streamlit import __version__
 
@@ -10,10 +10,16 @@ BTN_LABEL_CREATE_TIF = "Click to request data"
 BTN_LABEL_DOWNLOAD_TIFS = "Click to download .tifs"
 BTN_LABEL_DOWNLOAD_GIFS = "Click to download gif"
 
+# size of the request estimated ahead of submitting it, see `speculation.Speculation`
+ESTIMATE_CAPTION = "{items} scenes found, about {mb:.0f} MB to load"
+
 MAX_ALLOWED_AREA_SIZE = 25.0
 
 DISK_CLEANING_THRESHOLD = 60.0
 
+# number of fetched requests the results viewer keeps in memory, shared by all sessions
+RESULTS_CACHE_MAX_ENTRIES = 8
+
 
 
 DEFAULT_Z_OFFSET = 2
@@ -60,6 +66,51 @@ class SquaredCheckbox:
     )
 
 
+class OutputSelect:
+    label: str = "Select output"
+    # maps the displayed option to the `composite` method of `convert_bbox_to_tif`
+    options: Dict[str, Union[str, None]] = {
+        "One tif per scene": None,
+        "Median composite": "median",
+        "Mean composite": "mean",
+        "Least cloudy pixel composite": "min-cloud",
+    }
+    help: str = (
+        "Composites reduce all scenes of the date range into a single tif, leaving out clouds and cloud shadows. "
+        "This is a lot smaller to download than all scenes."
+    )
+
+
+class ClearSkySlider:
+    label: str = "Minimum clear sky over the area (%)"
+    min_value: int = 0
+    max_value: int = 100
+    value: int = 0
+    step: int = 5
+    help: str = (
+        "Scenes of which a smaller share of the selected area is free of clouds and cloud shadows are skipped before "
+        "downloading them. Unlike the cloud cover threshold, which applies to the whole scene, this is checked on the "
+        "selected area only. 0 keeps all scenes."
+    )
+
+
+class IndicesSelect:
+    label: str = "Compute indices"
+    help: str = (
+        "Instead of the selected bands, only the selected spectral indices are computed for each scene and written to "
+        "the tifs."
+    )
+
+
+class CustomIndexInput:
+    label: str = "Custom index"
+    placeholder: str = "ratio = B08 / B04"
+    help: str = (
+        "Band math in the form name = expression, over band names or common names like red, nir or swir16. "
+        "Supports + - * / **, numbers and the functions sqrt, abs, log, exp, min, max and clip."
+    )
+
+
 class TilingSelect:
     label: str = "Please ignore this!"#Split output STL file in multiple tiles?"
     options: Tuple[str] = (DEFAULT_TILING_FORMAT, "1x2", "2x1", "2x2", "2x3", "3x2", "3x3")
@@ -0,0 +1,204 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Dict, Iterable, Iterator, List, Tuple, Union
+from urllib.parse import parse_qs, parse_qsl, urlencode, urlparse
+
+from mapa_streamlit import conf
+from mapa_streamlit.metrics import span
+
+log = logging.getLogger(__name__)
+
+BLOB_STORAGE_DOMAIN = ".blob.core.windows.net"
+# thumbnails etc. are stored in a public container and must not be signed
+PUBLIC_ASSETS_ACCOUNT = "ai4edatasetspublicassets"
+# query parameters of SAS tokens, including those of user delegation tokens
+SAS_QUERY_PARAMETERS = set("sv ss srt sp se st spr sig sr si sdd skoid sktid skt ske sks skv saoid suoid scid".split())
+
+
+@dataclass(frozen=True)
+class SASToken:
+    token: str
+    expiry: datetime
+
+    def ttl(self) -> float:
+        """Returns the remaining lifetime of the token in seconds."""
+        return (self.expiry - datetime.now(timezone.utc)).total_seconds()
+
+    def sign(self, href: str) -> str:
+        separator = "&" if urlparse(href).query else "?"
+        return f"{href}{separator}{self.token}"
+
+
+def _parse_blob_href(href: str) -> Union[Tuple[str, str], None]:
+    """Returns the storage account and container of an Azure blob storage href, None if the href does not need to be
+    signed, e.g. because it is not pointing to blob storage or because it is already signed."""
+
+    parsed = urlparse(href)
+    if not parsed.netloc.endswith(BLOB_STORAGE_DOMAIN):
+        return None
+    account = parsed.netloc[: -len(BLOB_STORAGE_DOMAIN)]
+    if account == PUBLIC_ASSETS_ACCOUNT:
+        return None
+    if set(parse_qs(parsed.query)) & {"st", "se", "sp", "sig"}:
+        return None
+    container = parsed.path.lstrip("/").split("/", 1)[0]
+    return (account, container) if container else None
+
+
+def _parse_expiry(expiry: str) -> datetime:
+    return datetime.fromisoformat(expiry.replace("Z", "+00:00")).astimezone(timezone.utc)
+
+
+class TokenCache:
+    """Process wide cache of SAS tokens per storage container. Tokens are reused until they are about to expire,
+    concurrent lookups of the same container only trigger a single request to the token endpoint."""
+
+    def __init__(self) -> None:
+        self._tokens: Dict[Tuple[str, str], SASToken] = {}
+        self._locks: Dict[Tuple[str, str], threading.Lock] = {}
+        self._lock = threading.Lock()
+        self._session = None
+
+    def _get_session(self):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        with self._lock:
+            if self._session is None:
+                retry = Retry(
+                    total=conf.SAS_TOKEN_REQUEST_RETRIES,
+                    backoff_factor=0.8,
+                    status_forcelist=[429, 500, 502, 503, 504],
+                )
+                self._session = requests.Session()
+                self._session.mount("http://", HTTPAdapter(max_retries=retry))
+                self._session.mount("https://", HTTPAdapter(max_retries=retry))
+            return self._session
+
+    def _is_valid(self, token: Union[SASToken, None]) -> bool:
+        return token is not None and token.ttl() > conf.SAS_TOKEN_EXPIRY_MARGIN
+
+    def _request_token(self, account: str, container: str) -> SASToken:
+        headers = {}
+        subscription_key = os.getenv("PC_SDK_SUBSCRIPTION_KEY")
+        if subscription_key:
+            headers["Ocp-Apim-Subscription-Key"] = subscription_key
+        response = self._get_session().get(
+            f"{conf.PLANETARY_COMPUTER_SAS_URL.rstrip('/')}/{account}/{container}",
+            headers=headers,
+            timeout=conf.SAS_TOKEN_REQUEST_TIMEOUT,
+        )
+        response.raise_for_status()
+        body = response.json()
+        log.debug(f"🔑  requested sas token for {account}/{container}, expires at {body['msft:expiry']}")
+        return SASToken(token=body["token"], expiry=_parse_expiry(body["msft:expiry"]))
+
+    def get_token(self, account: str, container: str) -> SASToken:
+        key = (account, container)
+        with self._lock:
+            token = self._tokens.get(key)
+            if self._is_valid(token):
+                return token
+            lock = self._locks.setdefault(key, threading.Lock())
+
+        with lock:
+            # another thread might have refreshed the token while waiting for the lock
+            token = self._tokens.get(key)
+            if not self._is_valid(token):
+                token = self._request_token(account, container)
+                with self._lock:
+                    self._tokens[key] = token
+            return token
+
+    def get_tokens(self, containers: Iterable[Tuple[str, str]]) -> Dict[Tuple[str, str], SASToken]:
+        """Returns tokens for all given containers, requesting missing or expiring tokens concurrently."""
+
+        containers = set(containers)
+        if len(containers) <= 1:
+            return {key: self.get_token(*key) for key in containers}
+        with ThreadPoolExecutor(max_workers=min(len(containers), conf.SAS_TOKEN_REQUEST_WORKERS)) as pool:
+            return dict(zip(containers, pool.map(lambda key: self.get_token(*key), containers)))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._tokens.clear()
+
+
+TOKEN_CACHE = TokenCache()
+
+
+def sign_href(href: str) -> str:
+    """Signs a single href, can be used as `patch_url` for `odc.stac.stac_load`. Hrefs which are not pointing to
+    blob storage or which are already signed are returned unmodified."""
+
+    container = _parse_blob_href(href)
+    if container is None:
+        return href
+    return TOKEN_CACHE.get_token(*container).sign(href)
+
+
+def unsign_href(href: str) -> str:
+    """Removes the SAS token from a signed blob storage href, e.g. to store or key it independently of the token,
+    which expires. Any other href is returned unmodified."""
+
+    parsed = urlparse(href)
+    if not parsed.netloc.endswith(BLOB_STORAGE_DOMAIN) or not parsed.query:
+        return href
+    query = parse_qsl(parsed.query, keep_blank_values=True)
+    query = [(key, value) for key, value in query if key not in SAS_QUERY_PARAMETERS]
+    return parsed._replace(query=urlencode(query)).geturl()
+
+
+def _iter_asset_dicts(obj) -> Iterator[dict]:
+    """Yields the (mutable) asset dictionaries of a STAC item, collection or feature collection, given as dicts."""
+
+    if obj.get("type") == "FeatureCollection":
+        for feature in obj.get("features", []):
+            yield from _iter_asset_dicts(feature)
+        return
+    yield from obj.get("assets", {}).values()
+
+
+def _iter_assets(obj) -> Iterator:
+    from pystac import Collection, Item, ItemCollection
+
+    if isinstance(obj, dict):
+        yield from _iter_asset_dicts(obj)
+    elif isinstance(obj, ItemCollection):
+        for item in obj.items:
+            yield from item.assets.values()
+    elif isinstance(obj, (Item, Collection)):
+        yield from obj.assets.values()
+    else:
+        for item in obj:
+            yield from item.assets.values()
+
+
+def _get_href(asset) -> str:
+    return asset["href"] if isinstance(asset, dict) else asset.href
+
+
+def _set_href(asset, href: str) -> None:
+    if isinstance(asset, dict):
+        asset["href"] = href
+    else:
+        asset.href = href
+
+
+def sign_inplace(obj) -> None:
+    """Signs all asset hrefs of a STAC item, collection, item collection, list of items or the dictionary form of any
+    of them in place. The tokens of all storage containers involved are looked up once for the whole batch, which
+    makes this function suitable as `modifier` of `pystac_client.Client.open`."""
+
+    with span("sign") as s:
+        assets: List = [asset for asset in _iter_assets(obj) if _parse_blob_href(_get_href(asset))]
+        tokens = TOKEN_CACHE.get_tokens(_parse_blob_href(_get_href(asset)) for asset in assets)
+        for asset in assets:
+            href = _get_href(asset)
+            _set_href(asset, tokens[_parse_blob_href(href)].sign(href))
+        s.fields["assets"] = len(assets)
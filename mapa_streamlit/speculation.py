@@ -0,0 +1,187 @@
+import contextvars
+import logging
+import os
+import threading
+from typing import TYPE_CHECKING, List, Union
+
+from mapa_streamlit import conf
+from mapa_streamlit.clouds import MASK_BANDS
+from mapa_streamlit.grid import estimate_read_bytes, plan_read
+from mapa_streamlit.io import remote_io_env
+from mapa_streamlit.ledger import Ledger, get_ledger_key, get_uncovered_date_ranges
+from mapa_streamlit.metrics import request_context, span
+from mapa_streamlit.stac import get_patch_url, iter_stac_item_pages
+from mapa_streamlit.utils import TMPDIR
+
+if TYPE_CHECKING:
+    from pystac import ItemCollection
+
+log = logging.getLogger(__name__)
+
+
+def _lower_priority() -> None:
+    # threads are scheduled as tasks of their own on linux, hence this only lowers the priority of the calling thread
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), conf.SPECULATION_NICENESS)
+    except (AttributeError, OSError) as e:
+        log.debug(f"🐢  could not lower the priority of the speculation: {e}")
+
+
+class Speculation:
+    """Work of a request which can be done before the user actually submits it: the STAC search (which signs the
+    items and stores the results, see `items.ItemStore`), the estimation of the size of the pixels to load (see
+    `grid.estimate_read_bytes`) and reading the COG headers of the first items through the block cache, if it is
+    enabled (see `blockcache.with_block_cache`), or into the GDAL cache otherwise. It runs in a background thread with
+    lowered priority, after `conf.SPECULATION_DELAY` seconds in which it is likely to be superseded by further
+    changes, and stops at the next step once cancelled. The submitted request picks up the results from the item store
+    and the block cache."""
+
+    def __init__(
+        self,
+        geometry: dict,
+        user_defined_collection: str,
+        user_defined_bands: List[str],
+        date_range: str,
+        cloud_cover_percentage_value: int,
+        min_clear_fraction: float = 0,
+    ) -> None:
+        self.request = dict(
+            geometry=geometry,
+            user_defined_collection=user_defined_collection,
+            user_defined_bands=list(user_defined_bands),
+            date_range=date_range,
+            cloud_cover_percentage_value=cloud_cover_percentage_value,
+            min_clear_fraction=min_clear_fraction,
+        )
+        self.items = None
+        self.estimated_bytes: Union[None, int] = None
+        self.cancelled = threading.Event()
+        self.searched = threading.Event()
+        self.done = threading.Event()
+        # the stage runs with the context of the caller, e.g. to log with the same request id
+        context = contextvars.copy_context()
+        self._thread = threading.Thread(target=context.run, args=(self._run,), name="mapa-speculation", daemon=True)
+
+    def start(self) -> "Speculation":
+        self._thread.start()
+        return self
+
+    def cancel(self) -> None:
+        self.cancelled.set()
+
+    def pick_up(self, timeout: float = None) -> bool:
+        """Waits for the search of the speculation, so that the submitted request answers it from the stored results
+        instead of searching again, and stops the remaining header reads, which the request does itself.
+
+        Returns
+        -------
+        bool
+            Whether the search finished within `timeout` seconds, by default `conf.SPECULATION_PICKUP_TIMEOUT`.
+        """
+        searched = self.searched.wait(conf.SPECULATION_PICKUP_TIMEOUT if timeout is None else timeout)
+        self.cancel()
+        return searched and self.items is not None
+
+    def _get_date_ranges(self) -> List[str]:
+        # date ranges which were fetched for the same aoi and parameters before are not searched again by the request
+        request = self.request
+        key = get_ledger_key(
+            request["user_defined_collection"],
+            request["user_defined_bands"],
+            request["geometry"],
+            request["cloud_cover_percentage_value"],
+            min_clear_fraction=request["min_clear_fraction"],
+        )
+        return get_uncovered_date_ranges(request["date_range"], Ledger(TMPDIR()).get(key).covered)
+
+    def _search(self) -> Union[None, "ItemCollection"]:
+        from pystac import ItemCollection
+
+        request = self.request
+        items = []
+        for date_range in self._get_date_ranges():
+            # the screening reads pixels, it is left to the request
+            pages = iter_stac_item_pages(
+                request["user_defined_collection"],
+                request["geometry"],
+                date_range,
+                request["cloud_cover_percentage_value"],
+                min_clear_fraction=0,
+            )
+            for page in pages:
+                if self.cancelled.is_set():
+                    # the results of an unfinished search are not stored
+                    pages.close()
+                    return None
+                items += page.items
+        return ItemCollection(items)
+
+    def _read_headers(self, items: "ItemCollection") -> None:
+        import rasterio
+
+        request = self.request
+        bands = request["user_defined_bands"]
+        if request["min_clear_fraction"] and MASK_BANDS.get(request["user_defined_collection"]):
+            bands = bands + [MASK_BANDS[request["user_defined_collection"]]]
+        patch_url = get_patch_url(items)
+        if conf.READ_GRID == "source":
+            # reads the block shape of the cogs, see `grid.get_block_shape`
+            plan_read(items, request["geometry"], bands, patch_url=patch_url)
+        # the items are loaded in the order of the search
+        for item in items.items[: conf.SPECULATION_MAX_ITEMS]:
+            for band in bands:
+                if self.cancelled.is_set():
+                    return
+                if band not in item.assets:
+                    continue
+                href = item.assets[band].href
+                try:
+                    with rasterio.open(patch_url(href) if patch_url else href):
+                        pass
+                except Exception as e:
+                    log.debug(f"🔮  could not read the header of {band} of {item.id} ahead: {e}")
+
+    def _run(self) -> None:
+        _lower_priority()
+        try:
+            # changes of the drawing or the parameters in quick succession only start the last speculation
+            if self.cancelled.wait(conf.SPECULATION_DELAY):
+                return
+            with request_context(), remote_io_env(), span("speculation") as s:
+                self.items = self._search()
+                self.searched.set()
+                if self.items is None:
+                    return
+                s.fields["items"] = len(self.items)
+                log.debug(f"🔮  found {len(self.items)} stac items ahead of the request")
+                if self.request["user_defined_bands"]:
+                    self.estimated_bytes = estimate_read_bytes(
+                        self.items, self.request["geometry"], self.request["user_defined_bands"]
+                    )
+                self._read_headers(self.items)
+        except Exception as e:
+            # the request runs into the same error and reports it
+            log.debug(f"🔮  speculation failed: {e}")
+        finally:
+            self.searched.set()
+            self.done.set()
+
+
+def speculate(previous: Union[None, Speculation], geometry: dict, **request) -> Union[None, Speculation]:
+    """Starts a `Speculation` of the request for `geometry`, unless `previous` speculates on the same request already.
+    `previous` is cancelled otherwise, as it was superseded by a new drawing or changed parameters.
+
+    Returns
+    -------
+    Union[None, Speculation]
+        None if `conf.SPECULATION` is disabled.
+    """
+    speculation = Speculation(geometry, **request)
+    if previous is not None:
+        # a speculation of the same request was picked up by it already, if it was cancelled
+        if previous.request == speculation.request:
+            return previous
+        previous.cancel()
+    if not conf.SPECULATION:
+        return None
+    return speculation.start()
@@ -1,31 +1,39 @@
 import logging
-import warnings
-from pydantic import PydanticDeprecatedSince20
+from dataclasses import asdict
 from pathlib import Path
-from typing import List, Tuple, Union
-from odc.stac import stac_load
-import rasterio as rio
-import pandas as pd
-import numpy as np
-import rioxarray
-from pathlib import Path
-from geogif import dgif
+from typing import Callable, Dict, Iterator, List, Tuple, Union
+
 import geojson
-import stackstac
-import requests
 
 from mapa_streamlit import conf
+from mapa_streamlit.blockcache import with_block_cache
+from mapa_streamlit.cache import atomic_write, file_lock
+from mapa_streamlit.catalog import STAC_API, get_catalog, normalize_sortby
+from mapa_streamlit.clouds import MASK_BANDS, get_clear_fractions
 from mapa_streamlit.exceptions import NoSTACItemFound
-from mapa_streamlit.utils import ProgressBar
-import pystac_client
+from mapa_streamlit.geometry import is_rectangle, mask_outside_geometry
+from mapa_streamlit.grid import get_anchor, plan_read
+from mapa_streamlit.indices import add_indices
+from mapa_streamlit.items import ItemStore, ItemTable, get_search_key, get_solar_day
+from mapa_streamlit.io import are_stac_items_planetary_computer, get_stackstac_gdal_env, remote_io_env
+from mapa_streamlit.ledger import (
+    Ledger,
+    LedgerEntry,
+    add_covered_date_range,
+    clip_covered_date_ranges,
+    get_ledger_key,
+    get_uncovered_date_ranges,
+)
+from mapa_streamlit.metrics import request_context, span
+from mapa_streamlit.reads import read_dataset
+from mapa_streamlit.signing import sign_href
+from mapa_streamlit.utils import TMPDIR, ProgressBar, prefetch_iterator
 
-with warnings.catch_warnings():
-    warnings.filterwarnings("ignore", category=PydanticDeprecatedSince20)
-    import planetary_computer
+log = logging.getLogger(__name__)
 
-from mapa_streamlit.io import are_stac_items_planetary_computer
 
-log = logging.getLogger(__name__)
+# The geospatial stack (odc-stac, rasterio, xarray, pandas, ...) takes more than a second to import. It is imported
+# at first use in the functions below, so that importing mapa_streamlit stays cheap for streamlit workers and tests.
 
 def _bbox(coord_list):
     box = []
@@ -36,11 +44,23 @@ def _bbox(coord_list):
 
 
 def _turn_geojson_into_bbox(geojson_bbox: dict) -> List[float]:
-    coordinates = geojson_bbox["coordinates"]
-    return _bbox(list(geojson.utils.coords(geojson.Polygon(coordinates))))
-
+    return _bbox(list(geojson.utils.coords(geojson_bbox)))
+
+
+def save_images_from_xarr(
+    xarray,
+    filepath,
+    bands: list,
+    collection: str,
+    datatype="float32",
+    progress_bar: Union[None, ProgressBar] = None,
+    nodata: float = 0,
+):
+    import numpy as np
+    import pandas as pd
+    import rasterio as rio
+    import rioxarray  # noqa: F401, registers the `.rio` accessor
 
-def save_images_from_xarr(xarray, filepath, bands:list, collection:str, datatype="float32"):
     count=len(bands)
     paths=[]
     xarray.rio.set_crs(int(xarray.spatial_ref.values))
@@ -54,10 +74,19 @@ def save_images_from_xarr(xarray, filepath, bands:list, collection:str, datatype
         "height": height,
         "count": count,
         "dtype": datatype,
-        "nodata": 0, 
+        "nodata": nodata,
     }
 
-    array = np.stack([xarray[b].values for b in bands], axis=-1)
+    # progress is measured in bytes read from remote and bytes written to the tifs
+    write_bytes = xarray.sizes["time"] * width * height * count * np.dtype(datatype).itemsize
+    if progress_bar:
+        progress_bar.add_work(sum(xarray[b].nbytes for b in bands) + write_bytes)
+
+    # failed or slow chunk reads are retried and hedged, the counts per scene end up in the tif metadata
+    with span("compute", scenes=xarray.sizes["time"], bands=len(bands)) as s:
+        array, read_stats = read_dataset(xarray, bands, progress_bar=progress_bar)
+        s.add_bytes(array.nbytes)
+    xarray.attrs["read_stats"] = [asdict(stats) for stats in read_stats]
     key = {i: bands[i] for i in range(len(bands))}
 
     for i, arr in enumerate(array):
@@ -66,19 +95,22 @@ def save_images_from_xarr(xarray, filepath, bands:list, collection:str, datatype
             .to_pydatetime()
             .strftime("%Y-%m-%d_%H-%M-%S")
             + ".tif")
-        with rio.open(
-        filepath/filename,
-        "w",
-        **meta,
-        ) as dst:
-            for j in range(meta["count"]):
-                dst.write(arr[:, :, j], j + 1)
-                dst.set_band_description(j+1,key[j])   
-
-                paths.append(filepath/filename)
+        with span("geotiff_write", file=str(filename)) as s, atomic_write(filepath/filename) as tmp_path:
+            with rio.open(tmp_path, "w", **meta) as dst:
+                dst.update_tags(**read_stats[i].as_tags())
+                for j in range(meta["count"]):
+                    dst.write(arr[:, :, j], j + 1)
+                    dst.set_band_description(j+1,key[j])   
+
+                    paths.append(filepath/filename)
+            s.add_bytes(arr.size * np.dtype(datatype).itemsize)
+        if progress_bar:
+            progress_bar.step(arr.size * np.dtype(datatype).itemsize)
     return paths,array
 
 def get_mtl_metadata(items,filepath):
+    import requests
+
     paths=[]
     for count,item in enumerate(items):
         assets=items[count].assets.items()
@@ -86,88 +118,590 @@ def get_mtl_metadata(items,filepath):
         xml=dict_assets.get('mtl.xml')
 
         mtl_xml_url = xml.href
-        response = requests.get(mtl_xml_url)
+        with span("mtl_download", item=item.id) as s:
+            response = requests.get(mtl_xml_url)
+            s.add_bytes(len(response.content))
 
         if response.status_code == 200:
             filename=f'mtl_{item.id}.xml'
-            print("##################################################### ", filename)
-            with open(filepath/filename, 'wb') as f:
-                f.write(response.content)
-                paths.append(filepath/filename)
-            print("----------------------------------------------------- ",paths)
+            with atomic_write(filepath/filename) as tmp_path:
+                tmp_path.write_bytes(response.content)
+            paths.append(filepath/filename)
         else:
-            print("Failed to download:", response.status_code)
+            log.warning(f"⚠️  failed to download mtl.xml of {item.id}: {response.status_code}")
     return paths
-def fetch_stac_items_for_bbox(
-    user_defined_bands:list, user_defined_collection:str, geojson: dict, allow_caching: bool, cache_dir: Path, date_range:str, cloud_cover_percentage_value:int, progress_bar: Union[None, ProgressBar] = None, 
-) -> Tuple:
-    
-    items = search_stac_for_items(user_defined_collection, geojson,date_range,cloud_cover_percentage_value)
 
+
+def get_patch_url(items) -> Union[None, Callable[[str], str]]:
+    """Returns the hook all asset hrefs of `items` are read through: signing planetary computer hrefs and the block
+    cache, see `blockcache.with_block_cache`."""
+    # items are signed in batches when searching, sign_href only signs hrefs which are not signed yet
     patch_url = None
     if are_stac_items_planetary_computer(items):
-        patch_url = planetary_computer.sign
-
-        xx=stac_load(
+        patch_url = sign_href
+    if conf.BLOCK_CACHE_MAX_BYTES > 0:
+        patch_url = with_block_cache(patch_url)
+    return patch_url
+
+
+def _load_items(
+    items,
+    geojson: dict,
+    geobox=None,
+    chunks: dict = None,
+    bands: List[str] = None,
+    resolution: float = None,
+    groupby: str = "solar_day",
+):
+    from odc.stac import stac_load
+
+    patch_url = get_patch_url(items)
+    # later pages are loaded onto the grid of the first page, so that all pages can be concatenated
+    grid = {"geopolygon": geojson} if geobox is None else {"geobox": geobox}
+    # the grid covers the bbox of polygon aois, pixels outside of them are masked without reading their chunks
+    rectangle = is_rectangle(geojson)
+    if chunks is None and not rectangle:
+        chunks = {"x": conf.POLYGON_CHUNK_SIZE, "y": conf.POLYGON_CHUNK_SIZE}
+    resampling = "bilinear"
+    with span("plan", items=len(items)):
+        plan = None
+        if conf.READ_GRID == "source" and resolution is None:
+            plan = plan_read(items, geojson, bands, geobox=geobox, chunks=chunks, patch_url=patch_url)
+        if plan is not None:
+            grid, chunks, resampling = {"geobox": plan.geobox}, plan.chunks, conf.READ_GRID_RESAMPLING
+        xx = stac_load(
             items,
-            geopolygon=geojson,
-            chunks={},  # <-- use Dask
-            groupby= "solar_day",
+            chunks={} if chunks is None else chunks,  # <-- use Dask
+            groupby=groupby,
+            bands=bands,
+            resolution=resolution,
             patch_url=patch_url,
-            resampling="bilinear",
-            fail_on_error=False,
-            no_data=0
+            # classification bands like SCL or qa_pixel must not be interpolated
+            resampling={"*": resampling, **{band: "nearest" for band in conf.NEAREST_RESAMPLING_BANDS}},
+            fail_on_error=True,  # failed reads are retried by the reader, see `read_dataset`
+            no_data=0,
+            **grid,
         )
-    
-   
-    n = len(items)
-    if progress_bar:
-        progress_bar.steps += n
-    if n > 0:
-        log.info(f"⬇️  fetching {n} stac items...")
-        
-        tif_paths,array=save_images_from_xarr(xx,cache_dir,user_defined_bands,user_defined_collection)
+        if plan is not None:
+            # the blocks around the aoi are cropped lazily, chunks stay aligned to the blocks
+            xx = xx.isel(dict(zip(xx.odc.spatial_dims, plan.roi)))
+        if not rectangle:
+            xx = mask_outside_geometry(xx, geojson)
+    return xx
+
+
+def screen_items(items, user_defined_collection: str, geojson: dict, min_clear_fraction: float):
+    """Drops the items of which less than `min_clear_fraction` of the AOI pixels they observe are clear, before all
+    of their bands are loaded. Only the mask band (SCL or qa_pixel, see `clouds.MASK_BANDS`) is read, at the coarse
+    `conf.SCREENING_RESOLUTION`, so that the reads are served from the overviews of the COGs. Items without a mask
+    band and items of which the mask couldn't be read are kept."""
+    import xarray as xr
+    from pystac import ItemCollection
+
+    band = MASK_BANDS.get(user_defined_collection)
+    screened = [item for item in items if band in item.assets]
+    if not min_clear_fraction or not screened:
+        return items
+    with remote_io_env(), span("screen", items=len(screened)) as s:
+        # grouped by item instead of by solar day, so that each item is judged on its own
+        xx = _load_items(
+            ItemCollection(screened), geojson, bands=[band], resolution=conf.SCREENING_RESOLUTION, groupby="id"
+        )
+        array, stats = read_dataset(xx, [band])
+        s.add_bytes(array.nbytes)
+        fractions = get_clear_fractions(xr.Dataset({band: (xx[band].dims, array[..., 0])}), user_defined_collection)
+        dropped = {
+            item.id
+            for item, fraction, scene_stats in zip(screened, fractions.values, stats)
+            if fraction < min_clear_fraction and not scene_stats.errors
+        }
+        s.fields["dropped"] = len(dropped)
+    if dropped:
+        log.info(
+            f"☁️  dropping {len(dropped)} of {len(items)} stac items with less than {min_clear_fraction:.0%} clear "
+            "pixels over the aoi"
+        )
+    return ItemCollection([item for item in items if item.id not in dropped])
+
+
+def _get_solar_day(item) -> str:
+    """Returns the solar day of `item`, see `items.get_solar_day`."""
+    return get_solar_day(item.datetime or item.common_metadata.start_datetime, item.bbox)
+
+
+def _iter_solar_day_batches(pages: Iterator[ItemTable], sorted_by_time: bool) -> Iterator[ItemTable]:
+    """Regroups `pages` of items into batches of whole solar days, so that all tiles of a day are loaded, and fused
+    into one scene, together. With `sorted_by_time` the items of the latest day are held back until a page with a
+    later day arrives, otherwise all pages are buffered into a single batch."""
+    pending = []
+    for page in pages:
+        pending.append(page)
+        if not sorted_by_time:
+            continue
+        batch = ItemTable.concat(pending)
+        days = set(batch.solar_days)
+        if len(days) > 1:
+            last_day = max(days)
+            pending = [batch.filter(solar_days=[last_day])]
+            yield batch.filter(solar_days=days - {last_day})
+        else:
+            pending = [batch]
+    batch = ItemTable.concat(pending)
+    if len(batch):
+        yield batch
 
-        if user_defined_collection=='landsat-c2-l2':
-            mtl_paths = get_mtl_metadata(items,cache_dir)
-            paths_to_data=tif_paths+mtl_paths
 
-        else: 
-            paths_to_data= tif_paths
+def _drop_already_loaded_days(xx, loaded_days: set):
+    """Removes the scenes of solar days which are part of the output already, e.g. of an existing datacube."""
+    import numpy as np
+    import pandas as pd
 
-        
-        if progress_bar:
-            progress_bar.step()
-        print("######",paths_to_data)
-        return paths_to_data, array, xx
-    else:
-        raise NoSTACItemFound("Could not find the desired STAC item for the given bounding box and date range.")
+    days = pd.to_datetime(xx.time.values).strftime("%Y-%m-%d")
+    keep = np.flatnonzero([day not in loaded_days for day in days])
+    loaded_days.update(days)
+    return xx.isel(time=keep)
 
-def search_stac_for_items(user_defined_collection, geojson,date_range,cloud_cover_percentage_value):
-    bbox = _turn_geojson_into_bbox(geojson)
-    
-    catalog = pystac_client.Client.open(
-        conf.PLANETARY_COMPUTER_API_URL,
-        modifier=planetary_computer.sign_inplace,
+
+@request_context()
+def fetch_stac_items_for_bbox(
+    user_defined_bands: list,
+    user_defined_collection: str,
+    geojson: dict,
+    allow_caching: bool,
+    cache_dir: Path,
+    date_range: str,
+    cloud_cover_percentage_value: int,
+    progress_bar: Union[None, ProgressBar] = None,
+    max_items: Union[None, int] = None,
+    indices: Union[None, Dict[str, str]] = None,
+    min_clear_fraction: Union[None, float] = None,
+) -> Tuple:
+    """Fetches the STAC items for `geojson` and writes one tif per solar day with the `user_defined_bands` to
+    `cache_dir`. With `indices`, a mapping of index name to band math expression (see `indices.resolve_indices`), the
+    tifs only contain the index bands instead, computed chunk by chunk from the bands they need. Items of which less
+    than `min_clear_fraction` of the AOI is clear are dropped beforehand, see `screen_items`."""
+    import numpy as np
+    import xarray as xr
+    from pystac import ItemCollection
+
+    # the `max_items` least cloudy items can't be extended incrementally, as they depend on the whole date range
+    if allow_caching and max_items is None:
+        return _fetch_stac_items_incrementally(
+            user_defined_bands,
+            user_defined_collection,
+            geojson,
+            cache_dir,
+            date_range,
+            cloud_cover_percentage_value,
+            progress_bar,
+            indices=indices,
+            min_clear_fraction=min_clear_fraction,
+        )
+    output_bands = list(indices) if indices else user_defined_bands
+    # 0 is a valid index value
+    nodata = float("nan") if indices else 0
+
+    pages = prefetch_iterator(
+        iter_stac_item_pages(
+            user_defined_collection,
+            geojson,
+            date_range,
+            cloud_cover_percentage_value,
+            max_items=max_items,
+            min_clear_fraction=min_clear_fraction,
+        ),
+        depth=conf.STAC_SEARCH_PREFETCH_PAGES,
     )
 
-    search = catalog.search(
+    # pixels of the first days are loaded and written while the following pages are still being searched
+    items, datasets, arrays, tif_paths = [], [], [], []
+    geobox = None
+    with remote_io_env():
+        for page in pages:
+            log.info(f"⬇️  fetching {len(page.items)} stac items...")
+            items += page.items
+            xx = _load_items(page, geojson, geobox)
+            geobox = xx.odc.geobox if geobox is None else geobox
+            if indices:
+                xx = add_indices(xx, indices, user_defined_collection)
+            paths, array = save_images_from_xarr(
+                xx, cache_dir, output_bands, user_defined_collection, progress_bar=progress_bar, nodata=nodata
+            )
+            datasets.append(xx)
+            arrays.append(array)
+            tif_paths += paths
+
+    if not items:
+        raise NoSTACItemFound("Could not find the desired STAC item for the given bounding box and date range.")
+
+    if user_defined_collection == "landsat-c2-l2":
+        paths_to_data = tif_paths + get_mtl_metadata(ItemCollection(items), cache_dir)
+    else:
+        paths_to_data = tif_paths
+
+    log.debug(f"🗂  fetched files: {paths_to_data}")
+    xx = datasets[0] if len(datasets) == 1 else xr.concat(datasets, dim="time").sortby("time")
+    return paths_to_data, np.concatenate(arrays, axis=0), xx
+
+
+def _clip_covering_entry(
+    covering: Tuple[str, LedgerEntry],
+    geojson: dict,
+    date_range: str,
+    output_bands: list,
+    user_defined_collection: str,
+    scene_dir: Path,
+    nodata: float,
+) -> LedgerEntry:
+    """Starts a ledger entry for `geojson` from the `covering` entry of an AOI which contains it, see
+    `Ledger.find_covering`. The scenes of `covering` within `date_range` are clipped with windowed reads of its tifs,
+    on their grid, and the covered day ranges are taken over, so that only the remaining ones are fetched."""
+    import numpy as np
+    import pandas as pd
+    import rasterio as rio
+    import xarray as xr
+    from odc.geo.geobox import GeoBox
+    from odc.geo.geom import Geometry
+    from odc.geo.xr import xr_coords
+    from rasterio.windows import Window
+
+    key, source = covering
+    entry = LedgerEntry(
+        covered=clip_covered_date_ranges(source.covered, date_range),
+        metadata={path: source.metadata[path] for path in source.get_metadata(date_range)},
+    )
+    scenes = source.get_scenes(date_range)
+    log.info(f"🗺  aoi is within the aoi of ledger entry {key}, clipping {len(scenes)} scenes from its tifs")
+    if not scenes:
+        return entry
+    arrays = []
+    with span("geotiff_read", files=len(scenes)) as s:
+        for scene in scenes:
+            with rio.open(scene["paths"][0]) as src:
+                geobox = GeoBox((src.height, src.width), src.transform, src.crs.to_wkt())
+                # the grid a fresh fetch of the aoi would be loaded onto, see `_load_items`, anchored like the tifs
+                aoi_geobox = GeoBox.from_geopolygon(
+                    Geometry(geojson, crs="EPSG:4326"),
+                    resolution=geobox.resolution,
+                    crs=geobox.crs,
+                    anchor=get_anchor(src.transform),
+                )
+                roi = geobox.overlap_roi(aoi_geobox)
+                arrays.append(src.read(window=Window.from_slices(*roi)).transpose(1, 2, 0))
+                s.add_bytes(arrays[-1].nbytes)
+    array = np.stack(arrays)
+    xx = xr.Dataset(
+        {band: (("time", "y", "x"), array[..., j]) for j, band in enumerate(output_bands)},
+        coords={"time": pd.to_datetime([scene["datetime"] for scene in scenes]), **xr_coords(geobox[roi])},
+    )
+    if not is_rectangle(geojson):
+        xx = mask_outside_geometry(xx, geojson, nodata=nodata)
+    paths, _ = save_images_from_xarr(xx, scene_dir, output_bands, user_defined_collection, nodata=nodata)
+    for time, path in zip(pd.to_datetime(xx.time.values), dict.fromkeys(paths)):
+        entry.add_scene(time.strftime("%Y-%m-%d"), time.to_pydatetime(), [path])
+    return entry
+
+
+def _fetch_stac_items_incrementally(
+    user_defined_bands: list,
+    user_defined_collection: str,
+    geojson: dict,
+    cache_dir: Path,
+    date_range: str,
+    cloud_cover_percentage_value: int,
+    progress_bar: Union[None, ProgressBar] = None,
+    indices: Union[None, Dict[str, str]] = None,
+    min_clear_fraction: Union[None, float] = None,
+) -> Tuple:
+    """Like `fetch_stac_items_for_bbox`, but only the parts of `date_range` which were not searched for the same
+    collection, bands (or indices), AOI, cloud cover and clear fraction before are searched and only new items are
+    loaded, see `Ledger`. The tifs are written to a subdirectory of `cache_dir` per ledger key, on the grid of the
+    first fetch. An AOI within the AOI of another entry starts from the scenes of that entry, clipped from its tifs
+    without any network requests. The scenes within `date_range` are then read back from the tifs, hence the returned
+    dataset is held in memory."""
+    import numpy as np
+    import pandas as pd
+    import rasterio as rio
+    import xarray as xr
+    from odc.geo.geobox import GeoBox
+    from odc.geo.xr import xr_coords
+    from pystac import ItemCollection
+
+    output_bands = list(indices) if indices else user_defined_bands
+    # 0 is a valid index value
+    nodata = float("nan") if indices else 0
+    # indices are part of the key with their expressions, so that redefining an index doesn't return stale tifs
+    key_bands = [f"{name}={expression}" for name, expression in indices.items()] if indices else user_defined_bands
+    min_clear_fraction = conf.SCREENING_MIN_CLEAR_FRACTION if min_clear_fraction is None else min_clear_fraction
+    key = get_ledger_key(
+        user_defined_collection, key_bands, geojson, cloud_cover_percentage_value, min_clear_fraction=min_clear_fraction
+    )
+    scene_dir = Path(cache_dir) / key
+    scene_dir.mkdir(parents=True, exist_ok=True)
+    # replicas sharing the cache directory wait for each other instead of fetching the same scenes, the entry is
+    # read once the lock is held so that scenes materialized in the meantime are not fetched again
+    with file_lock(scene_dir):
+        ledger = Ledger(cache_dir)
+        entry = ledger.get(key)
+        search = {
+            "collection": user_defined_collection,
+            "bands": key_bands,
+            "cloud_cover": cloud_cover_percentage_value,
+            "min_clear_fraction": min_clear_fraction,
+        }
+        if not entry.covered:
+            covering = ledger.find_covering(search, geojson, date_range)
+            if covering is not None:
+                entry = _clip_covering_entry(
+                    covering, geojson, date_range, output_bands, user_defined_collection, scene_dir, nodata
+                )
+        entry.search, entry.geometry = search, geojson
+
+        geobox = None
+        if entry.scenes:
+            with rio.open(next(iter(entry.scenes.values()))["paths"][0]) as src:
+                geobox = GeoBox((src.height, src.width), src.transform, src.crs.to_wkt())
+        seen = set(entry.items)
+        date_ranges = get_uncovered_date_ranges(date_range, entry.covered)
+        log.info(f"📒  {len(entry.scenes)} scenes materialized already, searching {date_ranges}")
+
+        with remote_io_env():
+            for uncovered_date_range in date_ranges:
+                pages = prefetch_iterator(
+                    _iter_stac_item_tables(
+                        user_defined_collection, geojson, uncovered_date_range, cloud_cover_percentage_value
+                    ),
+                    depth=conf.STAC_SEARCH_PREFETCH_PAGES,
+                )
+                for page in pages:
+                    # days of which items were published after they were materialized are loaded again, with the
+                    # items materialized before, so that all tiles of the day end up in its scene. Items are only
+                    # created and screened for those days
+                    page = page.filter(solar_days=page.filter(exclude_ids=seen).solar_days)
+                    if not len(page):
+                        continue
+                    items = page.to_items()
+                    if min_clear_fraction:
+                        items = screen_items(items, user_defined_collection, geojson, min_clear_fraction)
+                    new_items = [item for item in items if item.id not in seen]
+                    new_days = {_get_solar_day(item) for item in new_items}
+                    items = ItemCollection([item for item in items if _get_solar_day(item) in new_days])
+                    if not items.items:
+                        continue
+                    log.info(f"⬇️  fetching {len(items)} stac items of {len(new_days)} new or updated days...")
+                    seen.update(item.id for item in new_items)
+                    entry.items += [item.id for item in new_items]
+                    if user_defined_collection == "landsat-c2-l2":
+                        for item in new_items:
+                            day = (item.datetime or item.common_metadata.start_datetime).date().isoformat()
+                            entry.metadata.update({str(path): day for path in get_mtl_metadata([item], scene_dir)})
+
+                    xx = _load_items(items, geojson, geobox)
+                    geobox = xx.odc.geobox if geobox is None else geobox
+                    if xx.time.size:
+                        if indices:
+                            xx = add_indices(xx, indices, user_defined_collection)
+                        paths, _ = save_images_from_xarr(
+                            xx,
+                            scene_dir,
+                            output_bands,
+                            user_defined_collection,
+                            progress_bar=progress_bar,
+                            nodata=nodata,
+                        )
+                        for time, path in zip(pd.to_datetime(xx.time.values), dict.fromkeys(paths)):
+                            entry.add_scene(time.strftime("%Y-%m-%d"), time.to_pydatetime(), [path])
+                    # recorded after every page, so that an interrupted fetch doesn't load the same items again
+                    ledger.put(key, entry)
+        entry.covered = add_covered_date_range(entry.covered, date_range)
+        ledger.put(key, entry)
+
+    scenes = entry.get_scenes(date_range)
+    if not scenes:
+        raise NoSTACItemFound("Could not find the desired STAC item for the given bounding box and date range.")
+    tif_paths = [Path(path) for scene in scenes for path in scene["paths"]]
+    arrays = []
+    with span("geotiff_read", files=len(tif_paths)):
+        for path in tif_paths:
+            with rio.open(path) as src:
+                arrays.append(src.read().transpose(1, 2, 0))
+                geobox = GeoBox((src.height, src.width), src.transform, src.crs.to_wkt())
+    array = np.stack(arrays)
+    xx = xr.Dataset(
+        {band: (("time", "y", "x"), array[..., j]) for j, band in enumerate(output_bands)},
+        coords={"time": pd.to_datetime([scene["datetime"] for scene in scenes]), **xr_coords(geobox)},
+    )
+    paths_to_data = tif_paths + [Path(path) for path in entry.get_metadata(date_range)]
+    log.debug(f"🗂  fetched files: {paths_to_data}")
+    return paths_to_data, array, xx
+
+
+def load_stac_items_for_bbox(
+    user_defined_collection: str,
+    geojson: dict,
+    date_range: str,
+    cloud_cover_percentage_value: int,
+    max_items: Union[None, int] = None,
+    chunks: dict = None,
+    min_clear_fraction: Union[None, float] = None,
+) -> Tuple[list, object]:
+    """Searches the STAC items for `geojson` and lazily loads all of them onto one grid, one scene per solar day.
+
+    Returns
+    -------
+    Tuple[list, xarray.Dataset]
+        The found STAC items and the dask backed dataset of the scenes.
+    """
+    import xarray as xr
+
+    pages = prefetch_iterator(
+        iter_stac_item_pages(
+            user_defined_collection,
+            geojson,
+            date_range,
+            cloud_cover_percentage_value,
+            max_items=max_items,
+            min_clear_fraction=min_clear_fraction,
+        ),
+        depth=conf.STAC_SEARCH_PREFETCH_PAGES,
+    )
+    items, datasets, geobox = [], [], None
+    for page in pages:
+        items += page.items
+        xx = _load_items(page, geojson, geobox, chunks=chunks)
+        geobox = xx.odc.geobox if geobox is None else geobox
+        datasets.append(xx)
+    if not datasets:
+        raise NoSTACItemFound("Could not find the desired STAC item for the given bounding box and date range.")
+    return items, datasets[0] if len(datasets) == 1 else xr.concat(datasets, dim="time").sortby("time")
+
+
+def iter_stac_item_pages(
+    user_defined_collection: str,
+    geojson: dict,
+    date_range: str,
+    cloud_cover_percentage_value: int,
+    sortby: Union[None, str, List[dict]] = None,
+    limit: int = conf.STAC_SEARCH_PAGE_SIZE,
+    max_items: Union[None, int] = None,
+    fields: Union[None, dict] = conf.STAC_SEARCH_FIELDS,
+    min_clear_fraction: Union[None, float] = None,
+) -> Iterator:
+    """Searches the configured catalog backend (see `mapa_streamlit.catalog.get_catalog`) and yields the resulting
+    items page by page as `pystac.ItemCollection`, so the caller can start working on the first items while the
+    following pages are still requested. Pages are regrouped into whole solar days, so that a day split across pages
+    is still loaded as one scene from all of its tiles, see `_iter_solar_day_batches`.
+
+    Parameters
+    ----------
+    sortby : Union[None, str, List[dict]], optional
+        Server side sorting of the items, by default in the order of acquisition (`conf.STAC_SEARCH_SORTBY`), with
+        `max_items` the least cloudy scenes first (`conf.STAC_SEARCH_MAX_ITEMS_SORTBY`). Items which are not sorted
+        by acquisition time are only yielded once the search is complete.
+    limit : int, optional
+        Number of items per page.
+    max_items : Union[None, int], optional
+        Maximum number of items to return in total, e.g. to only request the N least cloudy scenes. By default None,
+        meaning all items matching the search are returned.
+    fields : Union[None, dict], optional
+        Fields extension parameter to include / exclude item properties, trimming the size of the response payload.
+    min_clear_fraction : Union[None, float], optional
+        Items of which a smaller fraction of the observed AOI pixels is clear are dropped from the pages, see
+        `screen_items`. By default `conf.SCREENING_MIN_CLEAR_FRACTION`, 0 disables the screening.
+
+    The results of STAC API searches are stored, see `items.ItemStore`, the same search is answered from them
+    without any request for `conf.ITEM_STORE_TTL` seconds.
+    """
+    min_clear_fraction = conf.SCREENING_MIN_CLEAR_FRACTION if min_clear_fraction is None else min_clear_fraction
+    tables = _iter_stac_item_tables(
+        user_defined_collection, geojson, date_range, cloud_cover_percentage_value, sortby, limit, max_items, fields
+    )
+    for table in tables:
+        page = table.to_items()
+        if min_clear_fraction:
+            page = screen_items(page, user_defined_collection, geojson, min_clear_fraction)
+        yield page
+
+
+def _iter_stac_item_tables(
+    user_defined_collection: str,
+    geojson: dict,
+    date_range: str,
+    cloud_cover_percentage_value: int,
+    sortby: Union[None, str, List[dict]] = None,
+    limit: int = conf.STAC_SEARCH_PAGE_SIZE,
+    max_items: Union[None, int] = None,
+    fields: Union[None, dict] = conf.STAC_SEARCH_FIELDS,
+) -> Iterator[ItemTable]:
+    """Like `iter_stac_item_pages`, but yields the batches of whole solar days as `ItemTable` without screening them,
+    so that the caller can filter them before any pystac item is created. A search for the `max_items` least cloudy
+    items is answered from the stored results of the same search without `max_items` as well."""
+    if sortby is None:
+        sortby = conf.STAC_SEARCH_MAX_ITEMS_SORTBY if max_items else conf.STAC_SEARCH_SORTBY
+    first_sort = next(iter(normalize_sortby(sortby)), {})
+    sorted_by_time = first_sort.get("field") == "datetime" and first_sort.get("direction", "asc") == "asc"
+    # polygon aois only match the items intersecting the polygon itself, not just its bbox
+    rectangle = is_rectangle(geojson)
+    search = dict(
         collections=[user_defined_collection],
-        bbox=bbox,
+        bbox=_turn_geojson_into_bbox(geojson) if rectangle else None,
+        intersects=None if rectangle else geojson,
         datetime=date_range,
         query={
             "eo:cloud_cover": {"lt": cloud_cover_percentage_value},
         },
+        sortby=sortby,
+        max_items=max_items,
+        fields=fields,
     )
-    items = search.get_all_items()
-    return items
+    # local mirrors are searched without any round trips anyway
+    store = ItemStore(TMPDIR() / conf.ITEM_STORE_DIRNAME) if conf.CATALOG_BACKEND == STAC_API else None
+    key = get_search_key(catalog=conf.STAC_API_URL, **search)
+    stored = store.get(key) if store else None
+    if stored is None and store and max_items and sortby == conf.STAC_SEARCH_MAX_ITEMS_SORTBY:
+        unlimited = dict(search, sortby=conf.STAC_SEARCH_SORTBY, max_items=None)
+        stored = store.get(get_search_key(catalog=conf.STAC_API_URL, **unlimited))
+        if stored is not None:
+            stored = stored.sort_by_cloud_cover().slice(0, max_items)
+    if stored is not None:
+        log.debug(f"🗃  {len(stored)} search results are stored already")
+        pages = (stored.slice(offset, limit) for offset in range(0, len(stored), limit))
+    else:
+        pages = (ItemTable.from_items(page.items) for page in get_catalog().search_pages(limit=limit, **search))
+        if store:
+            pages = _store_pages(pages, store, key)
+    pages = _iter_solar_day_batches(pages, sorted_by_time)
+    while True:
+        with span("search", collection=user_defined_collection) as s:
+            page = next(pages, None)
+            s.fields["items"] = 0 if page is None else len(page)
+        if page is None:
+            return
+        yield page
+
+
+def _store_pages(pages: Iterator[ItemTable], store: ItemStore, key: str) -> Iterator[ItemTable]:
+    """Passes the `pages` through and stores all of their items once they are exhausted."""
+    tables = []
+    for page in pages:
+        tables.append(page)
+        yield page
+    store.put(key, ItemTable.concat(tables))
+
+
+def search_stac_for_items(user_defined_collection, geojson,date_range,cloud_cover_percentage_value, max_items=None):
+    from pystac import ItemCollection
+
+    pages = iter_stac_item_pages(
+        user_defined_collection, geojson, date_range, cloud_cover_percentage_value, max_items=max_items
+    )
+    return ItemCollection([item for page in pages for item in page.items])
 
 
 def get_band_metadata(collection:str):
-    catalog = pystac_client.Client.open(
-    conf.PLANETARY_COMPUTER_API_URL,
-    modifier=planetary_computer.sign_inplace,
-)
+    import pandas as pd
+
+    catalog = get_catalog()
     if collection == "landsat-c2-l2":
         landsat = catalog.get_collection("landsat-c2-l2")
         landsat_df1=pd.DataFrame(landsat.summaries.get_list("eo:bands"))
@@ -182,8 +716,22 @@ def get_band_metadata(collection:str):
     
     return df
 
+def _get_epsg(items) -> Union[int, None]:
+    """Returns the epsg code of the first item. Newer pystac versions migrate `proj:epsg` to `proj:code` when reading
+    items, which stackstac does not pick up on its own."""
+    properties = items[0].properties
+    code = properties.get("proj:code") or ""
+    if code.upper().startswith("EPSG:"):
+        return int(code.split(":")[1])
+    return properties.get("proj:epsg")
+
+
 def filter(bands,resolution,items,bbox,perc_thresh):#remove perc_thresh
-    stack = stackstac.stack(items, bounds_latlon=bbox, resolution=resolution,epsg=None)
+    import stackstac
+
+    stack = stackstac.stack(
+        items, bounds_latlon=bbox, resolution=resolution, epsg=_get_epsg(items), gdal_env=get_stackstac_gdal_env()
+    )
 
     data = stack.sel(band=bands)
 
@@ -193,25 +741,30 @@ def filter(bands,resolution,items,bbox,perc_thresh):#remove perc_thresh
     ts = nodata_filtered.persist()
     return ts
 
-def save_gif(gif):
-    filename=Path("my_gif.gif")
-    with open(filename, "wb") as f:
-        f.write(gif)
-    path=filename
+def save_gif(gif, output_file: Union[Path, str]) -> Path:
+    path = Path(f"{output_file}.gif")
+    with atomic_write(path) as tmp_path:
+        tmp_path.write_bytes(gif)
     return path
 
+@request_context()
 def create_and_save_gif(geojson,geo_hash,user_defined_collection,user_defined_bands,output_file,date_range,cloud_cover_percentage_value,compress=True)->Path:
+    from geogif import dgif
+
     gif_path_list=[]
     items=search_stac_for_items(user_defined_collection, geojson,date_range,cloud_cover_percentage_value)
     if not items:
-        print("No items found to create a GIF.")
+        log.info("No items found to create a GIF.")
         return None
     
     bbox = _turn_geojson_into_bbox(geojson)
     
-    ts=filter(user_defined_bands,10,items,bbox,perc_thresh=1) #check with band that is 30m if this 10m would work
-    gif=dgif(ts,fps=0.5, date_bg=(34, 229, 235),date_color=(0, 0, 0),date_position="lr", date_format="%Y-%m-%d_%H:%M:%S", bytes=True).compute()#cmap="Greys",
-    path=save_gif(gif)
+    with remote_io_env():
+        ts=filter(user_defined_bands,10,items,bbox,perc_thresh=1) #check with band that is 30m if this 10m would work
+        with span("gif_encode", scenes=ts.sizes["time"]) as s:
+            gif=dgif(ts,fps=0.5, date_bg=(34, 229, 235),date_color=(0, 0, 0),date_position="lr", date_format="%Y-%m-%d_%H:%M:%S", bytes=True).compute()#cmap="Greys",
+            s.add_bytes(len(gif))
+    path=save_gif(gif, output_file)
     gif_path_list.append(path)
     
 
@@ -219,6 +772,7 @@ def create_and_save_gif(geojson,geo_hash,user_defined_collection,user_defined_ba
 
 
 def get_xml_metadata(items):
+    import requests
 
     assets=items[0].assets.items()
     dict_assets=dict(assets)
@@ -1,7 +1,8 @@
 from dataclasses import dataclass
-from typing import List
+from typing import TYPE_CHECKING, List
 
-import numpy as np
+if TYPE_CHECKING:
+    import numpy as np
 
 
 @dataclass
@@ -10,7 +11,9 @@ class TileFormat:
     y: int
 
 
-def split_array_into_tiles(array: np.ndarray, tiles_format: TileFormat) -> List[np.ndarray]:
+def split_array_into_tiles(array: "np.ndarray", tiles_format: TileFormat) -> List["np.ndarray"]:
+    import numpy as np
+
     x, y = array.shape
     if tiles_format.x > x or tiles_format.y > y:
         raise ValueError("Input array is too small to be split into tiles.")
@@ -1,30 +1,170 @@
+import contextvars
 import logging
+import queue
 import tempfile
+import threading
+import time
 from pathlib import Path
+from typing import Iterable, Iterator, List, TypeVar, Union
+
+from mapa_streamlit import conf
+
+T = TypeVar("T")
 
 log = logging.getLogger(__name__)
 
 
 def TMPDIR() -> Path:
-    tmpdir = Path(tempfile.gettempdir()) / "mapa"
-    if not tmpdir.is_dir():
-        tmpdir.mkdir()
+    tmpdir = Path(conf.CACHE_ROOT) if conf.CACHE_ROOT else Path(tempfile.gettempdir()) / "mapa"
+    # created concurrently by other processes sharing the cache root
+    tmpdir.mkdir(parents=True, exist_ok=True)
     return tmpdir
 
 def GIFTMPDIR() -> Path:
-    tmpdir = Path(tempfile.gettempdir()) / "mapa" /"gif"
-    if not tmpdir.is_dir():
-        tmpdir.mkdir()
+    tmpdir = TMPDIR() / "gif"
+    tmpdir.mkdir(exist_ok=True)
     return tmpdir
 
+def prefetch_iterator(iterable: Iterable[T], depth: int = 1) -> Iterator[T]:
+    """Consumes `iterable` in a background thread, keeping up to `depth` elements ready while the caller is still
+    processing the previous ones. Exceptions raised by `iterable` are re-raised in the consuming thread."""
+
+    done = object()
+    buffer = queue.Queue(maxsize=max(depth, 1))
+    stop = threading.Event()
+
+    def _put(element) -> bool:
+        while not stop.is_set():
+            try:
+                buffer.put(element, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce() -> None:
+        try:
+            for element in iterable:
+                if not _put((element, None)):
+                    return
+        except BaseException as e:
+            _put((done, e))
+        else:
+            _put((done, None))
+
+    # the producer runs with the context of the caller, e.g. to log with the same request id
+    context = contextvars.copy_context()
+    thread = threading.Thread(target=context.run, args=(_produce,), name="mapa-prefetch", daemon=True)
+    thread.start()
+    try:
+        while True:
+            element, error = buffer.get()
+            if element is done:
+                if error is not None:
+                    raise error
+                return
+            yield element
+    finally:
+        # stop the producer in case the consumer did not exhaust the iterator
+        stop.set()
+
+
 class ProgressBar:
-    def __init__(self, progress_bar: object, steps: int = 0) -> None:
+    """Wraps a streamlit progress bar. Progress is measured in work units (usually bytes) which are registered with
+    `add_work` as soon as they are known and completed with `step`. The displayed value never goes backwards, even if
+    more work is registered later on. Updates are throttled, and they are only sent from the thread which created the
+    progress bar, as streamlit elements can't be updated from worker threads. Workers only count completed units,
+    the owning thread pushes them to the ui with `refresh`."""
+
+    def __init__(self, progress_bar: object, steps: int = 0, min_update_interval: float = None) -> None:
         self.progress_bar = progress_bar  # streamlit st.progress_bar object
-        self.steps: int = steps
-        self.counter: int = 0
-
-    def step(self) -> None:
-        progress = 100 // (self.steps - 1) * (self.counter + 1)
-        progress = progress if progress <= 100 else 100
-        self.progress_bar.progress(progress)
-        self.counter += 1
+        self.steps: float = steps
+        self.counter: float = 0
+        self.min_update_interval = (
+            conf.PROGRESS_MIN_UPDATE_INTERVAL if min_update_interval is None else min_update_interval
+        )
+        self._lock = threading.Lock()
+        self._owner = threading.get_ident()
+        self._start = time.monotonic()
+        self._last_update = float("-inf")
+        self._displayed = 0
+
+    @property
+    def fraction(self) -> float:
+        with self._lock:
+            if self.steps <= 0:
+                return 0.0
+            return min(self.counter / self.steps, 1.0)
+
+    def eta(self) -> Union[float, None]:
+        """Returns the estimated remaining time in seconds, None as long as there is too little progress to tell."""
+        fraction = self.fraction
+        if fraction < 0.01:
+            return None
+        elapsed = time.monotonic() - self._start
+        return elapsed / fraction * (1.0 - fraction)
+
+    def add_work(self, units: float) -> None:
+        with self._lock:
+            self.steps += units
+
+    def step(self, units: float = 1) -> None:
+        with self._lock:
+            self.counter += units
+        self.refresh()
+
+    def refresh(self, force: bool = False) -> None:
+        if threading.get_ident() != self._owner:
+            return
+        now = time.monotonic()
+        # tolerance for the rounding errors of units spread across dask tasks
+        progress = max(int(self.fraction * 100 + 1e-6), self._displayed)
+        if not force and progress < 100 and now - self._last_update < self.min_update_interval:
+            return
+        self._last_update = now
+        self._displayed = progress
+        eta = self.eta()
+        text = f"{progress}%" if eta is None or progress == 100 else f"{progress}% · about {_format_duration(eta)} left"
+        self.progress_bar.progress(progress, text=text)
+
+
+def _format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    return f"{minutes} min {seconds} s" if minutes else f"{seconds} s"
+
+
+class DaskProgressCallback:
+    """Reports the task completion of a single dask computation to a `ProgressBar`, spreading `units` (e.g. the bytes
+    the computation yields) evenly across its tasks. Pass it explicitly with `compute(callbacks=...)`, it never
+    reports more than `units`, so it can be reused for retries of the same computation."""
+
+    def __init__(self, progress_bar: ProgressBar, units: float) -> None:
+        self.progress_bar = progress_bar
+        self.units = units
+        self._reported = 0.0
+        self._units_per_task = 0.0
+        self._lock = threading.Lock()
+
+    def _start(self, dsk) -> None:
+        with self._lock:
+            self._units_per_task = self.units / max(len(dsk), 1)
+
+    def _posttask(self, key, result, dsk, state, worker_id) -> None:
+        with self._lock:
+            units = min(self._units_per_task, self.units - self._reported)
+            self._reported += units
+        if units > 0:
+            self.progress_bar.step(units)
+
+    def finish(self) -> None:
+        """Reports the units which are left, e.g. because parts of the computation were cached."""
+        with self._lock:
+            units = self.units - self._reported
+            self._reported = self.units
+        if units > 0:
+            self.progress_bar.step(units)
+
+    @property
+    def callbacks(self) -> List[tuple]:
+        """Callbacks in the form dask schedulers accept as `callbacks` argument."""
+        return [(self._start, None, None, self._posttask, None)]
@@ -5,6 +5,8 @@ from typing import List
 
 from pathlib import Path
 
+import geojson
+
 from mapa_streamlit import conf
 
 log = logging.getLogger(__name__)
@@ -42,9 +44,17 @@ def _get_area(bbox: List[List[float]]) -> float:
     return round(abs(width * height), 2)
 
 
+def _get_corners(geometry: dict) -> List[List[float]]:
+    """Returns the corners of the bbox of any GeoJSON geometry, e.g. rectangles, polygons or multipolygons."""
+    coordinates = list(geojson.utils.coords(geometry))
+    west, east = min(c[0] for c in coordinates), max(c[0] for c in coordinates)
+    south, north = min(c[1] for c in coordinates), max(c[1] for c in coordinates)
+    return [[west, south], [west, north], [east, north], [east, south]]
+
+
 def selected_bbox_too_large(geometry: dict, threshold: float) -> bool:
-    bbox = geometry["coordinates"][0]
-    area = _get_area(bbox=bbox)
+    # polygons are loaded on the grid of their bbox, which is what takes up memory
+    area = _get_area(bbox=_get_corners(geometry))
     log.info(f"📏  area with size: {area} was selected, threshold is: {threshold}")
     return area > threshold
 
@@ -57,8 +67,7 @@ class CoordinateBoundaries:
 
 
 def selected_bbox_in_boundary(geometry: dict, boundary: CoordinateBoundaries = CoordinateBoundaries) -> bool:
-    bbox = geometry["coordinates"][0]
-    for coordinate in bbox:
+    for coordinate in geojson.utils.coords(geometry):
         lon = coordinate[0]
         lat = coordinate[1]
         if lon < boundary.lon_min or lon > boundary.lon_max:
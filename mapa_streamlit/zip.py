@@ -5,6 +5,8 @@ import zipfile
 from pathlib import Path
 from typing import List, Union
 
+from mapa_streamlit.cache import atomic_write
+from mapa_streamlit.metrics import span
 from mapa_streamlit.utils import ProgressBar
 
 log = logging.getLogger(__name__)
@@ -14,11 +16,15 @@ def create_zip_archive(
     files: List[Path], output_file: Union[str, Path], progress_bar: Union[ProgressBar, None] = None
 ) -> Path:
     log.info(f"📦  compressing files: {[f.name for f in files]}")
-    with zipfile.ZipFile(output_file, "w", zipfile.ZIP_DEFLATED) as zip_file:
-        for f in files:
-            zip_file.write(f, f.name)
-            if progress_bar:
-                progress_bar.step()
+    if progress_bar:
+        progress_bar.add_work(sum(f.stat().st_size for f in files))
+    with span("zip", files=len(files)) as s, atomic_write(output_file) as tmp_path:
+        with zipfile.ZipFile(tmp_path, "w", zipfile.ZIP_DEFLATED) as zip_file:
+            for f in files:
+                zip_file.write(f, f.name)
+                s.add_bytes(f.stat().st_size)
+                if progress_bar:
+                    progress_bar.step(f.stat().st_size)
     log.info(f"✅  finished compressing files into: {output_file}")
     return Path(output_file)
 
@@ -28,7 +34,7 @@ def create_gif_zip_archive(
     files: List[Path], output_file: Union[str, Path]
 ) -> Path:
     log.info(f"📦  compressing files: {[f.name for f in files]}")
-    with zipfile.ZipFile(output_file, "w", zipfile.ZIP_DEFLATED) as zip_file:
+    with atomic_write(output_file) as tmp_path, zipfile.ZipFile(tmp_path, "w", zipfile.ZIP_DEFLATED) as zip_file:
         for f in files:
             zip_file.write(f, f.name)
     log.info(f"✅  finished compressing files into: {output_file}")
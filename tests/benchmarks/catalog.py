@@ -0,0 +1,225 @@
+import json
+import operator
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import List, Sequence, Union
+
+import numpy as np
+import rasterio
+from pyproj import Transformer
+from rasterio.transform import from_origin
+from shapely.geometry import shape
+
+CATALOG_FILE = "items.json"
+COLLECTION = "sentinel-2-l2a"
+BANDS = ("B02", "B03", "B04")
+EPSG = 32632
+ORIGIN = (500_000, 5_300_000)
+RESOLUTION = 10
+
+CONFORMS_TO = [
+    "https://api.stacspec.org/v1.0.0/core",
+    "https://api.stacspec.org/v1.0.0/item-search",
+    "https://api.stacspec.org/v1.0.0/item-search#query",
+    "https://api.stacspec.org/v1.0.0/item-search#sort",
+    "https://api.stacspec.org/v1.0.0/item-search#fields",
+]
+QUERY_OPERATORS = {"eq": operator.eq, "lt": operator.lt, "lte": operator.le, "gt": operator.gt, "gte": operator.ge}
+
+
+def write_cog(path: Path, bands: int = 3, size: int = 1024, epsg: int = EPSG, seed: int = 0) -> Path:
+    """Writes a tiled, deflate compressed cloud optimized GeoTIFF with overviews. The random uint16 data is spatially
+    correlated like real imagery, so it compresses alike."""
+    rng = np.random.default_rng(seed)
+    coarse = rng.integers(1_000, 9_000, size=(bands, size // 16 + 1, size // 16 + 1), dtype="uint16")
+    data = np.kron(coarse, np.ones((16, 16), dtype="uint16"))[:, :size, :size]
+    data += rng.integers(1, 100, size=data.shape, dtype="uint16")
+    profile = {
+        "driver": "COG",
+        "width": size,
+        "height": size,
+        "count": bands,
+        "dtype": "uint16",
+        "crs": f"EPSG:{epsg}",
+        "transform": from_origin(*ORIGIN, RESOLUTION, RESOLUTION),
+        "nodata": 0,
+        "blocksize": 512,
+        "compress": "deflate",
+    }
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(data)
+    return path
+
+
+def write_scl_cog(path: Path, scene_class: int, size: int = 1024, epsg: int = EPSG) -> Path:
+    """Writes a sentinel-2 scene classification COG in which all pixels are of `scene_class`, e.g. 4 (vegetation) or 9
+    (high probability clouds)."""
+    profile = {
+        "driver": "COG",
+        "width": size,
+        "height": size,
+        "count": 1,
+        "dtype": "uint8",
+        "crs": f"EPSG:{epsg}",
+        "transform": from_origin(*ORIGIN, RESOLUTION, RESOLUTION),
+        "nodata": 0,
+        "blocksize": 512,
+        "compress": "deflate",
+    }
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(np.full((1, size, size), scene_class, dtype="uint8"))
+    return path
+
+
+def aoi(size_m: int, offset_m: int = 1_000) -> dict:
+    """Returns a square lon / lat polygon of `size_m` meters within the footprint of the synthetic scenes."""
+    to_lon_lat = Transformer.from_crs(EPSG, 4326, always_xy=True)
+    x0, y1 = ORIGIN[0] + offset_m, ORIGIN[1] - offset_m
+    x1, y0 = x0 + size_m, y1 - size_m
+    ring = [to_lon_lat.transform(x, y) for x, y in [(x0, y0), (x0, y1), (x1, y1), (x1, y0), (x0, y0)]]
+    return {"type": "Polygon", "coordinates": [[list(c) for c in ring]]}
+
+
+def _footprint(size: int) -> dict:
+    return aoi(size * RESOLUTION, offset_m=0)
+
+
+def write_synthetic_catalog(
+    root: Path,
+    n_scenes: int,
+    size: int = 1024,
+    bands: tuple = BANDS,
+    start: datetime = datetime(2023, 6, 1, 10),
+    cloudy: Union[None, Sequence[int]] = None,
+) -> List[dict]:
+    """Writes `n_scenes` scenes on consecutive days, one single band COG per asset, and the STAC items describing
+    them to `root`. Asset hrefs are relative to the server root and made absolute when the items are served. With
+    `cloudy`, the scenes get an SCL band as well, in which the scenes of the given indices are completely clouded."""
+    items = []
+    footprint = _footprint(size)
+    lons, lats = zip(*footprint["coordinates"][0])
+    for i in range(n_scenes):
+        item_id = f"scene-{i:03d}"
+        scene_dir = root / "scenes" / item_id
+        scene_dir.mkdir(parents=True, exist_ok=True)
+        assets = {}
+        for j, band in enumerate(bands):
+            write_cog(scene_dir / f"{band}.tif", bands=1, size=size, epsg=EPSG, seed=i * len(bands) + j)
+            assets[band] = {
+                "href": f"scenes/{item_id}/{band}.tif",
+                "type": "image/tiff; application=geotiff; profile=cloud-optimized",
+                "roles": ["data"],
+                "eo:bands": [{"name": band}],
+            }
+        if cloudy is not None:
+            write_scl_cog(scene_dir / "SCL.tif", 9 if i in cloudy else 4, size=size)
+            assets["SCL"] = {**assets[bands[0]], "href": f"scenes/{item_id}/SCL.tif", "eo:bands": [{"name": "SCL"}]}
+        items.append(
+            {
+                "type": "Feature",
+                "stac_version": "1.0.0",
+                "stac_extensions": [
+                    "https://stac-extensions.github.io/projection/v1.1.0/schema.json",
+                    "https://stac-extensions.github.io/eo/v1.1.0/schema.json",
+                ],
+                "id": item_id,
+                "collection": COLLECTION,
+                "geometry": footprint,
+                "bbox": [min(lons), min(lats), max(lons), max(lats)],
+                "properties": {
+                    "datetime": (start + timedelta(days=i)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                    "eo:cloud_cover": (i * 37) % 100,
+                    "proj:epsg": EPSG,
+                    "proj:shape": [size, size],
+                    "proj:transform": list(from_origin(*ORIGIN, RESOLUTION, RESOLUTION))[:6],
+                },
+                "assets": assets,
+                "links": [],
+            }
+        )
+    (root / CATALOG_FILE).write_text(json.dumps(items))
+    return items
+
+
+def _parse_datetime(value: str) -> Union[datetime, None]:
+    if value in ("", ".."):
+        return None
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).astimezone(timezone.utc)
+
+
+def _matches(item: dict, search: dict) -> bool:
+    if search.get("collections") and item["collection"] not in search["collections"]:
+        return False
+    if search.get("ids") and item["id"] not in search["ids"]:
+        return False
+    if search.get("bbox"):
+        west, south, east, north = search["bbox"]
+        item_west, item_south, item_east, item_north = item["bbox"]
+        if west > item_east or east < item_west or south > item_north or north < item_south:
+            return False
+    if search.get("intersects") and not shape(search["intersects"]).intersects(shape(item["geometry"])):
+        return False
+    if search.get("datetime"):
+        start, _, end = search["datetime"].partition("/")
+        start, end = _parse_datetime(start), _parse_datetime(end or start)
+        item_datetime = _parse_datetime(item["properties"]["datetime"])
+        if (start and item_datetime < start) or (end and item_datetime > end):
+            return False
+    for field, comparisons in (search.get("query") or {}).items():
+        value = item["properties"].get(field)
+        for comparison, bound in comparisons.items():
+            if value is None or not QUERY_OPERATORS[comparison](value, bound):
+                return False
+    return True
+
+
+def _absolute(item: dict, data_url: str) -> dict:
+    assets = {key: {**asset, "href": f"{data_url}/{asset['href']}"} for key, asset in item["assets"].items()}
+    return {**item, "assets": assets}
+
+
+def landing_page(api_url: str) -> dict:
+    return {
+        "type": "Catalog",
+        "id": "synthetic",
+        "description": "Synthetic STAC catalog for offline benchmarks",
+        "stac_version": "1.0.0",
+        "conformsTo": CONFORMS_TO,
+        "links": [
+            {"rel": "self", "href": f"{api_url}/"},
+            {"rel": "root", "href": f"{api_url}/"},
+            {"rel": "search", "href": f"{api_url}/search", "type": "application/geo+json", "method": "POST"},
+        ],
+    }
+
+
+def search_page(items: List[dict], search: dict, api_url: str, data_url: str) -> dict:
+    """Answers an item search the way a STAC API does: filtered, sorted and paginated with a `next` link carrying
+    the offset of the following page as token."""
+    matches = [item for item in items if _matches(item, search)]
+    for sort in reversed(search.get("sortby") or []):
+        field = sort["field"].split("properties.")[-1]
+        matches.sort(
+            key=lambda item: item["properties"].get(field, item.get(field)), reverse=sort["direction"] == "desc"
+        )
+
+    limit = int(search.get("limit") or 10)
+    offset = int(search.get("token") or 0)
+    page = {
+        "type": "FeatureCollection",
+        "features": [_absolute(item, data_url) for item in matches[offset : offset + limit]],
+        "numberMatched": len(matches),
+        "numberReturned": len(matches[offset : offset + limit]),
+        "links": [],
+    }
+    if offset + limit < len(matches):
+        page["links"].append(
+            {
+                "rel": "next",
+                "href": f"{api_url}/search",
+                "type": "application/geo+json",
+                "method": "POST",
+                "body": {**search, "token": str(offset + limit)},
+            }
+        )
+    return page
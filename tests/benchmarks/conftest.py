@@ -0,0 +1,175 @@
+import json
+import multiprocessing
+import threading
+import time
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Tuple, Union
+from urllib.parse import parse_qs
+
+import psutil
+import pytest
+
+from mapa_streamlit.serving import _parse_range
+from tests.benchmarks.catalog import CATALOG_FILE, landing_page, search_page
+
+
+def _make_handler(root: Path, requests, bytes_sent):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_HEAD(self) -> None:
+            self._serve(send_body=False)
+
+        def do_GET(self) -> None:
+            if self.path.startswith("/stac/"):
+                self._serve_stac(search=None)
+            else:
+                self._serve(send_body=True)
+
+        def do_POST(self) -> None:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            self._serve_stac(search=json.loads(body or b"{}"))
+
+        def _count_request(self) -> None:
+            with requests.get_lock():
+                requests.value += 1
+
+        def _count_bytes(self, n_bytes: int) -> None:
+            with bytes_sent.get_lock():
+                bytes_sent.value += n_bytes
+
+        def _serve_stac(self, search: Union[dict, None]) -> None:
+            """Minimal STAC API in front of the synthetic catalog in `root`: `/stac/<run>/` is the landing page and
+            `/stac/<run>/search` the item search. The assets of the found items are served from `/<run>/...`."""
+            self._count_request()
+            path, _, query = self.path.partition("?")
+            run = path.strip("/").split("/")[1]
+            host = f"http://{self.headers['Host']}"
+            api_url, data_url = f"{host}/stac/{run}", f"{host}/{run}"
+            if path.rstrip("/").endswith("/search"):
+                if search is None:
+                    search = {key: values[0] for key, values in parse_qs(query).items()}
+                    search["bbox"] = [float(v) for v in search["bbox"].split(",")] if "bbox" in search else None
+                    search["collections"] = search["collections"].split(",") if "collections" in search else None
+                items = json.loads((root / CATALOG_FILE).read_text())
+                body = search_page(items, search, api_url, data_url)
+            else:
+                body = landing_page(api_url)
+            content = json.dumps(body).encode()
+            self.send_response(HTTPStatus.OK)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+            self._count_bytes(len(content))
+
+        def _serve(self, send_body: bool) -> None:
+            self._count_request()
+            # the first path segment can be chosen freely, which allows opening the same file under different urls
+            # without hitting GDAL's process wide cache
+            path = root.joinpath(*self.path.split("?", 1)[0].strip("/").split("/")[1:])
+            if not path.is_file():
+                self.send_response(HTTPStatus.NOT_FOUND)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            content = path.read_bytes()
+            start, end = 0, len(content) - 1
+            status = HTTPStatus.OK
+            if self.headers.get("Range"):
+                start, end = _parse_range(self.headers["Range"], len(content))
+                status = HTTPStatus.PARTIAL_CONTENT
+            self.send_response(status)
+            self.send_header("Content-Length", str(end - start + 1))
+            self.send_header("Accept-Ranges", "bytes")
+            if status == HTTPStatus.PARTIAL_CONTENT:
+                self.send_header("Content-Range", f"bytes {start}-{end}/{len(content)}")
+            self.end_headers()
+            if send_body:
+                self.wfile.write(content[start : end + 1])
+                self._count_bytes(end - start + 1)
+
+        def log_message(self, *args) -> None:
+            pass
+
+    return Handler
+
+
+def _serve_forever(root: Path, port, requests, bytes_sent) -> None:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _make_handler(root, requests, bytes_sent))
+    server.daemon_threads = True
+    port.value = server.server_address[1]
+    server.serve_forever()
+
+
+class CountingFileServer:
+    """Static http file server supporting range requests, which counts the requests and bytes it serves. Next to the
+    files it answers STAC API requests for a synthetic catalog written to its root, see `api_url`. It runs in a
+    separate process, as GDAL holds the GIL while opening remote files."""
+
+    def __init__(self, root: Path) -> None:
+        self.requests = multiprocessing.Value("i", 0)
+        self.bytes_sent = multiprocessing.Value("l", 0)
+        self._port = multiprocessing.Value("i", 0)
+        self._process = multiprocessing.Process(
+            target=_serve_forever, args=(root, self._port, self.requests, self.bytes_sent), daemon=True
+        )
+        self._process.start()
+        while self._port.value == 0:
+            time.sleep(0.01)
+
+    def stats(self) -> Tuple[int, int]:
+        """Returns the number of requests and bytes served since the last reset."""
+        return self.requests.value, self.bytes_sent.value
+
+    def reset(self) -> None:
+        self.requests.value = 0
+        self.bytes_sent.value = 0
+
+    def url(self, prefix: str, name: str) -> str:
+        return f"http://127.0.0.1:{self._port.value}/{prefix}/{name}"
+
+    def api_url(self, prefix: str) -> str:
+        """Returns the STAC API url of the catalog. Asset hrefs of the found items start with `prefix`, a new prefix
+        therefore bypasses the caches of GDAL for all assets."""
+        return f"http://127.0.0.1:{self._port.value}/stac/{prefix}"
+
+    def stop(self) -> None:
+        self._process.terminate()
+        self._process.join()
+
+
+@pytest.fixture
+def cog_server(tmp_path):
+    server = CountingFileServer(tmp_path)
+    yield server
+    server.stop()
+
+
+class PeakRSS:
+    """Samples the resident set size of the current process in a background thread while the context is active."""
+
+    def __init__(self, interval: float = 0.01) -> None:
+        self.interval = interval
+        self.baseline = 0
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self) -> None:
+        process = psutil.Process()
+        while not self._stop.is_set():
+            self.peak = max(self.peak, process.memory_info().rss)
+            time.sleep(self.interval)
+
+    def __enter__(self) -> "PeakRSS":
+        self.baseline = self.peak = psutil.Process().memory_info().rss
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self._stop.set()
+        self._thread.join()
@@ -0,0 +1,319 @@
+import itertools
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from mapa_streamlit import conf
+from mapa_streamlit.composite import composite_stac_items_for_bbox
+from mapa_streamlit.datacube import fetch_stac_items_to_datacube, open_datacube
+from mapa_streamlit.histogram import create_histogram_figure
+from mapa_streamlit.io import remote_io_env
+from mapa_streamlit.planning import fetch_stac_items_for_aois
+from mapa_streamlit.reads import get_reader
+from mapa_streamlit.speculation import speculate
+from mapa_streamlit.stac import (
+    _load_items,
+    create_and_save_gif,
+    fetch_stac_items_for_bbox,
+    save_images_from_xarr,
+    search_stac_for_items,
+)
+from mapa_streamlit.zip import create_zip_archive
+from tests.benchmarks.catalog import BANDS, COLLECTION, aoi, write_synthetic_catalog
+from tests.benchmarks.conftest import CountingFileServer, PeakRSS
+
+pytest.importorskip("pytest_benchmark")
+
+SCENE_COUNTS = (2, 6)
+AOI_SIZES_M = {"small": 2_000, "large": 8_000}
+DATE_RANGE = "2023-06-01/2023-07-31"
+CLOUD_COVER = 100
+ROUNDS = 3
+# unique across all benchmarks, so that no round reads urls which GDAL has cached already
+RUNS = itertools.count()
+
+
+@pytest.fixture(scope="module", params=SCENE_COUNTS, ids=lambda n: f"{n}-scenes")
+def catalog(request, tmp_path_factory):
+    root = tmp_path_factory.mktemp(f"catalog-{request.param}")
+    write_synthetic_catalog(root, n_scenes=request.param)
+    server = CountingFileServer(root)
+    yield server
+    server.stop()
+
+
+@pytest.fixture(params=list(AOI_SIZES_M), ids=lambda name: f"{name}-aoi")
+def geojson(request) -> dict:
+    return aoi(AOI_SIZES_M[request.param])
+
+
+def _measure(benchmark, catalog: CountingFileServer, monkeypatch, target: Callable, setup: Callable = None):
+    """Runs `target` for `ROUNDS` rounds and records the peak RSS as well as the requests and bytes served per round
+    next to the wall times. Each round reads the assets under a new url, so GDAL's caches don't hide any reads."""
+
+    def _setup():
+        monkeypatch.setattr(conf, "STAC_API_URL", catalog.api_url(f"run-{next(RUNS)}"))
+        return (setup() if setup else ()), {}
+
+    catalog.reset()
+    with PeakRSS() as rss:
+        result = benchmark.pedantic(target, setup=_setup, rounds=ROUNDS, iterations=1)
+    requests, n_bytes = catalog.stats()
+    benchmark.extra_info.update(
+        peak_rss_mb=round(rss.peak / 2**20, 1),
+        rss_increase_mb=round((rss.peak - rss.baseline) / 2**20, 1),
+        requests=requests // ROUNDS,
+        bytes_read=n_bytes // ROUNDS,
+    )
+    return result
+
+
+def _fetch(geojson: dict, cache_dir):
+    return fetch_stac_items_for_bbox(list(BANDS), COLLECTION, geojson, False, cache_dir, DATE_RANGE, CLOUD_COVER)
+
+
+def test_benchmark_search(benchmark, catalog, monkeypatch) -> None:
+    items = _measure(
+        benchmark, catalog, monkeypatch, lambda: search_stac_for_items(COLLECTION, aoi(2_000), DATE_RANGE, CLOUD_COVER)
+    )
+    assert len(items) in SCENE_COUNTS
+
+
+def test_benchmark_fetch(benchmark, catalog, geojson, monkeypatch, tmp_path) -> None:
+    paths, array, _ = _measure(benchmark, catalog, monkeypatch, lambda: _fetch(geojson, tmp_path))
+    assert len(array) in SCENE_COUNTS
+    assert array.shape[-1] == len(BANDS)
+
+
+def test_benchmark_save_images(benchmark, catalog, geojson, monkeypatch, tmp_path) -> None:
+    def _lazy_dataset():
+        return (_load_items(search_stac_for_items(COLLECTION, geojson, DATE_RANGE, CLOUD_COVER), geojson),)
+
+    def _save(xx):
+        with remote_io_env():
+            return save_images_from_xarr(xx, tmp_path, list(BANDS), COLLECTION)
+
+    paths, array = _measure(benchmark, catalog, monkeypatch, _save, setup=_lazy_dataset)
+    assert (array > 0).any()
+
+
+def test_benchmark_zip(benchmark, catalog, geojson, monkeypatch, tmp_path) -> None:
+    monkeypatch.setattr(conf, "STAC_API_URL", catalog.api_url("zip"))
+    paths, _, _ = _fetch(geojson, tmp_path)
+
+    archive = _measure(
+        benchmark, catalog, monkeypatch, lambda: create_zip_archive(files=paths, output_file=tmp_path / "result.zip")
+    )
+    benchmark.extra_info["archive_bytes"] = archive.stat().st_size
+
+
+def test_benchmark_gif(benchmark, catalog, geojson, monkeypatch, tmp_path) -> None:
+    path = _measure(
+        benchmark,
+        catalog,
+        monkeypatch,
+        lambda: create_and_save_gif(
+            geojson, "hash", COLLECTION, list(BANDS), tmp_path / "gif", DATE_RANGE, CLOUD_COVER
+        ),
+    )
+    assert path == tmp_path / "gif.gif" and path.stat().st_size > 0
+
+
+def test_benchmark_histogram(benchmark, catalog, geojson, monkeypatch, tmp_path) -> None:
+    monkeypatch.setattr(conf, "STAC_API_URL", catalog.api_url("histogram"))
+    paths, array, _ = _fetch(geojson, tmp_path)
+
+    figure = _measure(
+        benchmark, catalog, monkeypatch, lambda: create_histogram_figure(paths, array, paths[0].name, list(BANDS))
+    )
+    assert figure is not None
+
+
+def test_benchmark_merged_fetch(benchmark, catalog, monkeypatch, tmp_path) -> None:
+    # four overlapping AOIs around the same spot
+    aois = {f"aoi-{i}": aoi(3_000, offset_m=1_000 + 500 * i) for i in range(4)}
+    cache_dirs = {aoi_id: tmp_path / aoi_id for aoi_id in aois}
+    for cache_dir in cache_dirs.values():
+        cache_dir.mkdir()
+    # hedged reads duplicate bytes depending on the latencies of the run, which would blur the comparison
+    monkeypatch.setattr(get_reader(), "hedge_budget", 0)
+
+    monkeypatch.setattr(conf, "STAC_API_URL", catalog.api_url("separate"))
+    catalog.reset()
+    for aoi_id, geometry in aois.items():
+        _fetch(geometry, cache_dirs[aoi_id])
+    _, separate_bytes = catalog.stats()
+
+    fetched = _measure(
+        benchmark,
+        catalog,
+        monkeypatch,
+        lambda: fetch_stac_items_for_aois(aois, list(BANDS), COLLECTION, cache_dirs, DATE_RANGE, CLOUD_COVER),
+    )
+    benchmark.extra_info["separate_bytes_read"] = separate_bytes
+    assert sorted(fetched) == sorted(aois)
+    assert benchmark.extra_info["bytes_read"] < separate_bytes
+
+
+def test_benchmark_composite(benchmark, catalog, geojson, monkeypatch, tmp_path) -> None:
+    path = _measure(
+        benchmark,
+        catalog,
+        monkeypatch,
+        lambda: composite_stac_items_for_bbox(
+            list(BANDS), COLLECTION, geojson, tmp_path, DATE_RANGE, CLOUD_COVER, method="median"
+        ),
+    )
+    benchmark.extra_info["output_bytes"] = path.stat().st_size
+    assert path.stat().st_size > 0
+
+
+def test_benchmark_datacube(benchmark, catalog, geojson, monkeypatch, tmp_path) -> None:
+    pytest.importorskip("zarr")
+    stores = (tmp_path / f"cube-{i}.zarr" for i in itertools.count())
+
+    path = _measure(
+        benchmark,
+        catalog,
+        monkeypatch,
+        lambda: fetch_stac_items_to_datacube(list(BANDS), COLLECTION, geojson, next(stores), DATE_RANGE, CLOUD_COVER),
+    )
+    assert open_datacube(path).sizes["time"] in SCENE_COUNTS
+
+    # a refresh of a complete datacube only searches, no scene is read again
+    catalog.reset()
+    fetch_stac_items_to_datacube(list(BANDS), COLLECTION, geojson, path, DATE_RANGE, CLOUD_COVER)
+    _, refresh_bytes = catalog.stats()
+    benchmark.extra_info["refresh_bytes_read"] = refresh_bytes
+    assert refresh_bytes < benchmark.extra_info["bytes_read"] / 10
+
+
+def test_benchmark_incremental_refresh(benchmark, catalog, monkeypatch, tmp_path) -> None:
+    geojson = aoi(2_000)
+    monkeypatch.setattr(conf, "STAC_API_URL", catalog.api_url("full"))
+    catalog.reset()
+    _fetch(geojson, tmp_path)
+    _, full_bytes = catalog.stats()
+
+    # the first two days are fetched already, the refresh extends the date range. It changes the ledger, hence there
+    # is only a single round
+    monkeypatch.setattr(conf, "STAC_API_URL", catalog.api_url("first-days"))
+    fetch_stac_items_for_bbox(list(BANDS), COLLECTION, geojson, True, tmp_path, "2023-06-01/2023-06-02", CLOUD_COVER)
+    monkeypatch.setattr(conf, "STAC_API_URL", catalog.api_url("refresh"))
+    catalog.reset()
+    paths, array, xx = benchmark.pedantic(
+        lambda: fetch_stac_items_for_bbox(list(BANDS), COLLECTION, geojson, True, tmp_path, DATE_RANGE, CLOUD_COVER),
+        rounds=1,
+        iterations=1,
+    )
+    _, refresh_bytes = catalog.stats()
+    benchmark.extra_info.update(bytes_read=refresh_bytes, full_bytes_read=full_bytes)
+    assert len(paths) == len(array) == xx.sizes["time"] in SCENE_COUNTS
+    # only the scenes after the first two days are read
+    assert refresh_bytes < full_bytes * (len(array) - 1) / len(array)
+
+
+def test_benchmark_contained_fetch(benchmark, catalog, monkeypatch, tmp_path) -> None:
+    monkeypatch.setattr(conf, "STAC_API_URL", catalog.api_url(f"run-{next(RUNS)}"))
+    fetch_stac_items_for_bbox(list(BANDS), COLLECTION, aoi(8_000), True, tmp_path / "cache", DATE_RANGE, CLOUD_COVER)
+    contained = aoi(2_000, offset_m=3_000)
+    _, fresh_array, _ = _fetch(contained, tmp_path)
+
+    # the aoi within the fetched one is clipped from its tifs, without any request
+    catalog.reset()
+    paths, array, xx = benchmark.pedantic(
+        lambda: fetch_stac_items_for_bbox(
+            list(BANDS), COLLECTION, contained, True, tmp_path / "cache", DATE_RANGE, CLOUD_COVER
+        ),
+        rounds=1,
+        iterations=1,
+    )
+    requests, n_bytes = catalog.stats()
+    benchmark.extra_info.update(requests=requests, bytes_read=n_bytes)
+    assert requests == 0
+    assert array.shape == fresh_array.shape
+    np.testing.assert_array_equal(array, fresh_array)
+
+
+def test_benchmark_polygon_fetch(benchmark, catalog, monkeypatch, tmp_path) -> None:
+    # the block cache reads every block of the scenes once, be it for a pruned chunk or not
+    monkeypatch.setattr(conf, "BLOCK_CACHE_MAX_BYTES", 0)
+    square = aoi(8_000)
+    for name in ("square", "triangle"):
+        (tmp_path / name).mkdir()
+    monkeypatch.setattr(conf, "STAC_API_URL", catalog.api_url(f"run-{next(RUNS)}"))
+    catalog.reset()
+    _, square_array, _ = _fetch(square, tmp_path / "square")
+    _, square_bytes = catalog.stats()
+
+    # the triangle spanning half of the square is loaded on the same grid, only its chunks are read
+    ring = square["coordinates"][0]
+    triangle = {"type": "Polygon", "coordinates": [[ring[0], ring[1], ring[2], ring[0]]]}
+    paths, array, _ = _measure(benchmark, catalog, monkeypatch, lambda: _fetch(triangle, tmp_path / "triangle"))
+    benchmark.extra_info["square_bytes_read"] = square_bytes
+    assert array.shape == square_array.shape
+    assert benchmark.extra_info["bytes_read"] < square_bytes * 0.9
+    # pixels outside of the triangle are nodata
+    assert (array == 0).mean() > 0.4
+
+
+def test_benchmark_speculative_fetch(benchmark, catalog, monkeypatch, tmp_path) -> None:
+    geojson = aoi(2_000)
+    for name in ("cold", "speculated"):
+        (tmp_path / name).mkdir()
+    monkeypatch.setattr(conf, "SPECULATION_DELAY", 0)
+    # the headers read ahead are picked up from the block cache
+    monkeypatch.setattr(conf, "BLOCK_CACHE_MAX_BYTES", 2 * 1024**3)
+    monkeypatch.setattr(conf, "STAC_API_URL", catalog.api_url(f"run-{next(RUNS)}"))
+    catalog.reset()
+    _, cold_array, _ = _fetch(geojson, tmp_path / "cold")
+    cold_requests, _ = catalog.stats()
+
+    # the search and the headers are read ahead, while the user is still choosing the parameters
+    monkeypatch.setattr(conf, "STAC_API_URL", catalog.api_url(f"run-{next(RUNS)}"))
+    speculation = speculate(
+        None,
+        geojson,
+        user_defined_collection=COLLECTION,
+        user_defined_bands=list(BANDS),
+        date_range=DATE_RANGE,
+        cloud_cover_percentage_value=CLOUD_COVER,
+    )
+    assert speculation.done.wait(60) and speculation.pick_up()
+    catalog.reset()
+    paths, array, xx = benchmark.pedantic(lambda: _fetch(geojson, tmp_path / "speculated"), rounds=1, iterations=1)
+    requests, n_bytes = catalog.stats()
+    benchmark.extra_info.update(
+        requests=requests, bytes_read=n_bytes, cold_requests=cold_requests, estimated_bytes=speculation.estimated_bytes
+    )
+    np.testing.assert_array_equal(array, cold_array)
+    # neither the search nor the headers are requested by the submitted request
+    assert requests <= cold_requests - 1 - len(BANDS) * len(speculation.items)
+    assert speculation.estimated_bytes == array.size * 4
+
+
+@pytest.fixture(scope="module")
+def cloudy_catalog(tmp_path_factory):
+    root = tmp_path_factory.mktemp("cloudy-catalog")
+    write_synthetic_catalog(root, n_scenes=6, cloudy=(1, 2, 4))
+    server = CountingFileServer(root)
+    yield server
+    server.stop()
+
+
+def test_benchmark_cloud_screening(benchmark, cloudy_catalog, monkeypatch, tmp_path) -> None:
+    geojson = aoi(8_000)
+    monkeypatch.setattr(conf, "STAC_API_URL", cloudy_catalog.api_url(f"run-{next(RUNS)}"))
+    cloudy_catalog.reset()
+    _, unscreened_array, _ = _fetch(geojson, tmp_path)
+    _, unscreened_bytes = cloudy_catalog.stats()
+
+    monkeypatch.setattr(conf, "SCREENING_MIN_CLEAR_FRACTION", 0.5)
+    paths, array, xx = _measure(benchmark, cloudy_catalog, monkeypatch, lambda: _fetch(geojson, tmp_path))
+    benchmark.extra_info["unscreened_bytes_read"] = unscreened_bytes
+    # the clouded scenes are screened out by their SCL band, before any of their bands is read
+    assert len(unscreened_array) == 6 and len(array) == 3
+    assert list(pd.to_datetime(xx.time.values).day) == [1, 4, 6]
+    assert benchmark.extra_info["bytes_read"] < unscreened_bytes * 0.75
@@ -0,0 +1,135 @@
+import time
+from datetime import datetime
+
+import numpy as np
+import pystac
+import rasterio
+from pyproj import Transformer
+from rasterio.windows import Window
+
+from mapa_streamlit import conf
+from mapa_streamlit.io import remote_io_env
+from mapa_streamlit.stac import _load_items
+from tests.benchmarks.catalog import write_cog
+
+
+def _read_blocks(url: str) -> None:
+    with rasterio.open(url) as src:
+        for row in range(0, src.height, 512):
+            for col in range(0, src.width, 512):
+                src.read(window=Window(col, row, 512, 512))
+
+
+def _item(href: str) -> pystac.Item:
+    item = pystac.Item(
+        "scene",
+        geometry=None,
+        bbox=None,
+        datetime=datetime(2023, 6, 1, 10),
+        properties={
+            "proj:epsg": 32632,
+            "proj:shape": [1024, 1024],
+            "proj:transform": [10, 0, 500_000, 0, -10, 5_300_000],
+        },
+        stac_extensions=["https://stac-extensions.github.io/projection/v1.1.0/schema.json"],
+    )
+    item.add_asset("B04", pystac.Asset(href, media_type=pystac.MediaType.COG, roles=["data"]))
+    return item
+
+
+def _aoi() -> dict:
+    to_lon_lat = Transformer.from_crs(32632, 4326, always_xy=True)
+    (x0, x1), (y0, y1) = (502_000, 508_000), (5_292_000, 5_298_000)
+    ring = [to_lon_lat.transform(x, y) for x, y in [(x0, y0), (x0, y1), (x1, y1), (x1, y0), (x0, y0)]]
+    return {"type": "Polygon", "coordinates": [[list(c) for c in ring]]}
+
+
+def test_benchmark_block_reads(cog_server, tmp_path, record_property) -> None:
+    write_cog(tmp_path / "scene.tif")
+
+    with rasterio.Env():
+        _read_blocks(cog_server.url("default", "scene.tif"))
+    default_requests, default_bytes = cog_server.stats()
+
+    cog_server.reset()
+    with remote_io_env():
+        _read_blocks(cog_server.url("managed", "scene.tif"))
+    managed_requests, managed_bytes = cog_server.stats()
+
+    record_property("default_requests", default_requests)
+    record_property("default_bytes", default_bytes)
+    record_property("managed_requests", managed_requests)
+    record_property("managed_bytes", managed_bytes)
+    print(f"default env: {default_requests} requests, {default_bytes} bytes")
+    print(f"managed env: {managed_requests} requests, {managed_bytes} bytes")
+    # no directory listings and sidecar file probing in the managed environment
+    assert managed_requests < default_requests
+
+
+def test_benchmark_stac_load(cog_server, tmp_path, record_property) -> None:
+    write_cog(tmp_path / "scene.tif", bands=1)
+    items = pystac.ItemCollection([_item(cog_server.url("load", "scene.tif"))])
+
+    with remote_io_env():
+        xx = _load_items(items, _aoi())
+        values = xx["B04"].values
+    requests, n_bytes = cog_server.stats()
+
+    record_property("requests", requests)
+    record_property("bytes", n_bytes)
+    print(f"stac load: {requests} requests, {n_bytes} bytes for {values.shape} pixels")
+    assert values.shape[0] == 1
+    assert (values > 0).any()
+
+
+def test_benchmark_source_grid(cog_server, tmp_path, record_property, monkeypatch) -> None:
+    write_cog(tmp_path / "scene.tif", bands=1)
+    # a polygon aoi is loaded in chunks smaller than the blocks of the cog on the aoi grid
+    aoi = _aoi()
+    aoi["coordinates"][0].insert(2, [sum(c) / 2 for c in zip(aoi["coordinates"][0][1], aoi["coordinates"][0][2])])
+
+    # every read goes to the server, the block cache would fetch the union of the blocks either way
+    monkeypatch.setattr(conf, "BLOCK_CACHE_MAX_BYTES", 0)
+    results = {}
+    for read_grid in ("aoi", "source"):
+        monkeypatch.setattr(conf, "READ_GRID", read_grid)
+        cog_server.reset()
+        items = pystac.ItemCollection([_item(cog_server.url(read_grid, "scene.tif"))])
+        with remote_io_env():
+            xx = _load_items(items, aoi)
+            start = time.perf_counter()
+            values = xx["B04"].values
+            duration = time.perf_counter() - start
+        requests, n_bytes = cog_server.stats()
+        results[read_grid] = values
+        record_property(f"{read_grid}_requests", requests)
+        record_property(f"{read_grid}_bytes", n_bytes)
+        record_property(f"{read_grid}_chunks", xx["B04"].data.npartitions)
+        print(f"{read_grid} grid: {requests} requests, {n_bytes} bytes in {duration:.3f} s")
+    # the synthetic scenes are on a grid the aoi grid is aligned with, hence both read the same pixels
+    np.testing.assert_array_equal(results["aoi"], results["source"])
+
+
+def test_benchmark_block_cache(cog_server, tmp_path, record_property, monkeypatch) -> None:
+    monkeypatch.setattr(conf, "BLOCK_CACHE_MAX_BYTES", 2 * 1024**3)
+    write_cog(tmp_path / "scene.tif", bands=1)
+    items = pystac.ItemCollection([_item(cog_server.url("cached", "scene.tif"))])
+    # GDAL doesn't cache the reads of the proxy itself, so that every read reaches the block cache
+    with remote_io_env(CPL_VSIL_CURL_NON_CACHED="/vsicurl/http://127.0.0.1"):
+        _load_items(items, _aoi())["B04"].values
+        first_requests, first_bytes = cog_server.stats()
+
+        # the aoi shifted by 1 km, as drawn again by a user
+        cog_server.reset()
+        shifted = _aoi()
+        shifted["coordinates"][0] = [[lon + 0.013, lat] for lon, lat in shifted["coordinates"][0]]
+        values = _load_items(items, shifted)["B04"].values
+        requests, n_bytes = cog_server.stats()
+
+    record_property("first_requests", first_requests)
+    record_property("first_bytes", first_bytes)
+    record_property("shifted_requests", requests)
+    record_property("shifted_bytes", n_bytes)
+    print(f"first read: {first_requests} requests, {first_bytes} bytes, shifted: {requests} requests, {n_bytes} bytes")
+    assert (values > 0).any()
+    assert n_bytes < 0.25 * first_bytes
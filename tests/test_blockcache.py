@@ -0,0 +1,148 @@
+import os
+import threading
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import numpy as np
+import pytest
+import rasterio
+
+from mapa_streamlit.blockcache import (
+    BLOCK_SUFFIX,
+    BlockCache,
+    _encode_href,
+    _iter_runs,
+    get_cache_key,
+    get_cached_href,
+    stop_block_cache_server,
+    with_block_cache,
+)
+from mapa_streamlit.serving import register_download, start_download_server, stop_download_server
+
+CONTENT = bytes(range(256)) * 40
+
+
+@pytest.fixture
+def upstream(monkeypatch, tmp_path):
+    """Remote file served with range support by the download server, counting the range requests of the cache."""
+    monkeypatch.setattr("mapa_streamlit.conf.DOWNLOAD_SERVER_PORT", 0)
+    monkeypatch.setattr("mapa_streamlit.conf.DOWNLOAD_SERVER_PUBLIC_URL", "")
+    monkeypatch.setattr("mapa_streamlit.conf.CACHE_ROOT", str(tmp_path / "cache"))
+    monkeypatch.setattr("mapa_streamlit.conf.BLOCK_CACHE_MAX_BYTES", 1024**2)
+    (tmp_path / "scene.tif").write_bytes(CONTENT)
+    start_download_server()
+    fetches = []
+    fetch = BlockCache._fetch
+
+    def _fetch(self, href: str, start: int, end: int):
+        fetches.append((start, end))
+        return fetch(self, href, start, end)
+
+    monkeypatch.setattr(BlockCache, "_fetch", _fetch)
+    yield register_download("scene.tif", tmp_path / "scene.tif", "session"), fetches
+    stop_download_server()
+    stop_block_cache_server()
+
+
+def test__iter_runs() -> None:
+    assert list(_iter_runs([1, 2, 5, 7, 8, 9])) == [[1, 2], [5], [7, 8, 9]]
+    assert list(_iter_runs([])) == []
+
+
+def test_get_cache_key() -> None:
+    href = "https://account.blob.core.windows.net/container/scene/B04.tif"
+    assert get_cache_key(f"{href}?st=2023-06-01&se=2023-06-02&sp=rl&sig=a") == get_cache_key(f"{href}?sig=b")
+    assert get_cache_key(href) != get_cache_key(href.replace("B04", "B03"))
+
+
+def test_block_cache_read(upstream, tmp_path) -> None:
+    url, fetches = upstream
+    cache = BlockCache(tmp_path / "blocks", max_bytes=1024**2, block_size=1000)
+
+    assert cache.read(url, 10, 2500) == (CONTENT[10:2501], len(CONTENT))
+    # whole blocks are fetched, consecutive ones with one request
+    assert fetches == [(0, 2999)]
+    assert cache.read(url, 500, 1500)[0] == CONTENT[500:1501]
+    assert cache.read(url, 2800, 4500)[0] == CONTENT[2800:4501]
+    # only the blocks which were missing
+    assert fetches == [(0, 2999), (3000, 4999)]
+    # reads beyond the end of the file are clipped
+    assert cache.read(url, 10_000, 20_000)[0] == CONTENT[10_000:]
+    assert cache.get_size(url) == len(CONTENT)
+
+
+def test_block_cache_evicts_least_recently_read_blocks(upstream, tmp_path) -> None:
+    url, _ = upstream
+    cache = BlockCache(tmp_path / "blocks", max_bytes=5000, block_size=1000)
+    cache.read(url, 0, 999)
+    cache.read(url, 1000, 4999)
+    blocks = {path.name: path for path in (tmp_path / "blocks").glob(f"*/*{BLOCK_SUFFIX}")}
+    os.utime(blocks[f"1{BLOCK_SUFFIX}"], (0, 0))
+    # reading the first block again makes it the most recently used one
+    cache.read(url, 0, 999)
+
+    cache.read(url, 5000, 5999)
+    names = {path.name for path in (tmp_path / "blocks").glob(f"*/*{BLOCK_SUFFIX}")}
+    assert f"1{BLOCK_SUFFIX}" not in names and f"0{BLOCK_SUFFIX}" in names and f"5{BLOCK_SUFFIX}" in names
+    assert sum(path.stat().st_size for path in (tmp_path / "blocks").glob(f"*/*{BLOCK_SUFFIX}")) <= 4500
+
+
+def test_block_cache_proxy(upstream) -> None:
+    url, _ = upstream
+    cached = get_cached_href(url)
+    assert cached.startswith("http://127.0.0.1:") and cached.endswith("/scene.tif")
+    # hrefs which are no http urls are read as they are
+    assert get_cached_href("/data/scene.tif") == "/data/scene.tif"
+    assert with_block_cache()(url) == cached
+
+    with urlopen(Request(cached, headers={"Range": "bytes=100-199"})) as response:
+        assert response.status == 206
+        assert response.headers["Content-Range"] == f"bytes 100-199/{len(CONTENT)}"
+        assert response.read() == CONTENT[100:200]
+    with urlopen(cached) as response:
+        assert response.read() == CONTENT
+
+    # cached blocks are served without the remote server
+    stop_download_server()
+    with urlopen(Request(cached, headers={"Range": "bytes=5000-"})) as response:
+        assert response.read() == CONTENT[5000:]
+    with pytest.raises(HTTPError):
+        urlopen(get_cached_href(url.replace("scene.tif", "other.tif")))
+
+    # hrefs which weren't signed by `get_cached_href` are not fetched
+    port = cached.split(":")[2].split("/")[0]
+    with pytest.raises(HTTPError, match="403"):
+        urlopen(f"http://127.0.0.1:{port}/{_encode_href('http://example.com/scene.tif')}/0/scene.tif")
+    forged = cached.split("/")
+    forged[3] = _encode_href(url.replace("scene.tif", "other.tif"))
+    with pytest.raises(HTTPError, match="403"):
+        urlopen("/".join(forged))
+
+
+def test_block_cache_read_without_range_support(tmp_path) -> None:
+    # the simple http server answers range requests with the whole file
+    (tmp_path / "scene.tif").write_bytes(CONTENT)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(SimpleHTTPRequestHandler, directory=str(tmp_path)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        cache = BlockCache(tmp_path / "blocks", max_bytes=1024**2, block_size=1000)
+        url = f"http://127.0.0.1:{server.server_address[1]}/scene.tif"
+        assert cache.read(url, 10, 2500) == (CONTENT[10:2501], len(CONTENT))
+        assert cache.read(url, 9500, 20_000)[0] == CONTENT[9500:]
+        assert sum(path.stat().st_size for path in (tmp_path / "blocks").glob(f"*/*{BLOCK_SUFFIX}")) == 4240
+    finally:
+        server.shutdown()
+
+
+def test_block_cache_proxy_serves_cogs(upstream, tmp_path) -> None:
+    profile = {"driver": "COG", "width": 256, "height": 256, "count": 1, "dtype": "uint8", "blocksize": 64}
+    with rasterio.open(tmp_path / "cog.tif", "w", **profile) as dst:
+        dst.write(np.arange(256 * 256, dtype="uint8").reshape(1, 256, 256))
+    cached = get_cached_href(register_download("cog.tif", tmp_path / "cog.tif", "session"))
+
+    with rasterio.open(cached) as src:
+        data = src.read()
+    with rasterio.open(tmp_path / "cog.tif") as src:
+        assert (data == src.read()).all()
@@ -0,0 +1,106 @@
+import json
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from mapa_streamlit.cache import TMP_PREFIX, Manifest, atomic_write, file_lock
+
+
+def test_atomic_write(tmp_path) -> None:
+    path = tmp_path / "scene.tif"
+    with atomic_write(path) as tmp:
+        assert tmp.parent == tmp_path and tmp.name.startswith(TMP_PREFIX) and tmp.suffix == ".tif"
+        tmp.write_bytes(b"complete")
+        # nothing is visible before the write finished
+        assert not path.exists()
+    assert path.read_bytes() == b"complete"
+    assert Manifest(tmp_path).is_valid(path)
+
+    # failed writes leave neither a torn file nor a temporary one behind
+    with pytest.raises(RuntimeError), atomic_write(path) as tmp:
+        tmp.write_bytes(b"torn")
+        raise RuntimeError
+    assert path.read_bytes() == b"complete"
+    assert not [f for f in tmp_path.iterdir() if f.name.startswith(TMP_PREFIX)]
+
+
+def test_manifest(tmp_path) -> None:
+    path = tmp_path / "scene.tif"
+    path.write_bytes(b"scene")
+    # files written by other means are not trusted
+    assert not Manifest(tmp_path).is_valid(path)
+    Manifest(tmp_path).add(path)
+    assert Manifest(tmp_path).is_valid(path)
+    path.write_bytes(b"modified")
+    assert not Manifest(tmp_path).is_valid(path)
+    path.unlink()
+    assert not Manifest(tmp_path).is_valid(path)
+
+
+def test_manifest_appends_and_compacts(monkeypatch, tmp_path) -> None:
+    monkeypatch.setattr("mapa_streamlit.conf.CACHE_MANIFEST_COMPACT_MIN_LINES", 4)
+    paths = [tmp_path / f"scene-{i}.tif" for i in range(3)]
+    for path in paths:
+        path.write_bytes(b"scene")
+
+    threads = [threading.Thread(target=Manifest(tmp_path).add, args=(path,)) for path in paths]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    manifest = Manifest(tmp_path)
+    assert all(manifest.is_valid(path) for path in paths)
+    # one line per write, a torn line of an interrupted write is ignored
+    with open(manifest.path, "a") as f:
+        f.write('{"name": "scene-3.t')
+    assert len(manifest.path.read_text().splitlines()) == 4
+    assert all(Manifest(tmp_path).is_valid(path) for path in paths)
+
+    # rewritten and deleted files make the log mostly superseded, it is compacted on the next read
+    paths[0].write_bytes(b"rewritten")
+    for _ in range(3):
+        Manifest(tmp_path).add(paths[0])
+    paths[1].unlink()
+    assert Manifest(tmp_path).is_valid(paths[0])
+    # the order of the concurrent adds isn't deterministic, only one line per remaining file is
+    names = [json.loads(line)["name"] for line in manifest.path.read_text().splitlines()]
+    assert sorted(names) == [p.name for p in paths[::2]]
+
+
+def test_file_lock_excludes_threads(tmp_path) -> None:
+    inside, overlaps = [], []
+
+    def _work() -> None:
+        with file_lock(tmp_path / "key"):
+            overlaps.append(len(inside))
+            inside.append(1)
+            time.sleep(0.02)
+            inside.pop()
+
+    threads = [threading.Thread(target=_work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert overlaps == [0, 0, 0, 0]
+
+
+def test_file_lock_excludes_processes(tmp_path) -> None:
+    script = f"from mapa_streamlit.cache import file_lock\nwith file_lock({str(tmp_path / 'key')!r}): input()"
+    other = subprocess.Popen([sys.executable, "-c", script], stdin=subprocess.PIPE)
+    try:
+        # wait for the other process to hold the lock
+        deadline = time.monotonic() + 30
+        while not (tmp_path / "key.lock").exists() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        time.sleep(0.5)
+        with pytest.raises(TimeoutError):
+            with file_lock(tmp_path / "key", timeout=0.2):
+                pass
+    finally:
+        other.communicate(b"\n", timeout=30)
+    with file_lock(tmp_path / "key", timeout=0.2):
+        pass
@@ -0,0 +1,127 @@
+from datetime import datetime, timezone
+
+import pystac
+import pytest
+
+from mapa_streamlit.catalog import (
+    GeoParquetCatalog,
+    StacApiCatalog,
+    StaticCatalog,
+    _parse_datetime_range,
+    get_catalog,
+    write_geoparquet,
+)
+
+COLLECTION = "sentinel-2-l2a"
+BBOX = [11.0, 47.0, 11.5, 47.5]
+
+
+def _item(i: int, bbox=BBOX) -> pystac.Item:
+    west, south, east, north = bbox
+    item = pystac.Item(
+        f"scene-{i}",
+        geometry={
+            "type": "Polygon",
+            "coordinates": [[[west, south], [east, south], [east, north], [west, north], [west, south]]],
+        },
+        bbox=bbox,
+        datetime=datetime(2023, 6, 1 + i, 10, tzinfo=timezone.utc),
+        properties={"eo:cloud_cover": (i * 37) % 100},
+        collection=COLLECTION,
+    )
+    item.add_asset("B04", pystac.Asset(f"./{item.id}/B04.tif", roles=["data"]))
+    return item
+
+
+def _collection(items) -> pystac.Collection:
+    collection = pystac.Collection(
+        COLLECTION,
+        "synthetic scenes",
+        pystac.Extent(pystac.SpatialExtent([BBOX]), pystac.TemporalExtent([[None, None]])),
+        summaries=pystac.Summaries({"eo:bands": [{"name": "B04", "common_name": "red"}]}),
+    )
+    collection.add_items(items)
+    return collection
+
+
+@pytest.fixture
+def static_catalog(tmp_path) -> StaticCatalog:
+    items = [_item(i) for i in range(8)] + [_item(8, bbox=[0.0, 0.0, 0.5, 0.5])]
+    catalog = pystac.Catalog("mirror", "local mirror")
+    catalog.add_child(_collection(items))
+    catalog.normalize_hrefs(str(tmp_path / "mirror"))
+    catalog.save(pystac.CatalogType.SELF_CONTAINED)
+    return StaticCatalog(tmp_path / "mirror")
+
+
+@pytest.fixture
+def geoparquet_catalog(tmp_path) -> GeoParquetCatalog:
+    pytest.importorskip("pyarrow", exc_type=ImportError)
+    items = [_item(i) for i in range(8)] + [_item(8, bbox=[0.0, 0.0, 0.5, 0.5])]
+    for item in items:
+        item.assets["B04"].href = f"/data/{item.id}/B04.tif"
+    return GeoParquetCatalog(write_geoparquet(items, tmp_path / "items.parquet", [_collection([])]))
+
+
+def _search(catalog, **kwargs):
+    search = dict(
+        collections=[COLLECTION],
+        bbox=[11.2, 47.2, 11.3, 47.3],
+        datetime="2023-06-01/2023-06-07",
+        query={"eo:cloud_cover": {"lt": 80}},
+        sortby=[{"field": "eo:cloud_cover", "direction": "asc"}],
+        limit=2,
+    )
+    return list(catalog.search_pages(**{**search, **kwargs}))
+
+
+def test__parse_datetime_range() -> None:
+    start, end = _parse_datetime_range("2023-06-01/2023-06-07")
+    assert start == datetime(2023, 6, 1, tzinfo=timezone.utc)
+    assert end.date().day == 7 and end.hour == 23
+    assert _parse_datetime_range("../2023-06-07T10:00:00Z")[0] is None
+    assert _parse_datetime_range("2023-06-01") == (start, _parse_datetime_range("2023-06-01/2023-06-01")[1])
+
+
+@pytest.mark.parametrize("backend", ["static_catalog", "geoparquet_catalog"])
+def test_local_catalog_search(backend, request) -> None:
+    catalog = request.getfixturevalue(backend)
+    pages = _search(catalog)
+
+    items = [item for page in pages for item in page.items]
+    # scene 7 is out of the date range, scene 8 out of the bbox and scene 5 too cloudy
+    assert sorted(item.id for item in items) == ["scene-0", "scene-1", "scene-2", "scene-3", "scene-4", "scene-6"]
+    cloud_cover = [item.properties["eo:cloud_cover"] for item in items]
+    assert cloud_cover == sorted(cloud_cover)
+    assert [len(page.items) for page in pages] == [2, 2, 2]
+
+    assert len(_search(catalog, max_items=3)[-1].items) == 1
+    assert all(href.startswith("/") for item in items for href in [item.assets["B04"].href])
+
+
+@pytest.mark.parametrize("backend", ["static_catalog", "geoparquet_catalog"])
+def test_local_catalog_search_intersects(backend, request) -> None:
+    catalog = request.getfixturevalue(backend)
+    # the bbox of the triangle overlaps scene 8, the triangle itself doesn't
+    triangle = {"type": "Polygon", "coordinates": [[[0.6, 0.6], [11.2, 47.2], [0.6, 47.2], [0.6, 0.6]]]}
+    pages = _search(catalog, bbox=None, intersects=triangle, query=None, datetime="2023-06-01/2023-06-09")
+    assert sorted(item.id for page in pages for item in page.items) == [f"scene-{i}" for i in range(8)]
+
+
+@pytest.mark.parametrize("backend", ["static_catalog", "geoparquet_catalog"])
+def test_local_catalog_get_collection(backend, request) -> None:
+    collection = request.getfixturevalue(backend).get_collection(COLLECTION)
+    assert collection.summaries.get_list("eo:bands") == [{"name": "B04", "common_name": "red"}]
+
+
+def test_get_catalog(monkeypatch, tmp_path) -> None:
+    assert isinstance(get_catalog("stac-api", "https://example.com/stac"), StacApiCatalog)
+
+    monkeypatch.setattr("mapa_streamlit.conf.CATALOG_BACKEND", "geoparquet")
+    monkeypatch.setattr("mapa_streamlit.conf.CATALOG_PATH", str(tmp_path / "items.parquet"))
+    catalog = get_catalog()
+    assert isinstance(catalog, GeoParquetCatalog)
+    assert get_catalog() is catalog
+
+    with pytest.raises(ValueError, match="unknown catalog backend"):
+        get_catalog("ftp", "somewhere")
@@ -0,0 +1,134 @@
+import json
+from pathlib import Path
+
+import pytest
+
+from mapa_streamlit import cli
+from mapa_streamlit.cli import AOI, BatchParameters, read_aois, read_manifest, run_batch
+from mapa_streamlit.planning import AOIFetch
+
+POLYGON = {"type": "Polygon", "coordinates": [[[11.0, 47.0], [11.1, 47.0], [11.1, 47.1], [11.0, 47.1], [11.0, 47.0]]]}
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    """Replaces the pipeline with a fake writing an empty archive, failing for AOIs named `broken`."""
+    calls = []
+
+    def _convert_bbox_to_tif(output_file, bbox_geometry, **kwargs):
+        calls.append(Path(output_file).name)
+        if Path(output_file).name == "broken":
+            raise RuntimeError("read failed")
+        if Path(output_file).name == "nothing":
+            return None
+        Path(f"{output_file}.zip").touch()
+        return Path(f"{output_file}.zip")
+
+    monkeypatch.setattr(cli, "convert_bbox_to_tif", _convert_bbox_to_tif)
+    return calls
+
+
+def _feature_collection(tmp_path: Path, ids) -> Path:
+    path = tmp_path / "aois.geojson"
+    features = [{"type": "Feature", "properties": {"name": i}, "geometry": POLYGON} for i in ids]
+    path.write_text(json.dumps({"type": "FeatureCollection", "features": features}))
+    return path
+
+
+def test_read_aois(tmp_path) -> None:
+    path = _feature_collection(tmp_path, ["munich west", "alps"])
+    assert [aoi.id for aoi in read_aois(path, id_property="name")] == ["munich_west", "alps"]
+    # without id property the position is used
+    assert [aoi.id for aoi in read_aois(path)] == ["0", "1"]
+
+    with pytest.raises(ValueError, match="duplicates"):
+        read_aois(_feature_collection(tmp_path, ["alps", "alps"]), id_property="name")
+
+    point = {"type": "Feature", "geometry": {"type": "Point", "coordinates": [11.0, 47.0]}}
+    path.write_text(json.dumps({"type": "FeatureCollection", "features": [point]}))
+    with pytest.raises(ValueError, match="only Polygon, MultiPolygon"):
+        read_aois(path)
+
+
+def test_run_batch_resumes(tmp_path, calls) -> None:
+    params = BatchParameters(date_range="2023-06-01/2023-07-31")
+    aois = [AOI(id=name, geometry=POLYGON) for name in ["a", "broken", "nothing", "b"]]
+
+    results = run_batch(aois, params, tmp_path / "out", cache_dir=tmp_path / "cache")
+    assert [r.status for r in results] == ["done", "failed", "empty", "done"]
+    assert results[0].outputs == [str(tmp_path / "out" / "a.zip")]
+    assert "read failed" in results[1].error
+
+    manifest = read_manifest(tmp_path / "out" / "manifest.jsonl")
+    assert {aoi: result.status for aoi, result in manifest.items()} == {
+        "a": "done",
+        "broken": "failed",
+        "nothing": "empty",
+        "b": "done",
+    }
+
+    # a second run only retries the failed aoi
+    calls.clear()
+    run_batch(aois, params, tmp_path / "out", cache_dir=tmp_path / "cache")
+    assert calls == ["broken"]
+    calls.clear()
+    run_batch(aois, params, tmp_path / "out", cache_dir=tmp_path / "cache", retry_failed=False)
+    assert calls == []
+
+    # changed parameters invalidate the previous results
+    run_batch(aois, BatchParameters(date_range="2024-06-01/2024-07-31"), tmp_path / "out", cache_dir=tmp_path / "cache")
+    assert calls == ["a", "broken", "nothing", "b"]
+
+
+def test_read_manifest_skips_truncated_lines(tmp_path) -> None:
+    path = tmp_path / "manifest.jsonl"
+    path.write_text(
+        json.dumps({"aoi": "a", "status": "done", "seconds": 1.0, "params": "x"}) + "\n" + '{"aoi": "b", "sta'
+    )
+    assert list(read_manifest(path)) == ["a"]
+
+
+def test_main(tmp_path, calls, capsys) -> None:
+    aois = _feature_collection(tmp_path, ["a", "broken"])
+    params = tmp_path / "params.json"
+    params.write_text(json.dumps({"collection": "landsat-c2-l2", "bands": ["red"], "date_range": "2023"}))
+
+    exit_code = cli.main([str(aois), "-o", str(tmp_path / "out"), "--params", str(params), "--id-property", "name",
+                          "--cloud-cover", "5"])
+    assert exit_code == 1
+    assert calls == ["a", "broken"]
+    summary = capsys.readouterr().out
+    assert "1 done, 0 empty, 1 failed" in summary
+
+
+def test_run_batch_merges_overlapping_aois(tmp_path, calls, monkeypatch) -> None:
+    groups = []
+
+    def _fetch_stac_items_for_aois(aois, *args, **kwargs):
+        groups.append(sorted(aois))
+        return {aoi_id: AOIFetch(paths=[], array=None, xarray=None, seconds=1.0) for aoi_id in aois if aoi_id != "c"}
+
+    monkeypatch.setattr(cli, "fetch_stac_items_for_aois", _fetch_stac_items_for_aois)
+    shifted = {"type": "Polygon", "coordinates": [[[x + 0.05, y] for x, y in POLYGON["coordinates"][0]]]}
+    far_away = {"type": "Polygon", "coordinates": [[[x + 5, y] for x, y in POLYGON["coordinates"][0]]]}
+    aois = [AOI("a", POLYGON), AOI("b", shifted), AOI("c", POLYGON), AOI("d", far_away)]
+
+    results = run_batch(aois, BatchParameters(date_range="2023"), tmp_path / "out", merge_overlapping=True)
+    assert groups == [["a", "b", "c"]]
+    # the single aoi takes the regular path
+    assert calls == ["d"]
+    assert {r.aoi: r.status for r in results} == {"a": "done", "b": "done", "c": "empty", "d": "done"}
+    assert (tmp_path / "out" / "a.zip").is_file()
+
+
+def test_run_batch_does_not_merge_with_max_items(tmp_path, calls, monkeypatch) -> None:
+    groups = []
+    monkeypatch.setattr(cli, "fetch_stac_items_for_aois", lambda aois, *args, **kwargs: groups.append(sorted(aois)))
+    shifted = {"type": "Polygon", "coordinates": [[[x + 0.05, y] for x, y in POLYGON["coordinates"][0]]]}
+    aois = [AOI("a", POLYGON), AOI("b", shifted)]
+
+    results = run_batch(aois, BatchParameters(date_range="2023", max_items=2), tmp_path / "out", merge_overlapping=True)
+    # max_items applies to each aoi, so they are fetched one by one
+    assert groups == []
+    assert sorted(calls) == ["a", "b"]
+    assert {r.aoi: r.status for r in results} == {"a": "done", "b": "done"}
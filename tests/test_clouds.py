@@ -0,0 +1,27 @@
+import numpy as np
+import xarray as xr
+
+from mapa_streamlit.clouds import get_clear_fractions, get_observed_mask
+
+
+def test_get_observed_mask() -> None:
+    qa_pixel = xr.DataArray(np.array([0, 0b1, 0b1000, 0b1000000], dtype="uint16"), dims="time")
+    observed = get_observed_mask(xr.Dataset({"qa_pixel": qa_pixel}), "landsat-c2-l2")
+    # nodata and fill values aren't observed, clouds are
+    assert observed.values.tolist() == [False, False, True, True]
+    assert get_observed_mask(xr.Dataset({"qa_pixel": qa_pixel}), "cop-dem-glo-30") is None
+
+
+def test_get_clear_fractions() -> None:
+    scl = np.array(
+        [
+            [[4, 4], [4, 4]],  # clear
+            [[4, 9], [0, 0]],  # half of the observed pixels are clouds
+            [[0, 0], [0, 0]],  # outside of the footprint
+            [[8, 9], [3, 10]],  # clouds, cloud shadow and cirrus
+        ],
+        dtype="uint8",
+    )
+    xx = xr.Dataset({"SCL": (("time", "y", "x"), scl)})
+    np.testing.assert_allclose(get_clear_fractions(xx, "sentinel-2-l2a").values, [1.0, 0.5, 0.0, 0.0])
+    assert get_clear_fractions(xx.rename(SCL="B04"), "sentinel-2-l2a") is None
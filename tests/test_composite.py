@@ -0,0 +1,129 @@
+import dask
+import dask.array as da
+import numpy as np
+import pandas as pd
+import pytest
+import rasterio as rio
+import xarray as xr
+from odc.geo.geobox import GeoBox
+from odc.geo.xr import xr_coords
+
+from mapa_streamlit.composite import composite, get_clear_mask, save_composite
+from mapa_streamlit.reads import HedgedReader
+
+COLLECTION = "sentinel-2-l2a"
+GEOBOX = GeoBox.from_bbox((500_000, 5_290_000, 500_400, 5_290_300), crs="EPSG:32632", resolution=10)
+
+
+def _dataset(red: list, scl: list, chunk: int = 8) -> xr.Dataset:
+    """Scenes of constant reflectance and scene class, shape (time, 30, 40)."""
+    time = pd.date_range("2023-06-01", periods=len(red), freq="5D")
+    shape = (len(red),) + GEOBOX.shape
+    coords = {"time": time, **xr_coords(GEOBOX)}
+    dims = ("time", "y", "x")
+    xx = xr.Dataset(
+        {
+            "B04": (dims, np.broadcast_to(np.array(red, dtype="uint16")[:, None, None], shape)),
+            "SCL": (dims, np.broadcast_to(np.array(scl, dtype="uint8")[:, None, None], shape)),
+        },
+        coords=coords,
+    )
+    return xx.chunk({"time": 1, "y": chunk, "x": chunk})
+
+
+def test_get_clear_mask() -> None:
+    clear = get_clear_mask(_dataset([1, 1, 1], [4, 9, 3]), COLLECTION)
+    assert clear.isel(y=0, x=0).values.tolist() == [True, False, False]
+
+    qa_pixel = xr.DataArray(np.array([0b0, 0b1000, 0b10000, 0b1000000], dtype="uint16"), dims="time")
+    clear = get_clear_mask(xr.Dataset({"qa_pixel": qa_pixel}), "landsat-c2-l2")
+    assert clear.values.tolist() == [True, False, False, True]
+
+    assert get_clear_mask(xr.Dataset({"B04": qa_pixel}), COLLECTION) is None
+
+
+@pytest.mark.parametrize(
+    "method, expected",
+    [("median", 200), ("mean", 200), ("percentile", 300), ("min-cloud", 300)],
+)
+def test_composite(method, expected, monkeypatch) -> None:
+    monkeypatch.setattr("mapa_streamlit.conf.COMPOSITE_CHUNK_SIZE", 16)
+    # the cloud and the nodata scene must not enter the composite, the 4th scene is the clearest one with data
+    xx = _dataset([100, 5000, 0, 300, 200], [4, 9, 4, 4, 4])
+    xx["SCL"][0, :5] = 9
+    xx["SCL"][4, :10] = 9
+
+    result = composite(xx, ["B04"], COLLECTION, method=method, percentile=100)
+    assert result.dims == ("band", "y", "x")
+    assert result.dtype == np.float32
+    # spatially chunked, with all scenes of a pixel in one chunk
+    assert max(result.chunks[1]) <= 16 and max(result.chunks[2]) <= 16
+    assert float(result.isel(y=20, x=0)) == expected
+
+
+def test_composite_without_cloud_mask() -> None:
+    xx = _dataset([100, 5000, 200], [4, 9, 4])
+    assert float(composite(xx, ["B04"], COLLECTION, method="median", cloud_mask=False).max()) == 200
+    mean = composite(xx, ["B04"], COLLECTION, method="mean", cloud_mask=False)
+    assert float(mean.max()) == pytest.approx(1766.67, 1e-3)
+
+    # pixels without any clear observation are nodata
+    assert float(composite(xx.isel(time=[1]), ["B04"], COLLECTION).max()) == 0
+
+    with pytest.raises(ValueError, match="unknown composite method"):
+        composite(xx, ["B04"], COLLECTION, method="max")
+
+
+def test_save_composite(tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr("mapa_streamlit.conf.COMPOSITE_CHUNK_SIZE", 16)
+    xx = _dataset([100, 300, 200], [4, 4, 4])
+    xx["B03"] = xx["B04"] // 2
+    result = composite(xx, ["B04", "B03"], COLLECTION)
+
+    path = save_composite(result, tmp_path / "composite.tif", GEOBOX, composite="median", scenes=3)
+    with rio.open(path) as src:
+        assert (src.count, src.height, src.width) == (2, 30, 40)
+        assert src.crs.to_epsg() == 32632
+        assert src.transform == GEOBOX.affine
+        assert src.descriptions == ("B04", "B03")
+        assert src.tags()["scenes"] == "3"
+        assert src.block_shapes[0] == (16, 16)
+        np.testing.assert_array_equal(src.read(1), 200)
+        np.testing.assert_array_equal(src.read(2), 100)
+
+
+def test_save_composite_retries_failed_blocks(tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr("mapa_streamlit.conf.COMPOSITE_CHUNK_SIZE", 16)
+    monkeypatch.setattr("mapa_streamlit.conf.READ_FAIL_ON_ERROR", False)
+
+    def _block(height: int, width: int, failures: int):
+        calls = []
+
+        def read():
+            calls.append(1)
+            if len(calls) <= failures:
+                raise IOError("range request failed")
+            return np.full((1, height, width), 7, dtype="float32")
+
+        return da.from_delayed(dask.delayed(read)(), shape=(1, height, width), dtype="float32")
+
+    # blocks aligned to the composite chunks, the one of the last column of the second row fails
+    top = [da.full((1, 16, width), 7, dtype="float32") for width in (16, 16, 8)]
+    bottom = [da.full((1, 14, 16), 7, dtype="float32"), _block(14, 16, 1), _block(14, 8, 100)]
+    data = da.concatenate([da.concatenate(top, axis=2), da.concatenate(bottom, axis=2)], axis=1)
+    result = xr.DataArray(data, dims=("band", "y", "x"), coords={"band": ["B04"]})
+
+    path = save_composite(result, tmp_path / "composite.tif", GEOBOX, reader=HedgedReader(max_retries=2, backoff=0.0))
+    with rio.open(path) as src:
+        # the flaky block is read again, the failing one is left as nodata
+        values = src.read(1)
+        np.testing.assert_array_equal(values[:, :32], 7)
+        np.testing.assert_array_equal(values[:16, 32:], 7)
+        np.testing.assert_array_equal(values[16:, 32:], 0)
+        assert src.tags()["read_reads"] == "6"
+        assert src.tags()["read_retries"] == "3"
+        assert src.tags()["read_errors"] == "1"
+
+    monkeypatch.setattr("mapa_streamlit.conf.READ_FAIL_ON_ERROR", True)
+    with pytest.raises(IOError):
+        save_composite(result, tmp_path / "failed.tif", GEOBOX, reader=HedgedReader(max_retries=0, backoff=0.0))
@@ -0,0 +1,78 @@
+import numpy as np
+import pandas as pd
+import pystac
+import pytest
+import xarray as xr
+from odc.geo.geobox import GeoBox
+from odc.geo.xr import xr_coords
+
+from mapa_streamlit import datacube
+from mapa_streamlit.datacube import append_to_datacube, fetch_stac_items_to_datacube, get_datacube_days, open_datacube
+
+pytest.importorskip("zarr")
+
+GEOBOX = GeoBox.from_bbox((500_000, 5_290_000, 500_400, 5_290_300), crs="EPSG:32632", resolution=10)
+BANDS = ["B04", "B08"]
+
+
+def _scenes(times) -> xr.Dataset:
+    time = pd.to_datetime(times)
+    shape = (len(time),) + GEOBOX.shape
+    dims = ("time", "y", "x")
+    return xr.Dataset(
+        {band: (dims, np.zeros(shape, dtype="uint16"), {"nodata": 0}) for band in BANDS},
+        coords={"time": time, **xr_coords(GEOBOX)},
+    )
+
+
+def _array(xx: xr.Dataset) -> np.ndarray:
+    days = np.arange(1, xx.sizes["time"] + 1, dtype="uint16") * pd.to_datetime(xx.time.values).day.values
+    shape = (xx.sizes["time"],) + GEOBOX.shape + (len(BANDS),)
+    return np.broadcast_to(days[:, None, None, None], shape).astype("uint16")
+
+
+def test_append_to_datacube(tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr("mapa_streamlit.conf.DATACUBE_CHUNK_SIZE", 16)
+    path = tmp_path / "cube.zarr"
+    assert open_datacube(path) is None
+    assert get_datacube_days(None) == set()
+
+    first = _scenes(["2023-06-01T10:30:21.024", "2023-06-06T10:30:19.000"])
+    append_to_datacube(first, _array(first), path, BANDS)
+    chunks = sorted(p.name for p in (path / "B04").iterdir() if not p.name.startswith("."))
+    second = _scenes(["2023-06-11T10:30:20.000"])
+    append_to_datacube(second, _array(second), path, BANDS)
+
+    cube = open_datacube(path)
+    assert get_datacube_days(cube) == {"2023-06-01", "2023-06-06", "2023-06-11"}
+    assert pd.to_datetime(cube.time.values[0]) == pd.Timestamp("2023-06-01T10:30:21.024")
+    assert cube["B04"].dtype == np.uint16
+    assert cube["B04"].encoding["chunks"] == (1, 16, 16)
+    np.testing.assert_array_equal(cube["B08"].isel(y=0, x=0).values, [1, 12, 11])
+    # the chunks of the first scenes are left untouched
+    assert set(chunks) <= {p.name for p in (path / "B04").iterdir()}
+    assert not any(name.startswith("2.") for name in chunks)
+
+    # the georeferencing is stored once and restored on opening
+    assert cube.odc.geobox == GEOBOX
+
+
+def test_fetch_stac_items_to_datacube_reads_scene_by_scene(tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr("mapa_streamlit.conf.DATACUBE_CHUNK_SIZE", 16)
+    xx = _scenes(["2023-06-01T10:30", "2023-06-06T10:30", "2023-06-11T10:30"]).chunk({"time": 1})
+    item = pystac.Item("scene", geometry=None, bbox=None, datetime=pd.Timestamp("2023-06-01"), properties={})
+    monkeypatch.setattr(datacube, "iter_stac_item_pages", lambda *args, **kwargs: iter([pystac.ItemCollection([item])]))
+    monkeypatch.setattr(datacube, "_load_items", lambda *args: xx)
+    reads = []
+    read_dataset = datacube.read_dataset
+
+    def _read_dataset(scene, *args, **kwargs):
+        reads.append(scene.sizes["time"])
+        return read_dataset(scene, *args, **kwargs)
+
+    monkeypatch.setattr(datacube, "read_dataset", _read_dataset)
+
+    path = fetch_stac_items_to_datacube(BANDS, "sentinel-2-l2a", {}, tmp_path / "cube.zarr", "2023-06", 20)
+    # only a single scene is held in memory at a time
+    assert reads == [1, 1, 1]
+    assert get_datacube_days(open_datacube(path)) == {"2023-06-01", "2023-06-06", "2023-06-11"}
@@ -0,0 +1,58 @@
+import dask.array as da
+import numpy as np
+import xarray as xr
+from odc.geo.geobox import GeoBox
+from odc.geo.xr import xr_coords
+
+from mapa_streamlit.geometry import is_rectangle, mask_outside_geometry, union_geometry
+
+GEOBOX = GeoBox.from_bbox((11.0, 47.0, 11.4, 47.4), crs="EPSG:4326", resolution=0.01)
+RECTANGLE = {"type": "Polygon", "coordinates": [[[11.0, 47.0], [11.1, 47.0], [11.1, 47.1], [11.0, 47.1], [11.0, 47.0]]]}
+# triangle in the south west half of the geobox
+TRIANGLE = {"type": "Polygon", "coordinates": [[[11.0, 47.0], [11.4, 47.0], [11.0, 47.4], [11.0, 47.0]]]}
+
+
+def test_is_rectangle() -> None:
+    assert is_rectangle(RECTANGLE)
+    assert not is_rectangle(TRIANGLE)
+    # a rhombus has four corners, but isn't axis aligned
+    assert not is_rectangle(
+        {"type": "Polygon", "coordinates": [[[11.0, 47.05], [11.05, 47.0], [11.1, 47.05], [11.05, 47.1], [11.0, 47.05]]]}
+    )
+    assert not is_rectangle({"type": "MultiPolygon", "coordinates": [RECTANGLE["coordinates"]]})
+
+
+def test_union_geometry() -> None:
+    other = {
+        "type": "Polygon",
+        "coordinates": [[[11.05, 47.0], [11.2, 47.0], [11.2, 47.1], [11.05, 47.1], [11.05, 47.0]]],
+    }
+    union = union_geometry([RECTANGLE, other])
+    assert union["type"] == "Polygon"
+    far = {"type": "Polygon", "coordinates": [[[12.0, 47.0], [12.1, 47.0], [12.1, 47.1], [12.0, 47.1], [12.0, 47.0]]]}
+    assert union_geometry([RECTANGLE, far])["type"] == "MultiPolygon"
+
+
+def test_mask_outside_geometry() -> None:
+    reads = []
+
+    def _read(block, block_info=None):
+        reads.append(block_info[0]["chunk-location"])
+        return block
+
+    data = da.ones((2, 40, 40), dtype="uint16", chunks=(1, 10, 10)).map_blocks(_read, dtype="uint16")
+    xx = xr.Dataset({"B04": (("time", "latitude", "longitude"), data)}, coords=xr_coords(GEOBOX))
+
+    masked = mask_outside_geometry(xx, TRIANGLE)
+    assert masked["B04"].dtype == np.uint16
+    assert masked["B04"].chunks == xx["B04"].chunks
+    values = masked["B04"].values
+    # the north east corner block is outside the triangle and never read
+    assert (1, 0, 3) not in reads and (1, 3, 0) in reads
+    assert len(reads) < 2 * 16
+    # latitudes descend, hence the south west corner is in the last row
+    assert values[0, -1, 0] == 1 and values[0, 0, -1] == 0
+    assert 0.5 < values.mean() < 0.6
+
+    # in memory datasets are masked the same way
+    np.testing.assert_array_equal(mask_outside_geometry(xx.compute(), TRIANGLE)["B04"].values, values)
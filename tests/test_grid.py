@@ -0,0 +1,140 @@
+from datetime import datetime
+
+import numpy as np
+import pystac
+import pytest
+import rasterio
+from pyproj import Transformer
+from rasterio.transform import from_origin
+
+from mapa_streamlit import conf, grid
+from mapa_streamlit.grid import estimate_read_bytes, get_anchor, get_block_shape, plan_read
+from mapa_streamlit.stac import _load_items
+
+# landsat like grid, of which the pixel edges are offset by half a pixel from multiples of the resolution
+ORIGIN = (500_025, 5_300_025)
+RESOLUTION = 30
+
+
+@pytest.fixture(autouse=True)
+def block_shapes(monkeypatch):
+    """Block shapes read by other tests are not reused."""
+    monkeypatch.setattr(grid, "_block_shapes", {})
+
+
+def _write_cog(path, size: int = 512, blocksize: int = 128) -> np.ndarray:
+    data = np.arange(1, size * size + 1, dtype="uint32").reshape(1, size, size)
+    profile = {
+        "driver": "COG",
+        "width": size,
+        "height": size,
+        "count": 1,
+        "dtype": "uint32",
+        "crs": "EPSG:32632",
+        "transform": from_origin(*ORIGIN, RESOLUTION, RESOLUTION),
+        "nodata": 0,
+        "blocksize": blocksize,
+    }
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(data)
+    return data[0]
+
+
+def _item(href: str, size: int = 512) -> pystac.Item:
+    item = pystac.Item(
+        "scene",
+        geometry=None,
+        bbox=None,
+        datetime=datetime(2023, 6, 1, 10),
+        properties={
+            "proj:epsg": 32632,
+            "proj:shape": [size, size],
+            "proj:transform": list(from_origin(*ORIGIN, RESOLUTION, RESOLUTION))[:6],
+        },
+        stac_extensions=["https://stac-extensions.github.io/projection/v1.1.0/schema.json"],
+    )
+    item.add_asset("B04", pystac.Asset(href, media_type=pystac.MediaType.COG, roles=["data"]))
+    return item
+
+
+def _aoi(x0: float, y0: float, x1: float, y1: float) -> dict:
+    to_lon_lat = Transformer.from_crs(32632, 4326, always_xy=True)
+    ring = [to_lon_lat.transform(x, y) for x, y in [(x0, y0), (x0, y1), (x1, y1), (x1, y0), (x0, y0)]]
+    return {"type": "Polygon", "coordinates": [[list(c) for c in ring]]}
+
+
+def test_get_anchor() -> None:
+    assert tuple(get_anchor(from_origin(*ORIGIN, RESOLUTION, RESOLUTION)).xy) == (0.5, 0.5)
+    assert tuple(get_anchor(from_origin(500_000, 5_300_000, 10, 10)).xy) == (0, 0)
+
+
+def test_get_block_shape(tmp_path) -> None:
+    (tmp_path / "a").mkdir()
+    (tmp_path / "b").mkdir()
+    _write_cog(tmp_path / "a" / "B04.tif")
+    _write_cog(tmp_path / "b" / "B04.tif", blocksize=256)
+
+    assert get_block_shape("landsat-c2-l2", "B04", str(tmp_path / "a" / "B04.tif")) == (128, 128)
+    # assets of another directory, e.g. of another catalog with the same collection, are read on their own
+    assert get_block_shape("landsat-c2-l2", "B04", str(tmp_path / "b" / "B04.tif")) == (256, 256)
+    assert get_block_shape("landsat-c2-l2", "B04", str(tmp_path / "a" / "missing.tif")) == (128, 128)
+
+
+def test_plan_read(tmp_path) -> None:
+    _write_cog(tmp_path / "B04.tif")
+    items = [_item(str(tmp_path / "B04.tif"))]
+    aoi = _aoi(ORIGIN[0] + 4_000, ORIGIN[1] - 9_000, ORIGIN[0] + 8_000, ORIGIN[1] - 5_000)
+
+    plan = plan_read(items, aoi, ["B04"], chunks={"x": 100, "y": 100})
+    # the snapped grid starts and ends on block edges of the scene
+    col, row = ~from_origin(*ORIGIN, RESOLUTION, RESOLUTION) * (plan.geobox.transform.c, plan.geobox.transform.f)
+    assert (col % 128, row % 128) == (0, 0)
+    assert plan.geobox.shape[0] % 128 == 0 and plan.geobox.shape[1] % 128 == 0
+    assert plan.chunks == {"x": 128, "y": 128}
+    # the requested grid is within the blocks around it, on the pixel grid of the scene
+    requested = plan.geobox[plan.roi]
+    for size, roi in zip(plan.geobox.shape, plan.roi):
+        assert 0 <= roi.start < 128 and size - 128 < roi.stop <= size
+    assert tuple(get_anchor(requested.transform).xy) == (0.5, 0.5)
+
+    # later pages are loaded on the grid of the first one
+    assert plan_read(items, aoi, ["B04"], geobox=requested).roi == plan.roi
+    # grids which are not on the pixel grid of the scenes can't be snapped
+    assert plan_read(items, aoi, ["B04"], geobox=requested.translate_pix(0.5, 0)) is None
+    # items without projection metadata neither
+    items[0].properties = {"datetime": "2023-06-01T10:00:00Z"}
+    assert plan_read(items, aoi, ["B04"]) is None
+
+
+def test_load_items_on_source_grid(tmp_path, monkeypatch) -> None:
+    data = _write_cog(tmp_path / "B04.tif")
+    items = pystac.ItemCollection([_item(str(tmp_path / "B04.tif"))])
+    aoi = _aoi(ORIGIN[0] + 4_010, ORIGIN[1] - 9_010, ORIGIN[0] + 8_010, ORIGIN[1] - 5_010)
+
+    monkeypatch.setattr(conf, "READ_GRID", "source")
+    xx = _load_items(items, aoi, bands=["B04"], chunks={"x": 100, "y": 100})
+    values = xx["B04"].values[0]
+
+    # the pixels are the source pixels as they are, without resampling
+    transform = xx.odc.geobox.transform
+    col, row = ~from_origin(*ORIGIN, RESOLUTION, RESOLUTION) * (transform.c, transform.f)
+    col, row = round(col), round(row)
+    np.testing.assert_array_equal(values, data[row : row + values.shape[0], col : col + values.shape[1]])
+    # chunks are aligned to the blocks of the cog, only the outer ones are cut by the aoi
+    assert xx["B04"].chunks[1] == (128 - row % 128, values.shape[0] - 128 + row % 128)
+    assert xx["B04"].chunks[2] == (128 - col % 128, values.shape[1] - 128 + col % 128)
+    # the grid of the loaded page can be planned again for later pages
+    assert plan_read(items, aoi, ["B04"], geobox=xx.odc.geobox) is not None
+
+
+def test_estimate_read_bytes(tmp_path) -> None:
+    _write_cog(tmp_path / "B04.tif")
+    items = [_item(str(tmp_path / "B04.tif")), _item(str(tmp_path / "B04.tif")), _item(str(tmp_path / "B04.tif"))]
+    items[1].id, items[2].id = "same-day", "next-day"
+    items[2].datetime = datetime(2023, 6, 2, 10)
+    aoi = _aoi(ORIGIN[0] + 3_000, ORIGIN[1] - 6_000, ORIGIN[0] + 6_000, ORIGIN[1] - 3_000)
+
+    # two solar days of 100 x 100 pixels, loaded as float32 as the data type isn't part of the items
+    assert estimate_read_bytes(items, aoi, ["B04"]) == 2 * 100 * 100 * 4
+    items[0].properties = items[1].properties = items[2].properties = {"datetime": "2023-06-01T10:00:00Z"}
+    assert estimate_read_bytes(items, aoi, ["B04"]) is None
@@ -0,0 +1,51 @@
+import subprocess
+import sys
+
+# cumulative time in microseconds `import mapa_streamlit` may take, as reported by `python -X importtime`
+IMPORT_TIME_BUDGET_US = 300_000
+
+HEAVY_MODULES = (
+    "geogif",
+    "numpy",
+    "odc.stac",
+    "pandas",
+    "planetary_computer",
+    "pystac_client",
+    "rasterio",
+    "requests",
+    "rioxarray",
+    "stackstac",
+    "xarray",
+)
+
+
+def _import_mapa_streamlit():
+    return subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import sys, mapa_streamlit; print(' '.join(sys.modules))"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+
+def _get_cumulative_import_time(stderr: str, module: str) -> int:
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.split("|")
+        if name.strip() == module:
+            return int(cumulative)
+    raise ValueError(f"module {module} not found in importtime output")
+
+
+def test_import_does_not_load_heavy_dependencies() -> None:
+    loaded_modules = set(_import_mapa_streamlit().stdout.split())
+    assert not loaded_modules.intersection(HEAVY_MODULES)
+
+
+def test_import_time_budget() -> None:
+    # take the best of a few runs to not fail on a single slow run on busy CI machines
+    import_times = [
+        _get_cumulative_import_time(_import_mapa_streamlit().stderr, "mapa_streamlit") for _ in range(3)
+    ]
+    assert min(import_times) < IMPORT_TIME_BUDGET_US
@@ -0,0 +1,98 @@
+import dask.array as da
+import numpy as np
+import pytest
+import xarray as xr
+
+from mapa_streamlit.indices import (
+    InvalidExpression,
+    add_indices,
+    get_available_indices,
+    get_expression_bands,
+    parse_expression,
+    resolve_indices,
+)
+
+
+@pytest.mark.parametrize(
+    "expression",
+    [
+        "__import__('os').system('ls')",
+        "red.values",
+        "red[0]",
+        "lambda: 1",
+        "open(red)",
+        "sqrt",
+        "clip(red, a_min=0)",
+        "9 ** 9 ** 9",
+        "red ** nir",
+        "'red' + 1",
+        "red if nir else 1",
+        "red > 1",
+        "(" * 300 + "red" + ")" * 300,
+        "1",
+        "2 * (3 + 4)",
+        "sqrt(B04, B08)",
+        "abs()",
+        "min(B04)",
+        "max(B04, B08, 1)",
+        "clip(B04)",
+        "clip(B04, 0)",
+    ],
+)
+def test_parse_expression_rejects(expression) -> None:
+    with pytest.raises(InvalidExpression):
+        parse_expression(expression)
+
+
+def test_parse_expression() -> None:
+    parse_expression("clip((B08 - B04) / (B08 + B04), -1, 1) ** 2 + sqrt(abs(-red))")
+    assert get_expression_bands("(nir - red) / (nir + B8A)", "sentinel-2-l2a") == {"B08", "B04", "B8A"}
+    assert get_expression_bands("(nir - red) / (nir + red)", "landsat-c2-l2") == {"nir08", "red"}
+
+
+def test_resolve_indices() -> None:
+    assert resolve_indices(["ndvi", "ratio = B08 / B04"]) == {"NDVI": "(nir - red) / (nir + red)", "ratio": "B08 / B04"}
+    with pytest.raises(InvalidExpression, match="unknown index"):
+        resolve_indices(["NDXI"])
+    with pytest.raises(InvalidExpression, match="invalid index name"):
+        resolve_indices(["my index = B08"])
+
+
+def test_get_available_indices() -> None:
+    assert {"NDVI", "NBR", "EVI"} <= set(get_available_indices("sentinel-2-l2a"))
+    assert get_available_indices("cop-dem-glo-30") == []
+
+
+def test_add_indices() -> None:
+    red = np.array([[1000, 2000], [0, 3000]], dtype="uint16")
+    nir = np.array([[3000, 2000], [4000, 0]], dtype="uint16")
+    xx = xr.Dataset(
+        {
+            "B04": (("time", "y", "x"), da.from_array(red[None], chunks=(1, 1, 2))),
+            "B08": (("time", "y", "x"), da.from_array(nir[None], chunks=(1, 1, 2))),
+        }
+    )
+
+    result = add_indices(xx, {"NDVI": "(nir - red) / (nir + red)", "zero": "B04 - B04"}, "sentinel-2-l2a")
+    assert list(xx.data_vars) == ["B04", "B08"]
+    # evaluated lazily, on the chunks of the bands
+    assert isinstance(result["NDVI"].data, da.Array)
+    assert result["NDVI"].chunks == xx["B04"].chunks
+    assert result["NDVI"].dtype == np.float32
+    assert result["NDVI"].attrs["expression"] == "(nir - red) / (nir + red)"
+    # nodata in any of the bands is nodata in the index
+    np.testing.assert_allclose(result["NDVI"].values[0], [[0.5, 0.0], [np.nan, np.nan]])
+
+    with pytest.raises(InvalidExpression, match="not part of"):
+        add_indices(xx, {"NBR": "(nir - swir22) / (nir + swir22)"}, "sentinel-2-l2a")
+    with pytest.raises(InvalidExpression, match="doesn't use any band"):
+        add_indices(xx, resolve_indices(["ratio = 1"]), "sentinel-2-l2a")
+    with pytest.raises(InvalidExpression, match="takes 3 arguments"):
+        add_indices(xx, {"clipped": "clip(B04)"}, "sentinel-2-l2a")
+
+    result = add_indices(
+        xx, {"lower": "min(red, nir)", "upper": "max(red, nir)", "clipped": "clip(nir, 0, 0.2)"}, "sentinel-2-l2a"
+    )
+    np.testing.assert_allclose(result["lower"].values[0], [[0.1, 0.2], [np.nan, np.nan]], rtol=1e-6)
+    np.testing.assert_allclose(result["upper"].values[0], [[0.3, 0.2], [np.nan, np.nan]], rtol=1e-6)
+    np.testing.assert_allclose(result["clipped"].values[0], [[0.2, 0.2], [0.2, np.nan]], rtol=1e-6)
@@ -0,0 +1,104 @@
+import os
+import time
+from datetime import datetime, timezone
+
+import pystac
+import pytest
+
+from mapa_streamlit.catalog import write_geoparquet
+from mapa_streamlit.items import ItemStore, ItemTable, get_search_key
+
+pytest.importorskip("pyarrow", exc_type=ImportError)
+
+HREF = "https://account.blob.core.windows.net/container/scene-{i}/B04.tif"
+
+
+def _item(i: int) -> pystac.Item:
+    west, south = 11.0 + i / 10, 47.0
+    item = pystac.Item(
+        f"scene-{i}",
+        geometry={
+            "type": "Polygon",
+            "coordinates": [[[west, south], [west + 0.1, south], [west + 0.1, 47.1], [west, 47.1], [west, south]]],
+        },
+        bbox=[west, south, west + 0.1, 47.1],
+        datetime=datetime(2023, 6, 1 + i, 10, tzinfo=timezone.utc),
+        properties={"eo:cloud_cover": (i * 37) % 100},
+        collection="sentinel-2-l2a",
+    )
+    item.add_asset("B04", pystac.Asset(f"{HREF.format(i=i)}?st=2023&se=2023&sp=rl&sig=abc", roles=["data"]))
+    item.set_self_href(f"https://planetarycomputer.microsoft.com/api/stac/v1/items/{item.id}")
+    return item
+
+
+@pytest.fixture
+def table() -> ItemTable:
+    return ItemTable.from_items([_item(i) for i in range(5)])
+
+
+def test_item_table(table, monkeypatch) -> None:
+    assert len(table) == 5
+    assert table.ids == [f"scene-{i}" for i in range(5)]
+    # stored without sas tokens, they expire
+    assert table.get_hrefs("B04") == [HREF.format(i=i) for i in range(5)]
+    assert table.get_hrefs("B08") == [None] * 5
+
+    # the items are signed again once they are created
+    def _sign_inplace(items) -> None:
+        for item in items:
+            item.assets["B04"].href += "?sig=new"
+
+    monkeypatch.setattr("mapa_streamlit.items.sign_inplace", _sign_inplace)
+    items = table.slice(1, 2).to_items()
+    assert [item.id for item in items] == ["scene-1", "scene-2"]
+    assert items[0].assets["B04"].href == f"{HREF.format(i=1)}?sig=new"
+    assert items[0].properties["eo:cloud_cover"] == 37
+    assert items[0].get_self_href().startswith("https://planetarycomputer.microsoft.com")
+    assert items[0].bbox == _item(1).bbox and items[0].geometry == _item(1).geometry
+
+
+def test_item_table_filter(table) -> None:
+    # cloud covers are 0, 37, 74, 11 and 48
+    assert table.filter(max_cloud_cover=40).ids == ["scene-0", "scene-1", "scene-3"]
+    assert table.filter(bbox=[11.15, 47.0, 11.25, 47.1]).ids == ["scene-1", "scene-2"]
+    start, end = datetime(2023, 6, 2, tzinfo=timezone.utc), datetime(2023, 6, 3, 23, tzinfo=timezone.utc)
+    assert table.filter(start=start, end=end, exclude_ids=["scene-2"]).ids == ["scene-1"]
+    assert table.filter(exclude_ids=set()).ids == table.ids
+    assert table.sort_by_cloud_cover().ids == ["scene-0", "scene-3", "scene-1", "scene-4", "scene-2"]
+    assert ItemTable.concat([table.slice(0, 1), table.slice(4, 1)]).ids == ["scene-0", "scene-4"]
+
+
+def test_item_table_solar_days(table) -> None:
+    assert table.solar_days == [f"2023-06-0{1 + i}" for i in range(5)]
+    assert table.filter(solar_days=["2023-06-02", "2023-06-04"]).ids == ["scene-1", "scene-3"]
+    # items which don't have an asset are None, also if the pages they come from were built without it
+    other = _item(5)
+    other.add_asset("B08", pystac.Asset(HREF.format(i=5).replace("B04", "B08")))
+    del other.assets["B04"]
+    pages = ItemTable.concat([table.slice(0, 1), ItemTable.from_items([other])])
+    assert pages.get_hrefs("B04") == [HREF.format(i=0), None]
+    assert pages.get_hrefs("B08") == [None, HREF.format(i=5).replace("B04", "B08")]
+    assert ItemTable.from_items([]).filter(max_cloud_cover=10).ids == []
+
+
+def test_item_table_is_geoparquet(table, tmp_path) -> None:
+    # the same layout as the mirrors of the geoparquet catalog backend
+    path = write_geoparquet([_item(i) for i in range(5)], tmp_path / "items.parquet")
+    mirrored = ItemTable.read(path)
+    assert set(mirrored.table.column_names) == set(table.table.column_names)
+    assert mirrored.filter(max_cloud_cover=40).ids == table.filter(max_cloud_cover=40).ids
+    assert mirrored.solar_days == table.solar_days
+
+
+def test_item_store(table, tmp_path) -> None:
+    key = get_search_key(collections=["sentinel-2-l2a"], datetime="2023-06-01/2023-06-30")
+    assert key == get_search_key(datetime="2023-06-01/2023-06-30", collections=["sentinel-2-l2a"])
+    store = ItemStore(tmp_path, ttl=60)
+    assert store.get(key) is None
+    store.put(key, table)
+    assert store.get(key).ids == table.ids
+
+    # expired results are searched again
+    expired = time.time() - 120
+    os.utime(tmp_path / f"{key}.parquet", (expired, expired))
+    assert store.get(key) is None
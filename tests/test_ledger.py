@@ -0,0 +1,134 @@
+from datetime import date, datetime, timedelta
+
+import shapely
+
+from mapa_streamlit.cache import Manifest
+from mapa_streamlit.ledger import (
+    Ledger,
+    LedgerEntry,
+    add_covered_date_range,
+    clip_covered_date_ranges,
+    get_ledger_key,
+    get_uncovered_date_ranges,
+)
+
+POLYGON = {"type": "Polygon", "coordinates": [[[11.0, 47.0], [11.1, 47.0], [11.1, 47.1], [11.0, 47.1], [11.0, 47.0]]]}
+
+
+def test_get_uncovered_date_ranges() -> None:
+    covered = [("2023-06-10", "2023-06-20"), ("2023-07-01", "2023-07-05")]
+    assert get_uncovered_date_ranges("2023-06-01/2023-07-31", []) == ["2023-06-01/2023-07-31"]
+    assert get_uncovered_date_ranges("2023-06-01/2023-07-31", covered) == [
+        "2023-06-01/2023-06-09",
+        "2023-06-21/2023-06-30",
+        "2023-07-06/2023-07-31",
+    ]
+    assert get_uncovered_date_ranges("2023-06-12/2023-06-15", covered) == []
+    assert get_uncovered_date_ranges("2023-06-15/2023-06-25", covered) == ["2023-06-21/2023-06-25"]
+
+
+def test_add_covered_date_range() -> None:
+    covered = add_covered_date_range([("2023-06-10", "2023-06-20")], "2023-06-21/2023-06-30")
+    assert covered == [("2023-06-10", "2023-06-30")]
+    assert add_covered_date_range(covered, "2023-05-01/2023-05-02") == [
+        ("2023-05-01", "2023-05-02"),
+        ("2023-06-10", "2023-06-30"),
+    ]
+
+    # the most recent days are searched again on the next refresh
+    today = date.today()
+    covered = add_covered_date_range([], f"{today - timedelta(days=10)}/{today}")
+    assert date.fromisoformat(covered[0][1]) < today - timedelta(days=1)
+    assert add_covered_date_range([], f"{today}/{today}") == []
+
+
+def test_get_ledger_key() -> None:
+    key = get_ledger_key("sentinel-2-l2a", ["B04", "B03"], POLYGON, 20)
+    assert key == get_ledger_key("sentinel-2-l2a", ["B04", "B03"], dict(POLYGON), 20)
+    assert key != get_ledger_key("sentinel-2-l2a", ["B03", "B04"], POLYGON, 20)
+    assert key != get_ledger_key("sentinel-2-l2a", ["B04", "B03"], POLYGON, 30)
+    assert key == get_ledger_key("sentinel-2-l2a", ["B04", "B03"], POLYGON, 20, min_clear_fraction=0)
+    assert key != get_ledger_key("sentinel-2-l2a", ["B04", "B03"], POLYGON, 20, min_clear_fraction=0.5)
+
+
+def test_ledger(tmp_path) -> None:
+    ledger = Ledger(tmp_path)
+    assert ledger.get("key") == LedgerEntry()
+
+    tifs = [tmp_path / f"scene-{i}.tif" for i in range(3)]
+    for tif in tifs:
+        tif.write_bytes(b"tif")
+    Manifest(tmp_path).add(*tifs)
+    entry = LedgerEntry(covered=[("2023-06-01", "2023-06-30")], items=["a", "b", "c"])
+    entry.add_scene("2023-06-21", datetime(2023, 6, 21, 10, 30), [tifs[2]])
+    entry.add_scene("2023-06-01", datetime(2023, 6, 1, 10, 30), [tifs[0]])
+    entry.add_scene("2023-07-02", datetime(2023, 7, 2, 10, 30), [tifs[1]])
+    ledger.put("key", entry)
+
+    entry = Ledger(tmp_path).get("key")
+    assert entry.items == ["a", "b", "c"]
+    assert [scene["paths"] for scene in entry.get_scenes("2023-06-01/2023-06-30")] == [[str(tifs[0])], [str(tifs[2])]]
+
+    # entries with files which were modified, e.g. a torn write, or deleted files are started from scratch
+    tifs[0].write_bytes(b"t")
+    assert ledger.get("key") == LedgerEntry()
+    tifs[0].write_bytes(b"tif")
+    assert ledger.get("key").items == ["a", "b", "c"]
+    tifs[1].unlink()
+    assert ledger.get("key") == LedgerEntry()
+
+
+def test_clip_covered_date_ranges() -> None:
+    covered = [("2023-05-01", "2023-05-31"), ("2023-06-10", "2023-06-20")]
+    assert clip_covered_date_ranges(covered, "2023-05-20/2023-06-15") == [
+        ("2023-05-20", "2023-05-31"),
+        ("2023-06-10", "2023-06-15"),
+    ]
+    assert clip_covered_date_ranges(covered, "2023-07-01/2023-07-31") == []
+
+
+def test_find_covering(monkeypatch, tmp_path) -> None:
+    search = {"collection": "sentinel-2-l2a", "bands": ["B04"], "cloud_cover": 20, "min_clear_fraction": 0}
+    tif = tmp_path / "scene.tif"
+    tif.write_bytes(b"tif")
+    Manifest(tmp_path).add(tif)
+    large = {"type": "Polygon", "coordinates": [[[11.0, 47.0], [11.5, 47.0], [11.5, 47.5], [11.0, 47.5], [11.0, 47.0]]]}
+
+    def _entry(geometry: dict, covered: list, **search_changes) -> LedgerEntry:
+        entry = LedgerEntry(covered=covered, search={**search, **search_changes}, geometry=geometry)
+        entry.add_scene("2023-06-01", datetime(2023, 6, 1, 10, 30), [tif])
+        return entry
+
+    ledger = Ledger(tmp_path)
+    ledger.put("large", _entry(large, [("2023-06-01", "2023-06-30")]))
+    ledger.put("small", _entry(POLYGON, [("2023-06-01", "2023-06-30")]))
+    ledger.put("other-bands", _entry(large, [("2023-06-01", "2023-06-30")], bands=["B03"]))
+
+    trees = []
+    strtree = shapely.STRtree
+    monkeypatch.setattr(shapely, "STRtree", lambda geoms: trees.append(geoms) or strtree(geoms))
+
+    inner = {"type": "Polygon", "coordinates": [[[11.02, 47.02], [11.05, 47.02], [11.05, 47.05], [11.02, 47.02]]]}
+    # the smallest aoi containing the geometry
+    assert ledger.find_covering(search, inner, "2023-06-01/2023-06-30")[0] == "small"
+    assert ledger.find_covering(search, POLYGON, "2023-06-01/2023-06-30")[0] == "small"
+    # the tree is kept as long as the ledger doesn't change
+    assert len(trees) == 1
+    partly_outside = {"type": "Polygon", "coordinates": [[[11.05, 47.05], [11.2, 47.05], [11.2, 47.2], [11.05, 47.05]]]}
+    assert ledger.find_covering(search, partly_outside, "2023-06-01/2023-06-30")[0] == "large"
+    assert ledger.find_covering({**search, "cloud_cover": 30}, inner, "2023-06-01/2023-06-30") is None
+    assert ledger.find_covering(search, inner, "2023-08-01/2023-08-31") is None
+
+    # entries covering more of the date range win over smaller ones
+    ledger.put("large", _entry(large, [("2023-06-01", "2023-07-31")]))
+    assert ledger.find_covering(search, inner, "2023-06-01/2023-07-31")[0] == "large"
+    # rebuilt after the ledger was written, by this or any other process
+    assert len(trees) == 2
+
+    # aois which only partly overlap an entry are fetched in full, also if other entries cover the rest of them
+    overlapping = {"type": "Polygon", "coordinates": [[[11.4, 47.4], [11.6, 47.4], [11.6, 47.6], [11.4, 47.4]]]}
+    assert ledger.find_covering(search, overlapping, "2023-06-01/2023-06-30") is None
+    east = {"type": "Polygon", "coordinates": [[[11.5, 47.0], [12.0, 47.0], [12.0, 47.5], [11.5, 47.5], [11.5, 47.0]]]}
+    ledger.put("east", _entry(east, [("2023-06-01", "2023-06-30")]))
+    across = {"type": "Polygon", "coordinates": [[[11.4, 47.1], [11.6, 47.1], [11.6, 47.2], [11.4, 47.1]]]}
+    assert ledger.find_covering(search, across, "2023-06-01/2023-06-30") is None
@@ -0,0 +1,67 @@
+import json
+import logging
+from urllib.request import urlopen
+
+import pytest
+
+from mapa_streamlit.metrics import REGISTRY, get_request_id, render_metrics, request_context, span
+from mapa_streamlit.serving import start_download_server, stop_download_server
+
+
+@pytest.fixture(autouse=True)
+def clear_registry():
+    REGISTRY.clear()
+    yield
+    REGISTRY.clear()
+
+
+def test_request_context() -> None:
+    assert get_request_id() is None
+    with request_context() as request_id:
+        assert get_request_id() == request_id
+        # nested contexts keep the id of the outer request
+        with request_context():
+            assert get_request_id() == request_id
+        with request_context("explicit"):
+            assert get_request_id() == "explicit"
+    assert get_request_id() is None
+
+
+def test_span_records_metrics_and_logs(caplog) -> None:
+    with caplog.at_level(logging.INFO, logger="mapa_streamlit.metrics"):
+        with request_context("abc"), span("zip", files=2) as s:
+            s.add_bytes(100)
+            s.add_bytes(23)
+
+    record = json.loads(caplog.records[-1].getMessage())
+    assert record["stage"] == "zip"
+    assert record["status"] == "ok"
+    assert record["request_id"] == "abc"
+    assert record["bytes"] == 123
+    assert record["files"] == 2
+
+    metrics = render_metrics()
+    assert 'mapa_stage_bytes_total{stage="zip"} 123' in metrics
+    assert 'mapa_stage_duration_seconds_count{stage="zip"} 1' in metrics
+    assert 'mapa_stage_duration_seconds_bucket{stage="zip",le="+Inf"} 1' in metrics
+
+
+def test_span_counts_errors() -> None:
+    with pytest.raises(ValueError):
+        with span("search"):
+            raise ValueError("boom")
+    assert 'mapa_stage_errors_total{stage="search"} 1' in render_metrics()
+
+
+def test_metrics_endpoint(monkeypatch) -> None:
+    monkeypatch.setattr("mapa_streamlit.conf.DOWNLOAD_SERVER_PORT", 0)
+    server = start_download_server()
+    try:
+        with span("sign"):
+            pass
+        host, port = server.server_address[:2]
+        with urlopen(f"http://{host}:{port}/metrics") as response:
+            assert response.headers["Content-Type"].startswith("text/plain")
+            assert 'mapa_stage_duration_seconds_count{stage="sign"} 1' in response.read().decode()
+    finally:
+        stop_download_server()
@@ -0,0 +1,37 @@
+from mapa_streamlit import planning
+from mapa_streamlit.planning import _bbox_to_geojson, fetch_stac_items_for_aois, plan_aoi_groups
+
+
+def test_plan_aoi_groups() -> None:
+    aois = [
+        _bbox_to_geojson([11.0, 47.0, 11.2, 47.2]),
+        _bbox_to_geojson([13.0, 48.0, 13.1, 48.1]),
+        _bbox_to_geojson([11.1, 47.1, 11.3, 47.3]),
+        # overlaps the previous one only, it's grouped with both of them
+        _bbox_to_geojson([11.25, 47.05, 11.4, 47.25]),
+    ]
+    assert plan_aoi_groups(aois) == [[0, 2, 3], [1]]
+
+
+def test_plan_aoi_groups_limits_union_area() -> None:
+    # two thin AOIs touching at the corner, their union would mostly consist of pixels outside of both
+    aois = [_bbox_to_geojson([11.0, 47.0, 12.0, 47.1]), _bbox_to_geojson([11.9, 47.0, 12.0, 48.0])]
+    assert plan_aoi_groups(aois, max_area_ratio=2.0) == [[0], [1]]
+    assert plan_aoi_groups(aois, max_area_ratio=10.0) == [[0, 1]]
+
+
+def test_plan_aoi_groups_without_overlap() -> None:
+    aois = [_bbox_to_geojson([i, 47.0, i + 0.5, 47.5]) for i in range(5)]
+    assert plan_aoi_groups(aois) == [[i] for i in range(5)]
+
+
+def test_fetch_stac_items_for_aois_does_not_merge_with_max_items(monkeypatch) -> None:
+    groups = []
+    monkeypatch.setattr(planning, "_fetch_group", lambda aois, *args: groups.append(sorted(aois)) or {})
+    aois = {"a": _bbox_to_geojson([11.0, 47.0, 11.2, 47.2]), "b": _bbox_to_geojson([11.1, 47.1, 11.3, 47.3])}
+
+    fetch_stac_items_for_aois(aois, ["B04"], "sentinel-2-l2a", {}, "2023", 20)
+    assert groups == [["a", "b"]]
+    groups.clear()
+    fetch_stac_items_for_aois(aois, ["B04"], "sentinel-2-l2a", {}, "2023", 20, max_items=2)
+    assert groups == [["a"], ["b"]]
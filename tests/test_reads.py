@@ -0,0 +1,145 @@
+import threading
+import time
+
+import dask
+import dask.array as da
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from mapa_streamlit.reads import HedgedReader, ReadStats, read_dataset
+
+
+class _FlakyRead:
+    """Read function failing the first `failures` times it is called."""
+
+    def __init__(self, failures: int, result=42) -> None:
+        self.failures = failures
+        self.calls = 0
+        self.result = result
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        with self._lock:
+            self.calls += 1
+            calls = self.calls
+        if calls <= self.failures:
+            raise IOError("range request failed")
+        return self.result
+
+
+def test_read_retries_failed_reads() -> None:
+    reader = HedgedReader(max_retries=3, backoff=0.0)
+    stats = ReadStats()
+    assert reader.read(_FlakyRead(failures=2), stats) == 42
+    assert stats == ReadStats(reads=1, retries=2, hedges=0, errors=0)
+
+
+def test_read_raises_after_retries() -> None:
+    reader = HedgedReader(max_retries=1, backoff=0.0)
+    stats = ReadStats()
+    with pytest.raises(IOError):
+        reader.read(_FlakyRead(failures=5), stats)
+    assert stats == ReadStats(reads=1, retries=1, hedges=0, errors=1)
+
+
+def test_read_hedges_slow_reads() -> None:
+    reader = HedgedReader(hedge_quantile=0.9, hedge_min_samples=5)
+    for _ in range(5):
+        reader.read(lambda: time.sleep(0.01))
+    assert reader.hedge_delay() == pytest.approx(0.01, abs=0.02)
+
+    calls = []
+
+    def _first_call_hangs():
+        calls.append(1)
+        if len(calls) == 1:
+            time.sleep(2)
+            return "slow"
+        return "fast"
+
+    stats = ReadStats()
+    start = time.perf_counter()
+    assert reader.read(_first_call_hangs, stats) == "fast"
+    assert time.perf_counter() - start < 1
+    assert stats.hedges == 1
+
+
+def test_read_hedges_within_budget() -> None:
+    # every read slower than the fastest one is hedged, as long as the budget allows it
+    reader = HedgedReader(hedge_quantile=0.0, hedge_min_samples=1, hedge_budget=0.25)
+    reader.read(lambda: None)
+    stats = ReadStats()
+    for _ in range(7):
+        reader.read(lambda: time.sleep(0.02), stats)
+    # 8 reads allow 2 hedges
+    assert stats.hedges == 2
+
+
+def test_read_hedges_per_size_class() -> None:
+    reader = HedgedReader(hedge_quantile=0.9, hedge_min_samples=5)
+    for _ in range(5):
+        reader.read(lambda: None, nbytes=1024)
+    assert reader.hedge_delay(1024) is not None
+    assert reader.hedge_delay(1500) is not None
+    # larger reads take longer, they are not compared against the latencies of the small ones
+    assert reader.hedge_delay(4 * 1024 * 1024) is None
+
+
+def test_read_dataset() -> None:
+    data = np.arange(2 * 3 * 4, dtype="uint16").reshape(2, 3, 4)
+    xx = xr.Dataset(
+        {"B04": (("time", "y", "x"), da.from_array(data, chunks=(1, 3, 4))), "B08": (("time", "y", "x"), data + 1)},
+        coords={"time": pd.to_datetime(["2023-01-01", "2023-01-02"])},
+    )
+    array, stats = read_dataset(xx, ["B04", "B08"], HedgedReader(backoff=0.0))
+    assert array.shape == (2, 3, 4, 2)
+    np.testing.assert_array_equal(array[..., 0], data)
+    np.testing.assert_array_equal(array[..., 1], data + 1)
+    assert stats == [ReadStats(reads=2), ReadStats(reads=2)]
+
+
+def test_read_dataset_fills_failed_scenes_with_nodata(monkeypatch) -> None:
+    monkeypatch.setattr("mapa_streamlit.conf.READ_FAIL_ON_ERROR", False)
+    flaky = _FlakyRead(failures=100, result=np.ones((3, 4)))
+    scene = da.from_delayed(dask.delayed(flaky)(), shape=(3, 4), dtype="float64")
+    xx = xr.Dataset(
+        {"B04": (("time", "y", "x"), da.stack([da.ones((3, 4)), scene]))},
+        coords={"time": pd.to_datetime(["2023-01-01", "2023-01-02"])},
+    )
+    array, stats = read_dataset(xx, ["B04"], HedgedReader(max_retries=2, backoff=0.0))
+    assert (array[0] == 1).all()
+    assert (array[1] == 0).all()
+    assert stats[0] == ReadStats(reads=1)
+    assert stats[1] == ReadStats(reads=1, retries=2, errors=1)
+
+    monkeypatch.setattr("mapa_streamlit.conf.READ_FAIL_ON_ERROR", True)
+    with pytest.raises(IOError):
+        read_dataset(xx, ["B04"], HedgedReader(max_retries=0, backoff=0.0))
+
+
+def test_read_dataset_retries_chunks_separately(monkeypatch) -> None:
+    monkeypatch.setattr("mapa_streamlit.conf.READ_FAIL_ON_ERROR", False)
+    steady = _FlakyRead(failures=0, result=np.ones((2, 4)))
+    flaky = _FlakyRead(failures=1, result=np.full((2, 4), 2.0))
+    chunks = [da.from_delayed(dask.delayed(read)(), shape=(2, 4), dtype="float64") for read in (steady, flaky)]
+    xx = xr.Dataset(
+        {"B04": (("time", "y", "x"), da.concatenate(chunks)[None])},
+        coords={"time": pd.to_datetime(["2023-01-01"])},
+    )
+    array, stats = read_dataset(xx, ["B04"], HedgedReader(max_retries=1, backoff=0.0))
+    assert (array[0, :2] == 1).all()
+    assert (array[0, 2:] == 2).all()
+    # only the failing chunk is read again
+    assert (steady.calls, flaky.calls) == (1, 2)
+    assert stats == [ReadStats(reads=2, retries=1)]
+
+    flaky = _FlakyRead(failures=100, result=np.full((2, 4), 2.0))
+    chunks = [da.ones((2, 4)), da.from_delayed(dask.delayed(flaky)(), shape=(2, 4), dtype="float64")]
+    xx["B04"] = (("time", "y", "x"), da.concatenate(chunks)[None])
+    array, stats = read_dataset(xx, ["B04"], HedgedReader(max_retries=0, backoff=0.0))
+    # the chunks which were read are kept
+    assert (array[0, :2] == 1).all()
+    assert (array[0, 2:] == 0).all()
+    assert stats == [ReadStats(reads=2, errors=1)]
@@ -0,0 +1,116 @@
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import pytest
+
+from mapa_streamlit.serving import (
+    _parse_range,
+    get_download_url,
+    is_download_registered,
+    is_download_server_reachable,
+    new_download_session,
+    open_download,
+    register_download,
+    start_download_server,
+    stop_download_server,
+)
+
+
+@pytest.fixture
+def download_server(monkeypatch):
+    monkeypatch.setattr("mapa_streamlit.conf.DOWNLOAD_SERVER_PORT", 0)
+    monkeypatch.setattr("mapa_streamlit.conf.DOWNLOAD_SERVER_PUBLIC_URL", "")
+    yield start_download_server()
+    stop_download_server()
+
+
+def test__parse_range() -> None:
+    assert _parse_range("bytes=0-9", 100) == (0, 9)
+    assert _parse_range("bytes=90-", 100) == (90, 99)
+    assert _parse_range("bytes=-10", 100) == (90, 99)
+    assert _parse_range("bytes=50-500", 100) == (50, 99)
+    assert _parse_range("bytes=100-", 100) is None
+    assert _parse_range("bytes=10-5", 100) is None
+    assert _parse_range("bytes=-", 100) is None
+    assert _parse_range("items=0-9", 100) is None
+
+
+def test_download_full_and_ranged(download_server, tmp_path) -> None:
+    content = bytes(range(256)) * 10
+    f = tmp_path / "foo.zip"
+    f.write_bytes(content)
+    url = register_download("foo.zip", f, "session")
+    assert is_download_registered("foo.zip", "session")
+
+    with urlopen(url) as response:
+        assert response.status == 200
+        assert response.headers["Accept-Ranges"] == "bytes"
+        assert 'filename="foo.zip"' in response.headers["Content-Disposition"]
+        assert response.read() == content
+
+    with urlopen(Request(url, headers={"Range": "bytes=10-19"})) as response:
+        assert response.status == 206
+        assert response.headers["Content-Range"] == f"bytes 10-19/{len(content)}"
+        assert response.read() == content[10:20]
+
+    with pytest.raises(HTTPError) as e:
+        urlopen(Request(url, headers={"Range": f"bytes={len(content)}-"}))
+    assert e.value.code == 416
+
+
+def test_download_is_built_on_demand(download_server, tmp_path) -> None:
+    calls = []
+
+    def build():
+        calls.append(1)
+        f = tmp_path / "lazy.zip"
+        f.write_bytes(b"lazy")
+        return f
+
+    url = register_download("lazy.zip", build, "session")
+    assert calls == []
+
+    for _ in range(2):
+        with urlopen(url) as response:
+            assert response.read() == b"lazy"
+    assert len(calls) == 1
+
+    # a built file which got removed, e.g. by the cleanup job, is built again
+    (tmp_path / "lazy.zip").unlink()
+    with urlopen(url) as response:
+        assert response.read() == b"lazy"
+    assert len(calls) == 2
+
+
+def test_download_unknown_file(download_server) -> None:
+    with pytest.raises(HTTPError) as e:
+        urlopen(get_download_url("does-not-exist.zip", "session"))
+    assert e.value.code == 404
+
+
+def test_download_is_restricted_to_its_session(download_server, tmp_path) -> None:
+    (tmp_path / "foo.zip").write_bytes(b"foo")
+    session = new_download_session()
+    url = register_download("foo.zip", tmp_path / "foo.zip", session)
+    assert not is_download_registered("foo.zip", new_download_session())
+    with open_download("foo.zip", session) as f:
+        assert f.read() == b"foo"
+    with pytest.raises(FileNotFoundError):
+        open_download("foo.zip", "other")
+
+    for other_url in (url.replace(session, "other"), url.replace(f"{session}/", "")):
+        with pytest.raises(HTTPError) as e:
+            urlopen(other_url)
+        assert e.value.code == 404
+
+
+def test_is_download_server_reachable(monkeypatch) -> None:
+    monkeypatch.setattr("mapa_streamlit.conf.DOWNLOAD_SERVER_HOST", "127.0.0.1")
+    monkeypatch.setattr("mapa_streamlit.conf.DOWNLOAD_SERVER_PUBLIC_URL", "")
+    assert is_download_server_reachable("localhost:8501")
+    assert is_download_server_reachable("127.0.0.1")
+    # links to the loopback interface break for remote browsers
+    assert not is_download_server_reachable("mapa.example.com")
+    assert not is_download_server_reachable(None)
+    monkeypatch.setattr("mapa_streamlit.conf.DOWNLOAD_SERVER_PUBLIC_URL", "https://mapa.example.com/files")
+    assert is_download_server_reachable("mapa.example.com")
@@ -0,0 +1,117 @@
+import json
+import threading
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pystac
+import pytest
+
+from mapa_streamlit.signing import TOKEN_CACHE, _parse_blob_href, sign_href, sign_inplace, unsign_href
+
+HREF = "https://account.blob.core.windows.net/container/scene/B04.tif"
+
+
+class _TokenEndpoint:
+    """Local stand-in for the planetary computer sas token endpoint."""
+
+    def __init__(self) -> None:
+        self.requests = []
+        self.lifetime = timedelta(hours=1)
+        endpoint = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                endpoint.requests.append(self.path)
+                account, container = self.path.strip("/").split("/")[-2:]
+                expiry = datetime.now(timezone.utc) + endpoint.lifetime
+                body = json.dumps(
+                    {"msft:expiry": expiry.strftime("%Y-%m-%dT%H:%M:%SZ"), "token": f"sig={account}-{container}"}
+                ).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args) -> None:
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}/api/sas/v1/token"
+
+
+@pytest.fixture
+def token_endpoint(monkeypatch):
+    endpoint = _TokenEndpoint()
+    monkeypatch.setattr("mapa_streamlit.conf.PLANETARY_COMPUTER_SAS_URL", endpoint.url)
+    TOKEN_CACHE.clear()
+    yield endpoint
+    TOKEN_CACHE.clear()
+    endpoint.server.shutdown()
+
+
+def _item(item_id: str, hrefs: dict) -> pystac.Item:
+    item = pystac.Item(item_id, None, None, datetime(2023, 1, 1), {})
+    for key, href in hrefs.items():
+        item.add_asset(key, pystac.Asset(href))
+    return item
+
+
+def test__parse_blob_href() -> None:
+    assert _parse_blob_href(HREF) == ("account", "container")
+    assert _parse_blob_href("https://example.com/scene/B04.tif") is None
+    assert _parse_blob_href(f"{HREF}?st=2023&se=2023&sp=r&sig=abc") is None
+    assert _parse_blob_href("https://ai4edatasetspublicassets.blob.core.windows.net/assets/thumb.png") is None
+
+
+def test_sign_href_caches_tokens(token_endpoint) -> None:
+    assert sign_href(HREF) == f"{HREF}?sig=account-container"
+    assert sign_href(HREF.replace("B04", "B03")) == f"{HREF.replace('B04', 'B03')}?sig=account-container"
+    assert len(token_endpoint.requests) == 1
+
+    # hrefs outside of blob storage are not touched
+    assert sign_href("https://example.com/B04.tif") == "https://example.com/B04.tif"
+    assert len(token_endpoint.requests) == 1
+
+
+def test_sign_href_refreshes_expiring_tokens(token_endpoint) -> None:
+    # a token which expires within the safety margin is requested again
+    token_endpoint.lifetime = timedelta(seconds=30)
+    sign_href(HREF)
+    sign_href(HREF)
+    assert len(token_endpoint.requests) == 2
+
+
+def test_sign_inplace_item_collection(token_endpoint) -> None:
+    other = "https://other.blob.core.windows.net/data/scene/B04.tif"
+    items = pystac.ItemCollection(
+        [_item(f"item-{i}", {"B04": HREF.replace("scene", f"scene-{i}"), "B08": other}) for i in range(50)]
+    )
+    sign_inplace(items)
+
+    assert all(item.assets["B04"].href.endswith("?sig=account-container") for item in items)
+    assert all(item.assets["B08"].href.endswith("?sig=other-data") for item in items)
+    # one token request per storage container for the whole batch
+    assert sorted(token_endpoint.requests) == ["/api/sas/v1/token/account/container", "/api/sas/v1/token/other/data"]
+
+
+def test_sign_inplace_search_page_dict(token_endpoint) -> None:
+    page = {
+        "type": "FeatureCollection",
+        "features": [{"type": "Feature", "assets": {"B04": {"href": HREF}, "thumbnail": {"href": "https://x/y.png"}}}],
+    }
+    sign_inplace(page)
+    assets = page["features"][0]["assets"]
+    assert assets["B04"]["href"] == f"{HREF}?sig=account-container"
+    assert assets["thumbnail"]["href"] == "https://x/y.png"
+
+
+def test_unsign_href() -> None:
+    signed = f"{HREF}?st=2023-06-01T10%3A00%3A00Z&se=2023-06-02T10%3A00%3A00Z&sp=rl&sv=2021-06-08&sr=c&sig=abc%3D"
+    assert unsign_href(signed) == HREF
+    assert unsign_href(f"{HREF}?version=2&sig=abc") == f"{HREF}?version=2"
+    assert unsign_href("https://example.com/B04.tif?sig=abc") == "https://example.com/B04.tif?sig=abc"
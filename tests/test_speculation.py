@@ -0,0 +1,88 @@
+import threading
+
+import pystac
+import pytest
+
+from mapa_streamlit import conf
+from mapa_streamlit.speculation import Speculation, speculate
+from mapa_streamlit.stac import get_patch_url
+from tests.test_grid import ORIGIN, _aoi, _item, _write_cog
+
+REQUEST = dict(
+    user_defined_collection="landsat-c2-l2",
+    user_defined_bands=["B04"],
+    date_range="2023-06-01/2023-06-30",
+    cloud_cover_percentage_value=20,
+)
+
+
+@pytest.fixture
+def searches(monkeypatch, tmp_path):
+    """Search answered with a page of one local COG, recording the searched date ranges and the opened hrefs."""
+    monkeypatch.setattr(conf, "CACHE_ROOT", str(tmp_path / "cache"))
+    monkeypatch.setattr(conf, "BLOCK_CACHE_MAX_BYTES", 0)
+    monkeypatch.setattr(conf, "SPECULATION_DELAY", 0)
+    _write_cog(tmp_path / "B04.tif")
+    calls, opened, searching, release = [], [], threading.Event(), threading.Event()
+    release.set()
+
+    def _iter_stac_item_pages(collection, geojson, date_range, cloud_cover, min_clear_fraction=None):
+        calls.append(date_range)
+        searching.set()
+        release.wait(5)
+        yield pystac.ItemCollection([_item(str(tmp_path / "B04.tif"))])
+
+    def _patch_url(href: str) -> str:
+        opened.append(href)
+        return href
+
+    monkeypatch.setattr("mapa_streamlit.speculation.iter_stac_item_pages", _iter_stac_item_pages)
+
+    def _get_patch_url(items):
+        assert get_patch_url(items) is None
+        return _patch_url
+
+    monkeypatch.setattr("mapa_streamlit.speculation.get_patch_url", _get_patch_url)
+    return calls, opened, searching, release
+
+
+def test_speculation(searches) -> None:
+    calls, opened, _, _ = searches
+    aoi = _aoi(ORIGIN[0] + 3_000, ORIGIN[1] - 6_000, ORIGIN[0] + 6_000, ORIGIN[1] - 3_000)
+
+    speculation = Speculation(aoi, min_clear_fraction=0, **REQUEST).start()
+    assert speculation.done.wait(5)
+    assert calls == [REQUEST["date_range"]]
+    assert [item.id for item in speculation.items] == ["scene"]
+    assert speculation.estimated_bytes == 100 * 100 * 4
+    assert [href.rsplit("/", 1)[-1] for href in opened] == ["B04.tif"]
+    # the request picks up the finished search
+    assert speculation.pick_up(timeout=0)
+
+
+def test_speculate_supersedes_previous_requests(searches, monkeypatch) -> None:
+    calls, opened, searching, release = searches
+    monkeypatch.setattr(conf, "SPECULATION_DELAY", 5)
+    aoi = _aoi(ORIGIN[0] + 3_000, ORIGIN[1] - 6_000, ORIGIN[0] + 6_000, ORIGIN[1] - 3_000)
+
+    first = speculate(None, aoi, **REQUEST)
+    # the same request keeps its speculation, a changed one supersedes it before it started searching
+    assert speculate(first, aoi, **REQUEST) is first
+    second = speculate(first, aoi, **{**REQUEST, "cloud_cover_percentage_value": 30})
+    assert first.cancelled.is_set() and first.done.wait(5) and first.items is None
+    assert not second.cancelled.is_set()
+
+    # a search is stopped once superseded, without reading any headers
+    monkeypatch.setattr(conf, "SPECULATION_DELAY", 0)
+    release.clear()
+    third = speculate(second, aoi, **{**REQUEST, "user_defined_bands": ["B03"]})
+    assert searching.wait(5)
+    fourth = speculate(third, aoi, **REQUEST)
+    release.set()
+    assert third.done.wait(5) and third.items is None
+    assert fourth.done.wait(5) and fourth.items
+    assert calls == [REQUEST["date_range"]] * 2 and len(opened) == 1
+
+    monkeypatch.setattr(conf, "SPECULATION", False)
+    assert speculate(fourth, aoi, **{**REQUEST, "date_range": "2023-07-01/2023-07-31"}) is None
+    assert fourth.cancelled.is_set()
@@ -0,0 +1,133 @@
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pystac
+import rasterio
+import xarray as xr
+from rasterio.transform import from_origin
+
+from mapa_streamlit import conf
+from mapa_streamlit.items import ItemTable
+from mapa_streamlit.stac import (
+    _drop_already_loaded_days,
+    _get_solar_day,
+    _iter_solar_day_batches,
+    _turn_geojson_into_bbox,
+    iter_stac_item_pages,
+    load_stac_items_for_bbox,
+)
+from tests.test_grid import ORIGIN, RESOLUTION, _aoi, _item
+
+
+def _dataset(times):
+    time = pd.to_datetime(times)
+    return xr.Dataset({"B04": (("time", "y", "x"), np.ones((len(time), 2, 2)))}, coords={"time": time})
+
+
+def _tile(item_id: str, time: datetime, lon: float = 11.0) -> pystac.Item:
+    return pystac.Item(item_id, geometry=None, bbox=[lon - 0.5, 47.0, lon + 0.5, 48.0], datetime=time, properties={})
+
+
+def _ids(batches) -> list:
+    return [batch.ids for batch in batches]
+
+
+def test__get_solar_day() -> None:
+    assert _get_solar_day(_tile("a", datetime(2023, 6, 1, 10))) == "2023-06-01"
+    # 23:00 utc is already the next day at 30° east
+    assert _get_solar_day(_tile("b", datetime(2023, 6, 1, 23), lon=30.0)) == "2023-06-02"
+
+
+def test__iter_solar_day_batches() -> None:
+    pages = [
+        [_tile("a1", datetime(2023, 6, 1, 10)), _tile("b1", datetime(2023, 6, 5, 10))],
+        # the second tile of the 5th is on the next page
+        [_tile("b2", datetime(2023, 6, 5, 10, 1)), _tile("c1", datetime(2023, 6, 9, 10))],
+        [_tile("c2", datetime(2023, 6, 9, 10, 1))],
+    ]
+    pages = [ItemTable.from_items(page) for page in pages]
+    # all tiles of a day are part of the same batch, days are yielded once a later day shows up
+    assert _ids(_iter_solar_day_batches(iter(pages), sorted_by_time=True)) == [["a1"], ["b1", "b2"], ["c1", "c2"]]
+    # pages which are not sorted by time are yielded at once
+    assert _ids(_iter_solar_day_batches(iter(pages[::-1]), sorted_by_time=False)) == [
+        ["c2", "b2", "c1", "a1", "b1"]
+    ]
+    assert _ids(_iter_solar_day_batches(iter([]), sorted_by_time=True)) == []
+
+
+def test_iter_stac_item_pages_answers_max_items_from_stored_search(tmp_path, monkeypatch) -> None:
+    tiles = [_tile(f"t{i}", datetime(2023, 6, 1 + i, 10)) for i in range(4)]
+    for tile, cloud_cover in zip(tiles, [30, 10, 40, 20]):
+        tile.properties["eo:cloud_cover"] = cloud_cover
+        tile.add_asset("B04", pystac.Asset(f"{tmp_path}/{tile.id}.tif"))
+    searches = []
+
+    class _Catalog:
+        def search_pages(self, **search):
+            searches.append(search)
+            yield from (pystac.ItemCollection(page) for page in [tiles[:2], tiles[2:]])
+
+    monkeypatch.setattr(conf, "CACHE_ROOT", str(tmp_path))
+    monkeypatch.setattr("mapa_streamlit.stac.get_catalog", _Catalog)
+    aoi = {"type": "Polygon", "coordinates": [[[11.0, 47.0], [11.1, 47.0], [11.1, 47.1], [11.0, 47.1], [11.0, 47.0]]]}
+    pages = list(iter_stac_item_pages("sentinel-2-l2a", aoi, "2023-06-01/2023-06-30", 50))
+    assert [[item.id for item in page] for page in pages] == [["t0"], ["t1", "t2"], ["t3"]]
+    # the least cloudy items are taken from the stored results of the whole search, instead of searching again
+    pages = list(iter_stac_item_pages("sentinel-2-l2a", aoi, "2023-06-01/2023-06-30", 50, max_items=2))
+    assert [[item.id for item in page] for page in pages] == [["t1", "t3"]]
+    assert len(searches) == 1
+
+
+def test__drop_already_loaded_days() -> None:
+    loaded_days = set()
+    first_page = _drop_already_loaded_days(_dataset(["2023-01-01T10:00", "2023-01-05T10:00"]), loaded_days)
+    assert first_page.time.size == 2
+    assert loaded_days == {"2023-01-01", "2023-01-05"}
+
+    second_page = _drop_already_loaded_days(_dataset(["2023-01-05T10:30", "2023-01-09T10:00"]), loaded_days)
+    assert list(pd.to_datetime(second_page.time.values).strftime("%Y-%m-%d")) == ["2023-01-09"]
+    assert loaded_days == {"2023-01-01", "2023-01-05", "2023-01-09"}
+
+
+def test__turn_geojson_into_bbox() -> None:
+    geometry = {
+        "type": "MultiPolygon",
+        "coordinates": [
+            [[[11.0, 47.0], [11.1, 47.0], [11.0, 47.1], [11.0, 47.0]]],
+            [[[11.3, 47.2], [11.4, 47.3], [11.3, 47.3], [11.3, 47.2]]],
+        ],
+    }
+    assert _turn_geojson_into_bbox(geometry) == [11.0, 47.0, 11.4, 47.3]
+
+
+def test_load_stac_items_for_bbox_fuses_days_split_across_pages(tmp_path, monkeypatch) -> None:
+    # the left and right half of the aoi are two tiles of the same day, returned on different pages
+    tiles = []
+    for i, (x, value) in enumerate([(ORIGIN[0], 1), (ORIGIN[0] + 256 * RESOLUTION, 2)]):
+        profile = {"driver": "COG", "width": 256, "height": 512, "count": 1, "dtype": "uint16", "nodata": 0}
+        profile.update(crs="EPSG:32632", transform=from_origin(x, ORIGIN[1], RESOLUTION, RESOLUTION))
+        with rasterio.open(tmp_path / f"tile-{i}.tif", "w", **profile) as dst:
+            dst.write(np.full((1, 512, 256), value, dtype="uint16"))
+        tile = _item(str(tmp_path / f"tile-{i}.tif"))
+        tile.id, tile.datetime = f"tile-{i}", datetime(2023, 6, 1, 10, i)
+        tile.properties.update({"proj:shape": [512, 256], "proj:transform": list(profile["transform"])[:6]})
+        tiles.append(tile)
+    later = _item(str(tmp_path / "tile-0.tif"))
+    later.id, later.datetime = "later", datetime(2023, 6, 3, 10)
+    later.properties.update(tiles[0].properties, datetime="2023-06-03T10:00:00Z")
+
+    class _Catalog:
+        def search_pages(self, **search):
+            assert search["sortby"] == conf.STAC_SEARCH_SORTBY
+            yield from (pystac.ItemCollection(page) for page in [[tiles[0]], [tiles[1], later]])
+
+    monkeypatch.setattr(conf, "CACHE_ROOT", str(tmp_path / "cache"))
+    monkeypatch.setattr("mapa_streamlit.stac.get_catalog", _Catalog)
+    aoi = _aoi(ORIGIN[0] + 6_000, ORIGIN[1] - 9_000, ORIGIN[0] + 9_000, ORIGIN[1] - 6_000)
+    _, xx = load_stac_items_for_bbox("landsat-c2-l2", aoi, "2023-06-01/2023-06-30", 100)
+
+    first_day = xx["B04"].isel(time=0).values
+    assert xx.sizes["time"] == 2
+    # both tiles are fused into the scene of the day, no pixel is left empty
+    assert set(np.unique(first_day)) == {1, 2}
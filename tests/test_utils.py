@@ -0,0 +1,128 @@
+import threading
+import time
+
+import pytest
+
+from mapa_streamlit.utils import DaskProgressCallback, ProgressBar, prefetch_iterator
+
+
+def test_prefetch_iterator() -> None:
+    assert list(prefetch_iterator(range(10), depth=3)) == list(range(10))
+    assert list(prefetch_iterator([], depth=3)) == []
+
+
+def test_prefetch_iterator_runs_ahead() -> None:
+    produced = []
+
+    def _slow_pages():
+        for i in range(3):
+            produced.append(i)
+            yield i
+
+    pages = prefetch_iterator(_slow_pages(), depth=2)
+    assert next(pages) == 0
+    # the next pages are requested while the first one is being processed
+    time.sleep(0.2)
+    assert produced == [0, 1, 2]
+    assert list(pages) == [1, 2]
+
+
+def test_prefetch_iterator_reraises() -> None:
+    def _failing():
+        yield 1
+        raise RuntimeError("search failed")
+
+    pages = prefetch_iterator(_failing())
+    assert next(pages) == 1
+    with pytest.raises(RuntimeError, match="search failed"):
+        next(pages)
+
+
+def test_prefetch_iterator_stops_producer_when_closed() -> None:
+    pages = prefetch_iterator(iter(range(1_000_000)), depth=1)
+    assert next(pages) == 0
+    pages.close()
+    time.sleep(0.3)
+    assert not [t for t in threading.enumerate() if t.name == "mapa-prefetch"]
+
+
+class _FakeStreamlitProgress:
+    def __init__(self) -> None:
+        self.values = []
+        self.texts = []
+
+    def progress(self, value: int, text: str = None) -> None:
+        self.values.append(value)
+        self.texts.append(text)
+
+
+def test_progress_bar_without_work() -> None:
+    fake = _FakeStreamlitProgress()
+    progress_bar = ProgressBar(fake)
+    assert progress_bar.fraction == 0.0
+    assert progress_bar.eta() is None
+    progress_bar.refresh(force=True)
+    assert fake.values == [0]
+
+
+def test_progress_bar_is_monotonic() -> None:
+    fake = _FakeStreamlitProgress()
+    progress_bar = ProgressBar(fake, min_update_interval=0)
+    progress_bar.add_work(100)
+    progress_bar.step(50)
+    # registering more work later on must not move the bar backwards
+    progress_bar.add_work(100)
+    progress_bar.step(10)
+    progress_bar.step(140)
+    assert fake.values == [50, 50, 100]
+    assert fake.texts[-1] == "100%"
+
+
+def test_progress_bar_throttles_updates() -> None:
+    fake = _FakeStreamlitProgress()
+    progress_bar = ProgressBar(fake, steps=1000, min_update_interval=60)
+    for _ in range(999):
+        progress_bar.step()
+    # only the first update gets through, the completion is always shown
+    assert fake.values == [0]
+    progress_bar.step()
+    assert fake.values == [0, 100]
+
+
+def test_progress_bar_eta() -> None:
+    fake = _FakeStreamlitProgress()
+    progress_bar = ProgressBar(fake, steps=100, min_update_interval=0)
+    time.sleep(0.1)
+    progress_bar.step(50)
+    assert 0.05 < progress_bar.eta() < 1
+    assert "left" in fake.texts[-1]
+
+
+def test_progress_bar_ignores_updates_from_worker_threads() -> None:
+    fake = _FakeStreamlitProgress()
+    progress_bar = ProgressBar(fake, steps=10, min_update_interval=0)
+    worker = threading.Thread(target=progress_bar.step, args=(5,))
+    worker.start()
+    worker.join()
+    assert fake.values == []
+    assert progress_bar.fraction == 0.5
+    progress_bar.refresh()
+    assert fake.values == [50]
+
+
+def test_dask_progress_callback() -> None:
+    da = pytest.importorskip("dask.array")
+
+    fake = _FakeStreamlitProgress()
+    progress_bar = ProgressBar(fake, steps=800, min_update_interval=0)
+    array = da.ones((10, 10), chunks=(2, 2))
+    progress = DaskProgressCallback(progress_bar, units=800)
+    array.sum().compute(scheduler="synchronous", callbacks=progress.callbacks)
+    progress.finish()
+    assert progress_bar.counter == 800
+    assert len(fake.values) > 2
+
+    # repeating the computation, e.g. for a retry, never reports more than the given units
+    array.sum().compute(scheduler="synchronous", callbacks=progress.callbacks)
+    progress.finish()
+    assert progress_bar.counter == 800
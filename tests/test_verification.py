@@ -20,6 +20,22 @@ def test_selected_bbox_too_large() -> None:
     assert selected_bbox_too_large(geometry=geometry, threshold=60) is False
 
 
+def test_selected_bbox_too_large_polygon() -> None:
+    # the bbox of the multipolygon is 4 x 3 degrees
+    geometry = {
+        "type": "MultiPolygon",
+        "coordinates": [
+            [[[0.0, 0.0], [1.0, 0.0], [0.0, 1.0], [0.0, 0.0]]],
+            [[[3.0, 2.0], [4.0, 3.0], [3.0, 3.0], [3.0, 2.0]]],
+        ],
+    }
+    assert selected_bbox_too_large(geometry=geometry, threshold=11) is True
+    assert selected_bbox_too_large(geometry=geometry, threshold=12) is False
+    assert selected_bbox_in_boundary(geometry) is True
+    geometry["coordinates"][1][0][1] = [200.0, 3.0]
+    assert selected_bbox_in_boundary(geometry) is False
+
+
 def test__get_area() -> None:
     bbox = [[1, 1], [1, 3], [3, 1], [3, 3]]
     area = _get_area(bbox=bbox)